@@ -1,7 +1,133 @@
-from flask import Flask, render_template, session, json, request
+from flask import Flask, render_template, session, json, request, Response, abort, stream_with_context
 from flask_session import Session
 from datetime import timedelta
+import hmac
+import os
+import sqlite3
+from sql import tenant_db_path
+from utils import metrics
+from xero import jobs
+from recon.trial_balance import trial_balance
+from recon.balance_index import balance_as_of, balance_between
+from recon.search import search_lines
 
 app = Flask(__name__)
 app.permanent_session_lifetime = timedelta(days=14)
 Session(app)
+
+def metrics_allowed() -> bool:
+    '''With ``config.metrics_token`` set, scrapers must send it as a bearer token;
+    without it only local requests may read the metrics, which name every tenant.'''
+    import config
+    token = getattr(config, 'metrics_token', None)
+    if token:
+        return hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+    return request.remote_addr in ('127.0.0.1', '::1')
+
+def require_tenant_user(tenant_id: str):
+    '''Aborts with 403 unless the session's user is connected to the tenant.'''
+    from xero.oauth import is_tenant_user
+    user = session.get('user')
+    if not user or not is_tenant_user(user, tenant_id):
+        abort(403)
+
+def require_tenant(tenant_id: str):
+    '''Aborts with 403 unless the session's user is connected to the tenant, then with 404
+    if nothing has been synced for it. Opening a missing tenant would create its file.'''
+    require_tenant_user(tenant_id)
+    if not os.path.exists(tenant_db_path(tenant_id)):
+        abort(404)
+
+def not_synced(e: sqlite3.OperationalError, description: str):
+    '''409 for a tenant whose tables have not been created by a sync yet.'''
+    if not str(e).startswith('no such table'):
+        raise e
+    return {'error': True, 'description': description}, 409
+
+@app.route('/metrics')
+def prometheus_metrics():
+    if not metrics_allowed():
+        abort(403)
+    return Response(metrics.registry.collect(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/sync/<tenant_id>', methods=['POST'])
+def start_sync(tenant_id: str):
+    '''Queues a background sync and returns its job id; progress is at /sync/jobs/<job>/events.
+    A request the tenant's current job does not cover is refused with 409 and that job's id.'''
+    require_tenant_user(tenant_id)
+    body = request.get_json(silent=True) or {}
+    try:
+        job_id, created = jobs.enqueue(tenant_id, tuple(body.get('entities', jobs.ENTITIES)), body.get('kind', 'update'))
+    except ValueError as e:
+        return {'error': True, 'description': str(e)}, 400
+    except jobs.JobConflict as e:
+        return {'error': True, 'description': str(e), 'job': e.job_id}, 409
+    # 'existing' when the tenant's queued or running job already covers the request
+    return {'error': False, 'job': job_id, 'existing': not created}, 202
+
+@app.route('/sync/jobs/<job_id>')
+def sync_job(job_id: str):
+    job = jobs.get_job(job_id)
+    if job is None:
+        abort(404)
+    require_tenant_user(job['tenant'])
+    return job
+
+@app.route('/sync/jobs/<job_id>/events')
+def sync_job_events(job_id: str):
+    '''Server-sent events for the job: its current state, then each progress event
+    until it is done or failed.'''
+    job = jobs.get_job(job_id)
+    if job is None:
+        abort(404)
+    require_tenant_user(job['tenant'])
+
+    def stream():
+        for event in jobs.events(job_id):
+            if event is None:
+                yield ': keep-alive\n\n'
+            else:
+                yield f"event: {event['status']}\ndata: {json.dumps(event)}\n\n"
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/tenants/<tenant_id>/trial-balance/<at>')
+def local_trial_balance(tenant_id: str, at: str):
+    '''Trial balance at the end of the date ``at`` (YYYY-MM-DD), from stored journals.'''
+    require_tenant(tenant_id)
+    try:
+        return trial_balance(tenant_id, at)
+    except ValueError as e:
+        return {'error': True, 'description': str(e)}, 400
+    except sqlite3.OperationalError as e:
+        return not_synced(e, 'The tenant needs a sync before its trial balance can be computed')
+
+@app.route('/tenants/<tenant_id>/accounts/<account_id>/balance/<at>')
+def account_balance(tenant_id: str, account_id: str, at: str):
+    '''Balance at the end of ``at``, or with ?from=YYYY-MM-DD the movement from then to ``at``.'''
+    require_tenant(tenant_id)
+    try:
+        if 'from' in request.args:
+            return balance_between(tenant_id, account_id, request.args['from'], at)
+        return balance_as_of(tenant_id, account_id, at)
+    except ValueError as e:
+        return {'error': True, 'description': str(e)}, 400
+    except sqlite3.OperationalError as e:
+        return not_synced(e, 'The balance index is built by the next sync of the tenant')
+
+@app.route('/tenants/<tenant_id>/search')
+def journal_search(tenant_id: str):
+    '''Journal lines matching ?q=, optionally limited by ?account=, ?from=, ?to= and
+    ?amount= with ?tolerance=.'''
+    require_tenant(tenant_id)
+    args = request.args
+    try:
+        amount = args.get('amount', type=float)
+        return {'Lines': search_lines(tenant_id, args.get('q', ''), account_id=args.get('account'),
+            start=args.get('from'), end=args.get('to'), amount=amount,
+            tolerance=args.get('tolerance', 0.0, type=float), limit=args.get('limit', 50, type=int))}
+    except ValueError as e:
+        return {'error': True, 'description': str(e)}, 400
+    except sqlite3.OperationalError as e:
+        return not_synced(e, 'The search index is built by the next sync of the tenant')
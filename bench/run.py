@@ -0,0 +1,428 @@
+'''Sync throughput benchmarks on synthetic tenants.
+
+    python -m bench.run [--lines 10000 100000 1000000] [--cases parse write_df ...]
+        [--queries 200] [--latency 0.02] [--per-minute 60 --minute 5] [--out results.json] [--baseline results.json]
+
+Each case runs in a fresh process so peak RSS is its own. With ``--baseline`` the run
+is compared to an earlier ``--out`` file and exits non-zero if any case's rows/s fell
+by more than ``--tolerance``.
+'''
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from time import perf_counter
+from .synthetic import journal_pages
+from .server import StandInConfig, StandInProcess, bench_api, PAGE_SIZE, TENANT_ID
+
+SIZES = (10_000, 100_000, 1_000_000)
+LINES_PER_JOURNAL = 4
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / 1024
+
+def parse(journals: int, lines: int, options: dict) -> dict:
+    from xero.parser import JournalsParser
+    elapsed = 0.0
+    rows = 0
+    for page in journal_pages(journals, lines, PAGE_SIZE):
+        start = perf_counter()
+        parser = JournalsParser(page)
+        elapsed += perf_counter() - start
+        rows += len(parser.journal_lines)
+    return {'rows': rows, 'seconds': elapsed}
+
+def _write(journals: int, lines: int, frames: bool) -> dict:
+    import sql
+    from xero.parser import JournalsParser
+    from sql.writer import write_df_to_sql, write_rows_to_sql, transaction
+    elapsed = 0.0
+    rows = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        sql.db_dir = tmp
+        os.makedirs(f'{tmp}/xero_tenants')
+        sql.xero_base(TENANT_ID)
+        for page in journal_pages(journals, lines, PAGE_SIZE):
+            parser = JournalsParser(page)
+            if frames:
+                # build the frames outside the timing, as the parser would have them ready
+                df_journals, df_journal_lines = parser.df_journals, parser.df_journal_lines
+            start = perf_counter()
+            with sql.tenant_writer(TENANT_ID) as con, transaction(con):
+                if frames:
+                    write_df_to_sql(con, df_journals, 'Journals')
+                    write_df_to_sql(con, df_journal_lines, 'JournalLines')
+                else:
+                    write_rows_to_sql(con, parser.journals, 'Journals', parser.cols_journal)
+                    write_rows_to_sql(con, parser.journal_lines, 'JournalLines', parser.cols_journal_line)
+            elapsed += perf_counter() - start
+            rows += len(parser.journal_lines)
+        sql.pool.close()
+    return {'rows': rows, 'seconds': elapsed}
+
+def write_df(journals: int, lines: int, options: dict) -> dict:
+    return _write(journals, lines, frames=True)
+
+def write_rows(journals: int, lines: int, options: dict) -> dict:
+    return _write(journals, lines, frames=False)
+
+def full_update(journals: int, lines: int, options: dict) -> dict:
+    import sql
+    import xero.cache
+    from xero.updater import JournalUpdater
+    from xero.ratelimit import RateLimiter
+    # the stand-in tenant has no Redis; keep the end-of-sync invalidation in process
+    xero.cache._shared = xero.cache.ResponseCache()
+    config = StandInConfig(journals, lines, latency=options['latency'], concurrent=options['concurrent'],
+        per_minute=options['per_minute'], minute=options['minute'])
+    with tempfile.TemporaryDirectory() as tmp, StandInProcess(config) as server:
+        sql.db_dir = tmp
+        os.makedirs(f'{tmp}/xero_tenants')
+        sql.xero_base(TENANT_ID)
+        limiter = RateLimiter() if options['limiter'] else None
+        updater = JournalUpdater(TENANT_ID, bench_api(server.url, limiter=limiter, stream=options['stream']))
+        start = perf_counter()
+        result = updater.full_update()
+        elapsed = perf_counter() - start
+        if result['error']:
+            raise RuntimeError(result['description'])
+        with sql.tenant_reader(TENANT_ID) as con:
+            rows = con.execute('SELECT count(*) FROM JournalLines;').fetchone()[0]
+        stats = server.stats()
+        sql.pool.close()
+    return {'rows': rows, 'seconds': elapsed, 'api_calls': stats['api_calls'],
+        'throttled': sum(stats['throttled'].values())}
+
+def aio(journals: int, lines: int, options: dict) -> dict:
+    '''Journals for ``--tenants`` tenants fetched at once through AsyncXeroApi on one
+    session, every request paced by a shared RateLimiter, and parsed.'''
+    import asyncio
+    from time import time
+    from xero.aioapi import AsyncXeroTokenSession, AsyncXeroApi
+    from xero.parser import JournalsParser
+    from xero.ratelimit import RateLimiter
+    config = StandInConfig(journals, lines, latency=options['latency'], concurrent=options['concurrent'],
+        per_minute=options['per_minute'], minute=options['minute'])
+    token = {'access_token': 'bench', 'token_type': 'Bearer', 'expires_at': time() + 10 * 365 * 86400}
+    # Xero's budgets: past 60 pages a tenant waits for the minute window, as it would live
+    limiter = RateLimiter()
+
+    async def sync(api: AsyncXeroApi) -> int:
+        offset, rows = 0, 0
+        while True:
+            parser = JournalsParser(await api.get_journals(offset))
+            rows += len(parser.journal_lines)
+            if len(parser.journals) < PAGE_SIZE:
+                return rows
+            offset = max(row[0] for row in parser.journals)
+
+    async def sync_all(url: str) -> int:
+        async with AsyncXeroTokenSession('bench', 'bench', lambda: token) as ts:
+            apis = [AsyncXeroApi(ts, f'{TENANT_ID}-{n}', limiter, url) for n in range(options['tenants'])]
+            return sum(await asyncio.gather(*(sync(api) for api in apis)))
+    with StandInProcess(config) as server:
+        start = perf_counter()
+        rows = asyncio.run(sync_all(server.url))
+        elapsed = perf_counter() - start
+        stats = server.stats()
+    return {'rows': rows, 'seconds': elapsed, 'api_calls': stats['api_calls'],
+        'throttled': sum(stats['throttled'].values()), 'note': f'{options["tenants"]} tenants'}
+
+def _load(tmp: str, journals: int, lines: int):
+    '''A tenant DB in ``tmp`` holding the synthetic journals.'''
+    import sql
+    from xero.parser import JournalsParser
+    from sql.writer import write_rows_to_sql, transaction
+    sql.db_dir = tmp
+    os.makedirs(f'{tmp}/xero_tenants')
+    sql.xero_base(TENANT_ID)
+    for page in journal_pages(journals, lines, PAGE_SIZE):
+        parser = JournalsParser(page)
+        with sql.tenant_writer(TENANT_ID) as con, transaction(con):
+            write_rows_to_sql(con, parser.journals, 'Journals', parser.cols_journal)
+            write_rows_to_sql(con, parser.journal_lines, 'JournalLines', parser.cols_journal_line)
+
+def as_of(journals: int, lines: int, options: dict) -> dict:
+    '''Account balances at random dates from the balance index against summing the lines.'''
+    import random
+    from datetime import date, timedelta
+    import sql
+    from recon.balance_index import rebuild_balance_index, balance_at
+    from .synthetic import account, EPOCH_MS, DAY_MS
+    queries = options['queries']
+    with tempfile.TemporaryDirectory() as tmp:
+        _load(tmp, journals, lines)
+        start = perf_counter()
+        rebuild_balance_index(TENANT_ID)
+        build_seconds = perf_counter() - start
+        rnd = random.Random(0)
+        first = date(1970, 1, 1) + timedelta(milliseconds=EPOCH_MS)
+        days = journals // 50 + 1
+        asks = [(account(rnd.randint(1, 60))['AccountID'], first + timedelta(days=rnd.randrange(days)))
+            for _ in range(queries)]
+        with sql.tenant_reader(TENANT_ID) as con:
+            start = perf_counter()
+            indexed = [balance_at(con, account_id, at) for account_id, at in asks]
+            elapsed = perf_counter() - start
+            start = perf_counter()
+            naive = [con.execute(
+                "SELECT coalesce(sum(l.NetAmount), 0) FROM JournalLines l "
+                "JOIN Journals j ON j.JournalNumber = l.JournalNumber "
+                "WHERE l.AccountID = ? AND j.JournalDate < ?;",
+                (account_id, (at + timedelta(days=1)).isoformat()),
+            ).fetchone()[0] for account_id, at in asks]
+            naive_seconds = perf_counter() - start
+        sql.pool.close()
+    if any(abs(a - b) > 0.005 for a, b in zip(indexed, naive)):
+        raise RuntimeError('balance index disagrees with the summed lines')
+    return {'rows': queries, 'seconds': elapsed, 'build_seconds': build_seconds, 'naive_seconds': naive_seconds,
+        'note': f'index build {build_seconds:.2f}s, naive {naive_seconds / queries * 1000:.2f} ms/query, '
+            f'indexed {elapsed / queries * 1000:.3f} ms/query'}
+
+def search(journals: int, lines: int, options: dict) -> dict:
+    '''Free-text lookups through the search index against LIKE scans of the lines.'''
+    import random
+    import sql
+    from recon.search import rebuild_search_index, search_lines
+    queries = options['queries']
+    with tempfile.TemporaryDirectory() as tmp:
+        _load(tmp, journals, lines)
+        start = perf_counter()
+        rebuild_search_index(TENANT_ID)
+        build_seconds = perf_counter() - start
+        rnd = random.Random(0)
+        # distinctive fragments, as in a reference or invoice number: 'INV-<n>' and '... journal <n>'
+        asks = [str(rnd.randint(min(1000, journals), journals)) for _ in range(queries)]
+        start = perf_counter()
+        found = [{row['JournalLineID'] for row in search_lines(TENANT_ID, text, limit=100_000)} for text in asks]
+        elapsed = perf_counter() - start
+        with sql.tenant_reader(TENANT_ID) as con:
+            start = perf_counter()
+            naive = [{row[0] for row in con.execute(
+                "SELECT l.JournalLineID FROM JournalLines l JOIN Journals j ON j.JournalNumber = l.JournalNumber "
+                "WHERE l.Description LIKE ?1 OR j.Reference LIKE ?1;", (f'%{text}%',)
+            )} for text in asks]
+            naive_seconds = perf_counter() - start
+        sql.pool.close()
+    if found != naive:
+        raise RuntimeError('search index and LIKE found different lines')
+    return {'rows': queries, 'seconds': elapsed, 'build_seconds': build_seconds, 'naive_seconds': naive_seconds,
+        'note': f'index build {build_seconds:.2f}s, LIKE {naive_seconds / queries * 1000:.2f} ms/query, '
+            f'indexed {elapsed / queries * 1000:.3f} ms/query'}
+
+def match(journals: int, lines: int, options: dict) -> dict:
+    '''The offsetting-entry matcher over a clearing account with ``journals * lines``
+    open lines, from loading them to writing the mappings.'''
+    import sql
+    from xero.parser import JournalsParser
+    from sql.writer import write_rows_to_sql, transaction
+    from recon.matcher import match_account
+    from .synthetic import make_clearing_journals, CLEARING_ACCOUNT
+    account_id = CLEARING_ACCOUNT['AccountID']
+    with tempfile.TemporaryDirectory() as tmp:
+        sql.db_dir = tmp
+        os.makedirs(f'{tmp}/xero_tenants')
+        sql.xero_base(TENANT_ID)
+        clearing = make_clearing_journals(journals * lines)
+        for first in range(0, len(clearing), PAGE_SIZE):
+            parser = JournalsParser(clearing[first:first + PAGE_SIZE])
+            with sql.tenant_writer(TENANT_ID) as con, transaction(con):
+                write_rows_to_sql(con, parser.journals, 'Journals', parser.cols_journal)
+                write_rows_to_sql(con, parser.journal_lines, 'JournalLines', parser.cols_journal_line)
+        with sql.tenant_writer(TENANT_ID) as con, con:
+            con.execute("INSERT INTO recon_settings(AccountID, ReconType, JournalStart) VALUES (?, 'clearing', 0);",
+                (account_id,))
+        sql.create_recon_account(account_id, TENANT_ID)
+        start = perf_counter()
+        result = match_account(TENANT_ID, account_id, time_budget=options['time_budget'])
+        elapsed = perf_counter() - start
+        sql.pool.close()
+    seconds = result['Seconds']
+    return {'rows': result['OpenLines'], 'seconds': elapsed, 'matched': result['MatchedLines'],
+        'groups': result['Groups'], 'stage_seconds': seconds,
+        'note': f'{result["MatchedLines"] / max(result["OpenLines"], 1):.0%} matched; load {seconds["load"]:.2f}s, '
+            f'match {seconds["match"]:.2f}s, write {seconds["write"]:.2f}s'}
+
+def money(journals: int, lines: int, options: dict) -> dict:
+    '''Trial balances and a balance index build with amounts stored as floating point,
+    then again after migrating the tenant to integer amounts.'''
+    from datetime import date, timedelta
+    import sql
+    # connects on import, which migrate_tenant would otherwise time on its first claim
+    import utils.redis
+    from sql.money import migrate_tenant
+    from recon.trial_balance import compute_trial_balance
+    from recon.balance_index import rebuild_balance_index
+    from .synthetic import EPOCH_MS
+    first = date(1970, 1, 1) + timedelta(milliseconds=EPOCH_MS)
+    dates = [first + timedelta(days=(journals // 50 + 1) * (i + 1) // 10) for i in range(10)]
+
+    def timed() -> tuple[float, float, list]:
+        start = perf_counter()
+        with sql.tenant_reader(TENANT_ID) as con:
+            balances = [compute_trial_balance(con, at) for at in dates]
+        summed = perf_counter() - start
+        start = perf_counter()
+        rebuild_balance_index(TENANT_ID)
+        return summed, perf_counter() - start, balances
+    with tempfile.TemporaryDirectory() as tmp:
+        _load(tmp, journals, lines)
+        float_seconds, float_build, float_balances = timed()
+        start = perf_counter()
+        migrate_tenant(TENANT_ID)
+        migrate_seconds = perf_counter() - start
+        elapsed, build_seconds, balances = timed()
+        sql.pool.close()
+    drift = sum(a['Balance'] != b['Balance'] for x, y in zip(float_balances, balances) for a, b in zip(x, y))
+    return {'rows': journals * lines * len(dates), 'seconds': elapsed, 'float_seconds': float_seconds,
+        'migrate_seconds': migrate_seconds, 'drift': drift,
+        'note': f'float sums {float_seconds:.2f}s, integer {elapsed:.2f}s; index build {float_build:.2f}s -> '
+            f'{build_seconds:.2f}s; migration {migrate_seconds:.2f}s; {drift} balances differ'}
+
+def replay(journals: int, lines: int, options: dict) -> dict:
+    '''Re-parsing a tenant from its response archive, recorded by a sync from the
+    stand-in. The replayed tables, and a sync from the stand-in serving the archive,
+    must match what the recording sync stored.'''
+    import sql
+    import xero.cache
+    # connects on import, which replay would otherwise time on its first claim
+    import utils.redis
+    from xero.updater import JournalUpdater
+    from xero.archive import ResponseArchive, replay as replay_archive
+    xero.cache._shared = xero.cache.ResponseCache()
+    stored = "SELECT count(*), total(NetAmount), max(JournalNumber), group_concat(JournalLineID) FROM JournalLines;"
+
+    def sync(tmp: str, config: StandInConfig, archive=None) -> tuple:
+        sql.db_dir = tmp
+        os.makedirs(f'{tmp}/xero_tenants')
+        sql.xero_base(TENANT_ID)
+        with StandInProcess(config) as server:
+            result = JournalUpdater(TENANT_ID, bench_api(server.url, archive=archive)).full_update()
+            calls = server.stats()['api_calls']
+        if result['error']:
+            raise RuntimeError(result['description'])
+        with sql.tenant_reader(TENANT_ID) as con:
+            return con.execute(stored).fetchone(), calls
+    with tempfile.TemporaryDirectory() as tmp:
+        archive = ResponseArchive(f'{tmp}/archive')
+        recorded, _ = sync(f'{tmp}/recorded', StandInConfig(journals, lines), archive)
+        start = perf_counter()
+        written = replay_archive(TENANT_ID, archive, options['workers'])
+        elapsed = perf_counter() - start
+        with sql.tenant_reader(TENANT_ID) as con:
+            replayed = con.execute(stored).fetchone()
+        sql.pool.close()
+        served, calls = sync(f'{tmp}/served', StandInConfig(archive=archive.root))
+        sql.pool.close()
+        size = sum(entry['Bytes'] for entry in archive.entries(TENANT_ID))
+        on_disk = sum(os.path.getsize(os.path.join(root, name))
+            for root, _, names in os.walk(f'{tmp}/archive/objects') for name in names)
+    if replayed != recorded or served != recorded:
+        raise RuntimeError('replayed journals differ from the recorded sync')
+    return {'rows': written['JournalLines'], 'seconds': elapsed, 'api_calls': calls,
+        'stage_seconds': written['Seconds'],
+        'note': f'{options["workers"]} workers, journals {written["Seconds"]["journals"]:.2f}s, '
+            f'derived {written["Seconds"]["derived"]:.2f}s; archive {size / 2**20:.1f} MB raw, '
+            f'{on_disk / 2**20:.1f} MB compressed'}
+
+CASES = {
+    'parse': parse,
+    'write_df': write_df,
+    'write_rows': write_rows,
+    'full_update': full_update,
+    'aio': aio,
+    'as_of': as_of,
+    'search': search,
+    'match': match,
+    'money': money,
+    'replay': replay,
+}
+
+def run_case(name: str, lines: int, options: dict) -> dict:
+    journals = max(1, lines // options['lines_per_journal'])
+    result = CASES[name](journals, options['lines_per_journal'], options)
+    result['rows_per_second'] = result['rows'] / result['seconds'] if result['seconds'] else 0.0
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+def run(cases: list[str], sizes: list[int], options: dict) -> list[dict]:
+    results = []
+    print(f'{"case":<12} {"lines":>9} {"rows":>9} {"seconds":>9} {"rows/s":>11} {"peak MB":>8} {"calls":>7} {"429s":>5}')
+    for size in sizes:
+        for name in cases:
+            # a fresh process per case, so peak RSS is not inherited from earlier ones
+            with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as pool:
+                result = pool.submit(run_case, name, size, options).result()
+            result.update(case=name, lines=size)
+            results.append(result)
+            print(f'{name:<12} {size:>9} {result["rows"]:>9} {result["seconds"]:>9.2f} '
+                f'{result["rows_per_second"]:>11,.0f} {result["peak_rss_mb"]:>8.0f} '
+                f'{result.get("api_calls", "-"):>7} {result.get("throttled", "-"):>5} {result.get("note", "")}')
+    return results
+
+def compare(results: list[dict], baseline: list[dict], tolerance: float) -> list[str]:
+    '''Cases whose rows/s fell by more than ``tolerance`` against the baseline.'''
+    before = {(row['case'], row['lines']): row for row in baseline}
+    regressions = []
+    for row in results:
+        old = before.get((row['case'], row['lines']))
+        if old is None or not old['rows_per_second']:
+            continue
+        change = row['rows_per_second'] / old['rows_per_second'] - 1
+        if change < -tolerance:
+            regressions.append(f'{row["case"]} at {row["lines"]} lines: {old["rows_per_second"]:,.0f} -> '
+                f'{row["rows_per_second"]:,.0f} rows/s ({change:+.0%})')
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lines', type=int, nargs='+', default=list(SIZES), help='journal lines per tenant')
+    parser.add_argument('--cases', nargs='+', choices=list(CASES), default=list(CASES))
+    parser.add_argument('--lines-per-journal', type=int, default=LINES_PER_JOURNAL)
+    parser.add_argument('--queries', type=int, default=200, help='lookups in the as_of and search cases')
+    parser.add_argument('--tenants', type=int, default=4, help='tenants synced at once in the aio case')
+    parser.add_argument('--workers', type=int, default=1, help='replay parse processes (1 parses in process)')
+    parser.add_argument('--time-budget', type=float, default=10.0, help='matcher subset-search seconds')
+    parser.add_argument('--latency', type=float, default=0.0, help='stand-in seconds per request')
+    parser.add_argument('--concurrent', type=int, default=None, help='stand-in concurrent request limit')
+    parser.add_argument('--per-minute', type=int, default=None, help='stand-in requests per window')
+    parser.add_argument('--minute', type=float, default=60.0, help='stand-in rate-limit window in seconds')
+    parser.add_argument('--limiter', action='store_true', help='pace requests with a RateLimiter')
+    parser.add_argument('--stream', action='store_true', help='use XeroApi streaming mode')
+    parser.add_argument('--out', help='write results as JSON')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed fall in rows/s')
+    args = parser.parse_args()
+    options = {
+        'lines_per_journal': args.lines_per_journal,
+        'queries': args.queries,
+        'time_budget': args.time_budget,
+        'tenants': args.tenants,
+        'workers': args.workers,
+        'latency': args.latency,
+        'concurrent': args.concurrent,
+        'per_minute': args.per_minute,
+        'minute': args.minute,
+        'limiter': args.limiter,
+        'stream': args.stream,
+    }
+    results = run(args.cases, args.lines, options)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f'REGRESSION {line}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
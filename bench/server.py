@@ -0,0 +1,312 @@
+'''A local stand-in for the Xero endpoints the sync uses, serving a synthetic tenant.
+
+Journals, Accounts, Invoices and Organisation are served the way Xero pages and
+filters them (offset, page, If-Modified-Since), with a configurable latency per
+request and Xero's 429 behaviour for the concurrent and per-minute limits.
+
+    python -m bench.server [--port 8642] [--journals 25000] [--latency 0.05] [--per-minute 60]
+
+Given an archive (xero.archive) it serves a recorded tenant instead, each request
+answered with the body archived for it.
+
+    python -m bench.server --archive <archive_dir> --tenant <tenant_id>
+
+Point ``XeroApi(base_url=...)`` at it, e.g. with ``bench_api``.
+'''
+import argparse
+import json
+import math
+import os
+import multiprocessing
+from collections import Counter, deque
+from datetime import datetime, timezone
+from functools import lru_cache
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Lock
+from time import monotonic, sleep, time
+from urllib.parse import urlsplit, parse_qs, parse_qsl
+import requests
+from xero.parser import XERO_DATE
+from xero.archive import ResponseArchive, endpoint_path, cursor_key
+from .synthetic import EPOCH_MS, make_journals, make_accounts, make_invoices, make_organisation, make_tracking_categories
+
+PAGE_SIZE = 100
+TENANT_ID = 'bench-tenant'
+
+
+class StandInConfig():
+    def __init__(self, journals: int=2500, lines: int=4, invoices: int=1000, accounts: int=60, seed: int=0,
+        latency: float=0.0, concurrent: int|None=None, per_minute: int|None=None, minute: float=60.0,
+        archive: str|None=None, tenant_id: str=TENANT_ID):
+        '''``per_minute`` requests are allowed in any ``minute`` seconds; shorten ``minute``
+        to exercise the minute limit in a quick run. With ``archive``, the responses
+        archived there for ``tenant_id`` are served instead of synthetic ones.'''
+        self.journals = journals
+        self.lines = lines
+        self.invoices = invoices
+        self.accounts = accounts
+        self.seed = seed
+        self.latency = latency
+        self.concurrent = concurrent
+        self.per_minute = per_minute
+        self.minute = minute
+        self.archive = archive
+        self.tenant_id = tenant_id
+
+
+class StandIn(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, config: StandInConfig, host: str='127.0.0.1', port: int=0):
+        super().__init__((host, port), StandInHandler)
+        self.config = config
+        self.lock = Lock()
+        self.in_flight = 0
+        self.window: deque[float] = deque()
+        self.calls: Counter = Counter()
+        self.throttled: Counter = Counter()
+        self.journal_page = lru_cache(maxsize=256)(self._journal_page)
+        self.invoice_page = lru_cache(maxsize=256)(self._invoice_page)
+        self.archive = ResponseArchive(config.archive) if config.archive else None
+
+    def _journal_page(self, offset: int) -> bytes:
+        count = max(0, min(PAGE_SIZE, self.config.journals - offset))
+        journals = make_journals(count, self.config.lines, offset + 1, self.config.seed)
+        return json.dumps({'Journals': journals}).encode()
+
+    def _invoice_page(self, first: int) -> bytes:
+        count = max(0, min(PAGE_SIZE, self.config.invoices - first + 1))
+        return json.dumps({'Invoices': make_invoices(count, first, self.config.seed)}).encode()
+
+    def admit(self, endpoint: str) -> str|None:
+        '''Counts the call and returns the rate limit it broke, if any.'''
+        now = monotonic()
+        with self.lock:
+            self.calls[endpoint] += 1
+            if self.config.concurrent is not None and self.in_flight >= self.config.concurrent:
+                problem = 'concurrent'
+            elif self.config.per_minute is not None:
+                while self.window and now - self.window[0] >= self.config.minute:
+                    self.window.popleft()
+                problem = 'minute' if len(self.window) >= self.config.per_minute else None
+            else:
+                problem = None
+            if problem:
+                self.throttled[problem] += 1
+                return problem
+            self.in_flight += 1
+            self.window.append(now)
+        return None
+
+    def retry_after(self) -> int:
+        with self.lock:
+            if not self.window:
+                return 1
+            return max(1, math.ceil(self.config.minute - (monotonic() - self.window[0])))
+
+    def minute_remaining(self) -> int:
+        with self.lock:
+            if self.config.per_minute is None:
+                return 60
+            return max(0, self.config.per_minute - len(self.window))
+
+    def done(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'calls': dict(self.calls),
+                'api_calls': sum(self.calls.values()),
+                'throttled': dict(self.throttled),
+            }
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+            self.throttled.clear()
+            self.window.clear()
+
+
+def modified_since_ms(value: str|None) -> int|None:
+    if not value:
+        return None
+    dt = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc)
+    return int(dt.timestamp() * 1000)
+
+def ms(xero_date: str) -> int:
+    return int(XERO_DATE.match(xero_date).group(1)) # type: ignore
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    server: StandIn
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        return
+
+    def send_body(self, status: int, body: bytes, headers: dict|None=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, val in (headers or {}).items():
+            self.send_header(key, str(val))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, obj, status: int=200):
+        self.send_body(status, json.dumps(obj).encode())
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {key: vals[0] for key, vals in parse_qs(url.query).items()}
+        if url.path == '/_stats':
+            return self.send_json(self.server.stats())
+        if url.path == '/_reset':
+            self.server.reset()
+            return self.send_json({})
+        if url.path == '/connections':
+            return self.send_json([{'tenantId': self.server.config.tenant_id, 'tenantType': 'ORGANISATION'}])
+        if self.server.archive is not None:
+            route = self.archived
+        else:
+            route = {
+                '/api.xro/2.0/Journals': self.journals,
+                '/api.xro/2.0/Accounts': self.accounts,
+                '/api.xro/2.0/Invoices': self.invoices,
+                '/api.xro/2.0/Organisation': self.organisation,
+                '/api.xro/2.0/TrackingCategories': self.tracking_categories,
+            }.get(url.path)
+        if route is None:
+            return self.send_json({'Message': f'{url.path} is not served by the stand-in'}, 404)
+        if not self.headers.get('Authorization', '').startswith('Bearer '):
+            return self.send_json({'Title': 'Unauthorized', 'Status': 401}, 401)
+        problem = self.server.admit(url.path.rsplit('/', 1)[-1])
+        if problem:
+            headers = {'X-Rate-Limit-Problem': problem}
+            if problem == 'minute':
+                headers['Retry-After'] = self.server.retry_after()
+            return self.send_body(429, b'', headers)
+        try:
+            if self.server.config.latency:
+                sleep(self.server.config.latency)
+            body = route(query, modified_since_ms(self.headers.get('If-Modified-Since')))
+            self.send_body(200, body, {'X-MinLimit-Remaining': self.server.minute_remaining()})
+        finally:
+            self.server.done()
+
+    def archived(self, query: dict, modified_since: int|None) -> bytes:
+        url = urlsplit(self.path)
+        endpoint = endpoint_path(url.path)
+        params = parse_qsl(url.query)
+        body = self.server.archive.get(self.server.config.tenant_id, endpoint, # type: ignore
+            cursor_key(params, self.headers.get('If-Modified-Since')))
+        if body is None:
+            # paging past what was recorded, as past the last page
+            return json.dumps({endpoint.split('/')[0]: []}).encode()
+        return body
+
+    def journals(self, query: dict, modified_since: int|None) -> bytes:
+        return self.server.journal_page(max(0, int(query.get('offset', 0))))
+
+    def accounts(self, query: dict, modified_since: int|None) -> bytes:
+        accounts = make_accounts(self.server.config.accounts)
+        if modified_since is not None:
+            accounts = [acct for acct in accounts if ms(acct['UpdatedDateUTC']) > modified_since]
+        return json.dumps({'Accounts': accounts}).encode()
+
+    def invoices(self, query: dict, modified_since: int|None) -> bytes:
+        # invoice n was last updated n seconds after EPOCH_MS
+        first = 1
+        if modified_since is not None:
+            first = max(1, (modified_since - EPOCH_MS) // 1000 + 1)
+        page = int(query.get('page', 1))
+        return self.server.invoice_page(first + (page - 1) * PAGE_SIZE)
+
+    def organisation(self, query: dict, modified_since: int|None) -> bytes:
+        return json.dumps({'Organisations': [make_organisation(TENANT_ID)]}).encode()
+
+    def tracking_categories(self, query: dict, modified_since: int|None) -> bytes:
+        return json.dumps({'TrackingCategories': make_tracking_categories()}).encode()
+
+def serve(config: StandInConfig, host: str='127.0.0.1', port: int=0, ready=None):
+    server = StandIn(config, host, port)
+    if ready is not None:
+        ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+class StandInProcess():
+    '''Runs the stand-in in its own process, so serving it does not count against the
+    time and memory of what is being measured.
+
+        with StandInProcess(StandInConfig(journals=2500)) as server:
+            api = bench_api(server.url)'''
+
+    def __init__(self, config: StandInConfig, host: str='127.0.0.1', port: int=0):
+        self.config = config
+        self.host = host
+        self.port = port
+        self.process = None
+
+    def __enter__(self) -> 'StandInProcess':
+        ctx = multiprocessing.get_context('spawn')
+        ready = ctx.Queue()
+        self.process = ctx.Process(target=serve, args=(self.config, self.host, self.port, ready), daemon=True)
+        self.process.start()
+        self.port = ready.get(timeout=30)
+        return self
+
+    def __exit__(self, *exc):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.host}:{self.port}'
+
+    def stats(self) -> dict:
+        return requests.get(f'{self.url}/_stats').json()
+
+    def reset(self):
+        requests.get(f'{self.url}/_reset')
+
+
+def bench_api(url: str, tenant_id: str=TENANT_ID, limiter=None, stream: bool=False, archive=None, cache=None):
+    '''A XeroApi for the stand-in, with a token that never expires. Without a ``cache``
+    every read reaches the stand-in.'''
+    from xero.api import XeroApi, XeroTokenSession
+    # the stand-in is plain http on localhost
+    os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
+    token = {'access_token': 'bench', 'token_type': 'Bearer', 'expires_at': time() + 10 * 365 * 86400}
+    return XeroApi(XeroTokenSession('bench', 'bench', lambda: token), tenant_id, limiter, url, stream,
+        cache=cache, archive=archive)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8642)
+    parser.add_argument('--journals', type=int, default=25000)
+    parser.add_argument('--lines', type=int, default=4, help='lines per journal')
+    parser.add_argument('--invoices', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--concurrent', type=int, default=None)
+    parser.add_argument('--per-minute', type=int, default=None)
+    parser.add_argument('--minute', type=float, default=60.0, help='length of the per-minute window in seconds')
+    parser.add_argument('--archive', help='serve the responses archived in this directory')
+    parser.add_argument('--tenant', default=TENANT_ID, help='tenant whose archived responses are served')
+    args = parser.parse_args()
+    config = StandInConfig(args.journals, args.lines, args.invoices, latency=args.latency,
+        concurrent=args.concurrent, per_minute=args.per_minute, minute=args.minute, archive=args.archive,
+        tenant_id=args.tenant)
+    if args.archive:
+        print(f'serving {args.tenant} from {args.archive} on http://{args.host}:{args.port}')
+    else:
+        print(f'serving {args.journals} journals on http://{args.host}:{args.port}')
+    serve(config, args.host, args.port)
+
+if __name__ == '__main__':
+    main()
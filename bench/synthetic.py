@@ -0,0 +1,262 @@
+'''Synthetic Xero tenants for benchmarks. Everything is derived from a seed and the
+record number, so any page can be generated on its own and is the same every run.'''
+import random
+
+DAY_MS = 86400000
+EPOCH_MS = 1577836800000
+
+ACCOUNT_TYPES = (
+    ('BANK', 'ASSET'), ('CURRENT', 'ASSET'), ('FIXED', 'ASSET'), ('CURRLIAB', 'LIABILITY'),
+    ('EQUITY', 'EQUITY'), ('REVENUE', 'REVENUE'), ('DIRECTCOSTS', 'EXPENSE'), ('EXPENSE', 'EXPENSE'),
+)
+TAX_TYPES = (('NONE', 'No GST', 0.0), ('INPUT', 'GST on Expenses', 0.15), ('OUTPUT', 'GST on Income', 0.15))
+TRACKING = {
+    'Region': ('North', 'South', 'East', 'West'),
+    'Department': ('Sales', 'Operations', 'Administration'),
+}
+SOURCE_TYPES = ('ACCREC', 'ACCPAY', 'CASHREC', 'CASHPAID', 'MANJOURNAL', 'TRANSFER')
+
+def xero_date(ms: int) -> str:
+    return f'/Date({ms}+0000)/'
+
+def guid(kind: int, number: int, n: int=0) -> str:
+    return f'{number:08d}-{kind:04d}-{n:04d}-0000-000000000000'
+
+def tracking_id(category: str, option: str|None=None) -> str:
+    names = list(TRACKING)
+    if option is None:
+        return guid(9, names.index(category) + 1)
+    return guid(9, names.index(category) + 1, TRACKING[category].index(option) + 1)
+
+def account(n: int) -> dict:
+    account_type, account_class = ACCOUNT_TYPES[n % len(ACCOUNT_TYPES)]
+    return {
+        "AccountID": guid(2, n),
+        "Code": str(100 + n * 10),
+        "Name": f"{account_type.title()} account {n}",
+        "Type": account_type,
+        "Class": account_class,
+    }
+
+def make_tracking_categories() -> list[dict]:
+    '''The categories used by the synthetic journal lines, shaped like the Xero
+    TrackingCategories endpoint.'''
+    return [{
+        "TrackingCategoryID": tracking_id(category),
+        "Name": category,
+        "Status": "ACTIVE",
+        "Options": [{
+            "TrackingOptionID": tracking_id(category, option),
+            "Name": option,
+            "Status": "ACTIVE",
+        } for option in options],
+    } for category, options in TRACKING.items()]
+
+def make_accounts(count: int=60) -> list[dict]:
+    '''A chart of accounts shaped like the Xero Accounts endpoint.'''
+    accounts = []
+    for n in range(1, count + 1):
+        acct = account(n)
+        accounts.append({
+            **acct,
+            "BankAccountNumber": f"12-3456-{n:07d}-00" if acct["Type"] == 'BANK' else None,
+            "Status": "ACTIVE",
+            "Description": f"Synthetic account {n}",
+            "BankAccountType": "BANK" if acct["Type"] == 'BANK' else "",
+            "CurrencyCode": "NZD",
+            "TaxType": TAX_TYPES[n % len(TAX_TYPES)][0],
+            "EnablePaymentsToAccount": False,
+            "ShowInExpenseClaims": acct["Class"] == 'EXPENSE',
+            "ReportingCode": acct["Class"][:3],
+            "ReportingCodeName": acct["Class"].title(),
+            "HasAttachments": False,
+            "UpdatedDateUTC": xero_date(EPOCH_MS + n * 60000),
+            "AddToWatchlist": False,
+        })
+    return accounts
+
+def make_journal(number: int, lines: int=3, seed: int=0, accounts: int=60) -> dict:
+    '''Journal ``number`` with ``lines`` lines whose net amounts balance to zero, as Xero's
+    do. About half the lines carry tracking categories and a third carry tax.'''
+    rnd = random.Random(seed * 1000003 + number)
+    journal_lines = []
+    total = 0.0
+    for n in range(lines):
+        acct = account(rnd.randint(1, accounts))
+        if n < lines - 1:
+            gross = round(rnd.uniform(-5000, 5000), 2)
+            tax_type, tax_name, rate = TAX_TYPES[0] if rnd.random() < 0.67 else rnd.choice(TAX_TYPES[1:])
+        else:
+            gross = -round(total, 2)
+            tax_type, tax_name, rate = TAX_TYPES[0]
+        tax = round(gross * rate / (1 + rate), 2)
+        total += round(gross - tax, 2)
+        tracking = []
+        if rnd.random() < 0.5:
+            for category in rnd.sample(list(TRACKING), rnd.randint(1, len(TRACKING))):
+                option = rnd.choice(TRACKING[category])
+                tracking.append({
+                    "Name": category,
+                    "Option": option,
+                    "TrackingCategoryID": tracking_id(category),
+                    "TrackingOptionID": tracking_id(category, option),
+                })
+        journal_lines.append({
+            "JournalLineID": guid(1, number, n),
+            "AccountID": acct["AccountID"],
+            "AccountCode": acct["Code"],
+            "AccountType": acct["Type"],
+            "AccountName": acct["Name"],
+            "Description": f"Synthetic line {n} of journal {number}",
+            "NetAmount": round(gross - tax, 2),
+            "GrossAmount": gross,
+            "TaxAmount": tax,
+            "TaxType": tax_type,
+            "TaxName": tax_name,
+            "TrackingCategories": tracking,
+        })
+    return {
+        "JournalID": guid(0, number),
+        "JournalDate": xero_date(EPOCH_MS + number // 50 * DAY_MS),
+        "JournalNumber": number,
+        "CreatedDateUTC": xero_date(EPOCH_MS + number * 1000),
+        "Reference": f"INV-{number}" if rnd.random() < 0.8 else "",
+        "SourceID": guid(3, number),
+        "SourceType": rnd.choice(SOURCE_TYPES),
+        "JournalLines": journal_lines,
+    }
+
+def make_journals(count: int, lines: int=3, start: int=1, seed: int=0) -> list[dict]:
+    '''Journals shaped like the Xero Journals endpoint, numbered from ``start``.'''
+    return [make_journal(number, lines, seed) for number in range(start, start + count)]
+
+def journal_pages(count: int, lines: int=3, page_size: int=100, seed: int=0):
+    for start in range(1, count + 1, page_size):
+        yield make_journals(min(page_size, count - start + 1), lines, start, seed)
+
+CLEARING_ACCOUNT = {"AccountID": guid(2, 0), "Code": "800", "Name": "Clearing", "Type": "CURRLIAB"}
+
+def make_clearing_journals(count: int, seed: int=0, window: int=7) -> list[dict]:
+    '''Journals putting about ``count`` lines through CLEARING_ACCOUNT, most of which
+    offset each other as a matcher should find: pairs sharing a SourceID, pairs sharing a
+    Reference, equal and opposite amounts within ``window`` days, and one amount split
+    over two to four lines. About a tenth are left unmatched.'''
+    rnd = random.Random(seed)
+    entries: list[tuple[int, float, str, str]] = []
+    n = 0
+    while len(entries) < count:
+        n += 1
+        day = len(entries) // 40
+        amount = round(rnd.uniform(10, 10000), 2)
+        kind = rnd.random()
+        if kind < 0.3:
+            source = guid(7, n)
+            entries += [(day, amount, source, ''), (day + rnd.randint(0, 30), -amount, source, '')]
+        elif kind < 0.5:
+            ref = f'CLR-{n}'
+            entries += [(day, amount, guid(7, n, 1), ref), (day + rnd.randint(0, 30), -amount, guid(7, n, 2), ref)]
+        elif kind < 0.8:
+            entries += [(day, amount, guid(7, n, 1), ''), (day + rnd.randint(0, window), -amount, guid(7, n, 2), '')]
+        elif kind < 0.9:
+            parts = rnd.randint(2, 4)
+            cents = sorted(rnd.sample(range(1, int(amount * 100)), parts - 1))
+            splits = [(b - a) / 100 for a, b in zip([0] + cents, cents + [int(round(amount * 100))])]
+            entries.append((day, -amount, guid(7, n), ''))
+            entries += [(day + rnd.randint(0, window), split, guid(7, n, m + 1), '') for m, split in enumerate(splits)]
+        else:
+            entries.append((day, amount, guid(7, n), ''))
+    journals = []
+    for number, (day, amount, source, ref) in enumerate(entries, 1):
+        other = account(rnd.randint(1, 60))
+        journals.append({
+            "JournalID": guid(0, number),
+            "JournalDate": xero_date(EPOCH_MS + day * DAY_MS),
+            "JournalNumber": number,
+            "CreatedDateUTC": xero_date(EPOCH_MS + number * 1000),
+            "Reference": ref,
+            "SourceID": source,
+            "SourceType": "MANJOURNAL",
+            "JournalLines": [
+                {"JournalLineID": guid(1, number, 0), "AccountID": CLEARING_ACCOUNT["AccountID"],
+                    "AccountCode": CLEARING_ACCOUNT["Code"], "AccountType": CLEARING_ACCOUNT["Type"],
+                    "AccountName": CLEARING_ACCOUNT["Name"], "Description": f"Clearing {number}",
+                    "NetAmount": amount, "GrossAmount": amount, "TaxAmount": 0.0, "TaxType": "NONE",
+                    "TaxName": "No GST", "TrackingCategories": []},
+                {"JournalLineID": guid(1, number, 1), "AccountID": other["AccountID"], "AccountCode": other["Code"],
+                    "AccountType": other["Type"], "AccountName": other["Name"], "Description": f"Clearing {number}",
+                    "NetAmount": -amount, "GrossAmount": -amount, "TaxAmount": 0.0, "TaxType": "NONE",
+                    "TaxName": "No GST", "TrackingCategories": []},
+            ],
+        })
+    return journals
+
+def make_invoice(number: int, lines: int=2, seed: int=0) -> dict:
+    rnd = random.Random(seed * 1000003 + number + (1 << 40))
+    line_items = []
+    for n in range(lines):
+        quantity = rnd.randint(1, 10)
+        unit = round(rnd.uniform(5, 500), 2)
+        line_items.append({
+            "LineItemID": guid(4, number, n),
+            "Description": f"Synthetic item {n}",
+            "Quantity": quantity,
+            "UnitAmount": unit,
+            "AccountCode": account(rnd.randint(1, 60))["Code"],
+            "TaxType": "OUTPUT",
+            "LineAmount": round(quantity * unit, 2),
+        })
+    subtotal = round(sum(item["LineAmount"] for item in line_items), 2)
+    tax = round(subtotal * 0.15, 2)
+    paid = rnd.choice((0.0, round(subtotal + tax, 2)))
+    return {
+        "InvoiceID": guid(5, number),
+        "InvoiceNumber": f"INV-{number:06d}",
+        "Type": rnd.choice(("ACCREC", "ACCPAY")),
+        "Contact": {"ContactID": guid(6, rnd.randint(1, 500)), "Name": "Synthetic contact"},
+        "Date": xero_date(EPOCH_MS + number // 20 * DAY_MS),
+        "DueDate": xero_date(EPOCH_MS + (number // 20 + 30) * DAY_MS),
+        "Status": "PAID" if paid else "AUTHORISED",
+        "LineAmountTypes": "Exclusive",
+        "SubTotal": subtotal,
+        "TotalTax": tax,
+        "Total": round(subtotal + tax, 2),
+        "AmountDue": round(subtotal + tax - paid, 2),
+        "AmountPaid": paid,
+        "AmountCredited": 0.0,
+        "CurrencyCode": "NZD",
+        "CurrencyRate": 1.0,
+        "Reference": f"PO-{number}",
+        "HasAttachments": False,
+        "UpdatedDateUTC": xero_date(EPOCH_MS + number * 1000),
+        "LineItems": line_items,
+    }
+
+def make_invoices(count: int, start: int=1, seed: int=0) -> list[dict]:
+    return [make_invoice(number, seed=seed) for number in range(start, start + count)]
+
+def make_organisation(tenant_id: str) -> dict:
+    return {
+        "OrganisationID": tenant_id,
+        "Name": f"Synthetic {tenant_id}",
+        "LegalName": f"Synthetic {tenant_id} Limited",
+        "PaysTax": True,
+        "Version": "NZ",
+        "OrganisationType": "COMPANY",
+        "BaseCurrency": "NZD",
+        "CountryCode": "NZ",
+        "IsDemoCompany": False,
+        "OrganisationStatus": "ACTIVE",
+        "FinancialYearEndDay": 31,
+        "FinancialYearEndMonth": 3,
+        "SalesTaxBasis": "INVOICE",
+        "SalesTaxPeriod": "TWOMONTHS",
+        "DefaultSalesTax": "Tax Exclusive",
+        "DefaultPurchasesTax": "Tax Exclusive",
+        "PeriodLockDate": xero_date(EPOCH_MS),
+        "CreatedDateUTC": xero_date(EPOCH_MS),
+        "OrganisationEntityType": "COMPANY",
+        "Timezone": "NEWZEALANDSTANDARDTIME",
+        "ShortCode": "!synth",
+        "Edition": "BUSINESS",
+        "Class": "PREMIUM",
+    }
@@ -0,0 +1,172 @@
+'''Per-account running balances by journal date, for balance-as-of questions that would
+otherwise sum every journal line of the tenant.
+
+``balance_index`` holds one row per account and day with that day's net movement and
+the account's balance at the end of it. Its primary key is (AccountID, JournalDate), so
+the balance at any date is one B-tree seek to the last row on or before it. The index
+covers journals up to the 'BalanceIndex' checkpoint and is topped up after each sync.
+
+    python -m recon.balance_index <tenant_id> rebuild
+    python -m recon.balance_index <tenant_id> <account_id> <YYYY-MM-DD> [<YYYY-MM-DD>]
+'''
+import json
+import sys
+from bisect import bisect_right
+from datetime import date, datetime, timezone
+from sqlite3 import Connection
+from sql import tenant_reader, tenant_writer, create_balance_index, create_sync_checkpoints
+from sql.money import money_scale, units_sql
+from .trial_balance import as_date
+
+CHECKPOINT = 'BalanceIndex'
+# JournalDate is stored as str(datetime); the index keys rows by its date part
+_DAY = 'substr(j.JournalDate, 1, 10)'
+
+def _watermark(con: Connection) -> int:
+    first = con.execute("SELECT Cursor FROM sync_checkpoints WHERE Entity = ?;", (CHECKPOINT,)).fetchone()
+    return first[0] if first else 0
+
+def _set_watermark(con: Connection, cursor: int):
+    con.execute(
+        "INSERT INTO sync_checkpoints(Entity, Cursor, UpdatedUTC) VALUES (?, ?, ?) "
+        "ON CONFLICT(Entity) DO UPDATE SET Cursor = excluded.Cursor, UpdatedUTC = excluded.UpdatedUTC;",
+        (CHECKPOINT, cursor, str(datetime.now(timezone.utc))),
+    )
+
+def build(con: Connection) -> int:
+    '''Recomputes the whole index with one windowed pass. Run inside ``with con``.
+    Returns the number of index rows.'''
+    top = con.execute("SELECT coalesce(max(JournalNumber), 0) FROM Journals;").fetchone()[0]
+    scale = money_scale(con)
+    running = "sum(Net) OVER (PARTITION BY AccountID ORDER BY Day)"
+    con.execute("DELETE FROM balance_index;")
+    con.execute(
+        "INSERT INTO balance_index(AccountID, JournalDate, Net, Balance) "
+        f"SELECT AccountID, Day, Net, {units_sql(running, scale)} FROM ("
+        f"SELECT l.AccountID, {_DAY} AS Day, {units_sql('sum(l.NetAmount)', scale)} AS Net "
+        "FROM JournalLines l JOIN Journals j ON j.JournalNumber = l.JournalNumber "
+        "WHERE l.JournalNumber <= ? GROUP BY 1, 2);",
+        (top,),
+    )
+    _set_watermark(con, top)
+    return con.execute("SELECT count(*) FROM balance_index;").fetchone()[0]
+
+def apply_new_journals(con: Connection) -> int:
+    '''Adds the journals above the checkpoint to the index. Journals are appended in
+    number order but may be dated in the past, so each day's movement is also added to
+    the account's later balances. Run inside ``with con``. Returns the number of
+    (account, day) movements applied, or of index rows when it was built afresh.'''
+    last = _watermark(con)
+    top = con.execute("SELECT coalesce(max(JournalNumber), 0) FROM Journals;").fetchone()[0]
+    if last == 0 or top < last:
+        # never built, or the journals were reloaded from scratch
+        return build(con)
+    if top == last:
+        return 0
+    scale = money_scale(con)
+    moves = con.execute(
+        f"SELECT l.AccountID, {_DAY}, sum(l.NetAmount) "
+        "FROM JournalLines l JOIN Journals j ON j.JournalNumber = l.JournalNumber "
+        "WHERE l.JournalNumber > ? AND l.JournalNumber <= ? GROUP BY 1, 2 ORDER BY 1, 2;",
+        (last, top),
+    ).fetchall()
+    for account_id, day, amount in moves:
+        con.execute(
+            "INSERT INTO balance_index(AccountID, JournalDate, Net, Balance) "
+            "SELECT ?, ?, 0, coalesce((SELECT Balance FROM balance_index WHERE AccountID = ? AND JournalDate < ? "
+            "ORDER BY JournalDate DESC LIMIT 1), 0) ON CONFLICT DO NOTHING;",
+            (account_id, day, account_id, day),
+        )
+        con.execute(
+            f"UPDATE balance_index SET Net = {units_sql('Net + ?1', scale)} WHERE AccountID = ?2 AND JournalDate = ?3;",
+            (amount, account_id, day),
+        )
+        con.execute(
+            f"UPDATE balance_index SET Balance = {units_sql('Balance + ?1', scale)} "
+            "WHERE AccountID = ?2 AND JournalDate >= ?3;",
+            (amount, account_id, day),
+        )
+    _set_watermark(con, top)
+    return len(moves)
+
+def update_balance_index(tenant_id: str) -> int:
+    '''Brings the index up to the newest stored journal.'''
+    create_sync_checkpoints(tenant_id)
+    create_balance_index(tenant_id)
+    with tenant_writer(tenant_id) as con, con:
+        return apply_new_journals(con)
+
+def rebuild_balance_index(tenant_id: str) -> int:
+    create_sync_checkpoints(tenant_id)
+    create_balance_index(tenant_id)
+    with tenant_writer(tenant_id) as con, con:
+        return build(con)
+
+def balance_at(con: Connection, account_id: str, at: date) -> float:
+    '''The account's balance at the end of ``at``.'''
+    first = con.execute(
+        "SELECT Balance FROM balance_index WHERE AccountID = ? AND JournalDate <= ? "
+        "ORDER BY JournalDate DESC LIMIT 1;",
+        (account_id, at.isoformat()),
+    ).fetchone()
+    return first[0] / money_scale(con) if first else 0.0
+
+def balance_as_of(tenant_id: str, account_id: str, at: date|str) -> dict:
+    at = as_date(at)
+    with tenant_reader(tenant_id) as con:
+        balance = balance_at(con, account_id, at)
+        last = _watermark(con)
+    return {'AccountID': account_id, 'Date': at.isoformat(), 'LastJournalNumber': last, 'Balance': round(balance, 2)}
+
+def balance_between(tenant_id: str, account_id: str, start: date|str, end: date|str) -> dict:
+    '''Opening balance before ``start``, closing balance at the end of ``end`` and the
+    movement between them.'''
+    start, end = as_date(start), as_date(end)
+    with tenant_reader(tenant_id) as con:
+        first = con.execute(
+            "SELECT Balance FROM balance_index WHERE AccountID = ? AND JournalDate < ? "
+            "ORDER BY JournalDate DESC LIMIT 1;",
+            (account_id, start.isoformat()),
+        ).fetchone()
+        opening = first[0] / money_scale(con) if first else 0.0
+        closing = balance_at(con, account_id, end)
+        last = _watermark(con)
+    return {
+        'AccountID': account_id,
+        'Start': start.isoformat(),
+        'End': end.isoformat(),
+        'LastJournalNumber': last,
+        'Opening': round(opening, 2),
+        'Closing': round(closing, 2),
+        'Movement': round(closing - opening, 2),
+    }
+
+def balances_as_of(tenant_id: str, account_id: str, dates: list[date|str]) -> dict[str, float]:
+    '''Balances at many dates, from one read of the account's index rows and a binary
+    search per date.'''
+    with tenant_reader(tenant_id) as con:
+        scale = money_scale(con)
+        rows = con.execute(
+            "SELECT JournalDate, Balance FROM balance_index WHERE AccountID = ? ORDER BY JournalDate;", (account_id,)
+        ).fetchall()
+    days = [row[0] for row in rows]
+    out = {}
+    for at in dates:
+        at = as_date(at).isoformat()
+        i = bisect_right(days, at)
+        out[at] = round(rows[i - 1][1] / scale, 2) if i else 0.0
+    return out
+
+def main(tenant_id: str, *args: str):
+    if args == ('rebuild',):
+        print(f'{rebuild_balance_index(tenant_id)} index rows')
+    elif len(args) == 2:
+        print(json.dumps(balance_as_of(tenant_id, *args), indent=2))
+    elif len(args) == 3:
+        print(json.dumps(balance_between(tenant_id, *args), indent=2))
+    else:
+        print(__doc__, file=sys.stderr)
+        sys.exit(2)
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
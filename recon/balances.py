@@ -0,0 +1,127 @@
+from sql import tenant_reader, tenant_writer, create_recon_balances
+from sql.money import money_scale
+from sqlite3 import Connection
+
+UNMAPPED = ''
+
+def recon_table(account_id: str) -> str:
+    return f'"recon-{account_id}"'
+
+def _add(con: Connection, account_id: str, mapping: str, amount, lines: int):
+    con.execute(
+        "INSERT INTO recon_balances(AccountID, Mapping, Amount, Lines) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(AccountID, Mapping) DO UPDATE SET Amount = Amount + excluded.Amount, "
+        "Lines = Lines + excluded.Lines;",
+        (account_id, mapping, amount, lines),
+    )
+
+def apply_new_lines(con: Connection, account_id: str) -> int:
+    '''Adds the account's lines above recon_settings.LastJournalNumber to the running totals
+    and advances the watermark to the newest stored journal. Run inside ``with con`` so
+    both commit together. Returns the number of lines added.'''
+    settings = con.execute(
+        "SELECT LastJournalNumber, JournalStart FROM recon_settings WHERE AccountID = ?;",
+        (account_id,),
+    ).fetchone()
+    if settings is None:
+        raise KeyError(f'{account_id} is not a reconciled account')
+    last, start = settings[0] or 0, settings[1] or 0
+    watermark = con.execute("SELECT max(JournalNumber) FROM Journals;").fetchone()[0] or 0
+    if watermark <= last:
+        return 0
+    rows = con.execute(
+        f"SELECT coalesce(r.Mapping, ?), sum(l.NetAmount), count(*) FROM JournalLines l "
+        f"LEFT JOIN {recon_table(account_id)} r ON r.JournalLineID = l.JournalLineID "
+        "WHERE l.JournalNumber > ? AND l.JournalNumber <= ? AND l.JournalNumber >= ? AND l.AccountID = ? "
+        "GROUP BY 1;",
+        (UNMAPPED, last, watermark, start, account_id),
+    ).fetchall()
+    for mapping, amount, lines in rows:
+        _add(con, account_id, mapping, amount, lines)
+    con.execute(
+        "UPDATE recon_settings SET LastJournalNumber = ? WHERE AccountID = ?;",
+        (watermark, account_id),
+    )
+    return sum(row[2] for row in rows)
+
+def update_balances(tenant_id: str, account_id: str|None=None) -> dict[str, int]:
+    '''Brings the running totals of one reconciled account, or all of them, up to date.'''
+    create_recon_balances(tenant_id)
+    added = {}
+    with tenant_writer(tenant_id) as con, con:
+        if account_id is None:
+            accounts = [row[0] for row in con.execute("SELECT AccountID FROM recon_settings;")]
+        else:
+            accounts = [account_id]
+        for account in accounts:
+            added[account] = apply_new_lines(con, account)
+    return added
+
+def rebuild_balances(tenant_id: str, account_id: str) -> int:
+    create_recon_balances(tenant_id)
+    with tenant_writer(tenant_id) as con, con:
+        con.execute("DELETE FROM recon_balances WHERE AccountID = ?;", (account_id,))
+        con.execute("UPDATE recon_settings SET LastJournalNumber = NULL WHERE AccountID = ?;", (account_id,))
+        return apply_new_lines(con, account_id)
+
+def set_mappings(con: Connection, account_id: str, mappings: dict[str, str|None]):
+    '''Maps journal lines (JournalLineID -> Mapping, None to unmap) in the account's recon
+    table, moving the amounts of lines already counted between the running totals.
+    Run inside ``with con``.'''
+    if not mappings:
+        return
+    table = recon_table(account_id)
+    last, start = con.execute(
+        "SELECT coalesce(LastJournalNumber, 0), coalesce(JournalStart, 0) FROM recon_settings WHERE AccountID = ?;",
+        (account_id,),
+    ).fetchone()
+    con.execute("CREATE TEMP TABLE IF NOT EXISTS recon_remap(JournalLineID text primary key, Mapping text);")
+    con.execute("DELETE FROM temp.recon_remap;")
+    con.executemany("INSERT OR REPLACE INTO temp.recon_remap VALUES (?, ?);", mappings.items())
+    # CROSS JOIN keeps the remapped lines as the outer loop, each one a seek on the JournalLineID index
+    moves = con.execute(
+        f"SELECT coalesce(r.Mapping, ?), coalesce(m.Mapping, ?), sum(l.NetAmount), count(*) "
+        f"FROM temp.recon_remap m CROSS JOIN JournalLines l ON l.JournalLineID = m.JournalLineID "
+        f"LEFT JOIN {table} r ON r.JournalLineID = m.JournalLineID "
+        "WHERE l.AccountID = ? AND l.JournalNumber <= ? AND l.JournalNumber >= ? GROUP BY 1, 2;",
+        (UNMAPPED, UNMAPPED, account_id, last, start),
+    ).fetchall()
+    for old, new, amount, lines in moves:
+        if old != new:
+            _add(con, account_id, old, -amount, -lines)
+            _add(con, account_id, new, amount, lines)
+    con.execute(
+        f"DELETE FROM {table} WHERE JournalLineID IN "
+        "(SELECT JournalLineID FROM temp.recon_remap WHERE Mapping IS NULL);"
+    )
+    con.execute(
+        f"INSERT INTO {table}(JournalNumber, JournalLineID, Mapping) "
+        "SELECT l.JournalNumber, m.JournalLineID, m.Mapping FROM temp.recon_remap m "
+        "CROSS JOIN JournalLines l ON l.JournalLineID = m.JournalLineID "
+        "WHERE m.Mapping IS NOT NULL AND l.AccountID = ? "
+        "ON CONFLICT(JournalLineID) DO UPDATE SET Mapping = excluded.Mapping;",
+        (account_id,),
+    )
+    con.execute("DELETE FROM temp.recon_remap;")
+
+def get_balances(tenant_id: str, account_id: str) -> dict:
+    '''Opening balance plus the stored per-mapping totals; unmapped lines are under UNMAPPED.'''
+    with tenant_reader(tenant_id) as con:
+        scale = money_scale(con)
+        opening = con.execute(
+            "SELECT OpeningBalance, LastJournalNumber FROM recon_settings WHERE AccountID = ?;", (account_id,)
+        ).fetchone()
+        if opening is None:
+            raise KeyError(f'{account_id} is not a reconciled account')
+        mappings = {
+            mapping: amount for mapping, amount, lines in con.execute(
+                "SELECT Mapping, Amount, Lines FROM recon_balances WHERE AccountID = ?;", (account_id,)
+            ) if lines
+        }
+    # totals are summed in stored units and converted once
+    return {
+        'OpeningBalance': (opening[0] or 0) / scale,
+        'LastJournalNumber': opening[1],
+        'Mappings': {mapping: amount / scale for mapping, amount in mappings.items()},
+        'Balance': ((opening[0] or 0) + sum(mappings.values())) / scale,
+    }
@@ -0,0 +1,251 @@
+'''Finds groups of lines in a reconciled account that offset each other and maps each
+group to its own Mapping, so the account's unmapped balance is what is left unexplained.
+
+The account's unmapped lines are loaded once into arrays (amounts as integer cents) and
+matched in stages, each working only on what the previous ones left:
+
+  source     lines of one SourceID that net to zero
+  reference  lines with one journal Reference that net to zero
+  pair       an amount and its negative, dated within ``window`` days
+  subset     one line against up to ``max_group`` opposite lines within the window
+             that sum to it; groups of three or more are searched among its
+             ``max_candidates`` nearest by date
+
+Mappings are named 'auto:<stage>:<first JournalLineID>' so they can be told apart from
+staff mappings and cleared with ``clear_matches``.
+
+    python -m recon.matcher <tenant_id> <account_id> [--dry-run] [--clear]
+'''
+import json
+import sys
+from itertools import combinations
+from time import monotonic, perf_counter
+import numpy as np
+import pandas as pd
+from sql import tenant_reader, tenant_writer
+from sql.money import money_scale
+from .balances import recon_table, set_mappings
+
+PREFIX = 'auto'
+WINDOW_DAYS = 7
+MAX_GROUP = 4
+MAX_CANDIDATES = 24
+TIME_BUDGET = 10.0
+
+
+class OpenLines():
+    '''An account's unmapped lines as parallel arrays.'''
+
+    def __init__(self, rows: list[tuple], scale: int=1):
+        '''``scale`` is the stored units per dollar of the amounts in ``rows``.'''
+        cols = list(zip(*rows)) if rows else [()] * 6
+        self.journal_numbers = np.array(cols[0], dtype=np.int64)
+        self.line_ids = np.array(cols[1], dtype=object)
+        if scale == 1:
+            self.cents = np.rint(np.array(cols[2], dtype=np.float64) * 100).astype(np.int64)
+        else:
+            # integer units, rounded half up to whole cents
+            self.cents = (np.array(cols[2], dtype=np.int64) + scale // 200) // (scale // 100)
+        self.days = np.array(cols[3], dtype='datetime64[D]').astype(np.int64)
+        self.source_ids = np.array(cols[4], dtype=object)
+        self.references = np.array(cols[5], dtype=object)
+
+    def __len__(self) -> int:
+        return len(self.line_ids)
+
+    @classmethod
+    def load(cls, tenant_id: str, account_id: str) -> 'OpenLines':
+        with tenant_reader(tenant_id) as con:
+            settings = con.execute(
+                "SELECT coalesce(JournalStart, 0) FROM recon_settings WHERE AccountID = ?;", (account_id,)
+            ).fetchone()
+            if settings is None:
+                raise KeyError(f'{account_id} is not a reconciled account')
+            rows = con.execute(
+                "SELECT l.JournalNumber, l.JournalLineID, coalesce(l.NetAmount, 0), substr(j.JournalDate, 1, 10), "
+                "j.SourceID, j.Reference FROM JournalLines l JOIN Journals j ON j.JournalNumber = l.JournalNumber "
+                f"LEFT JOIN {recon_table(account_id)} r ON r.JournalLineID = l.JournalLineID "
+                "WHERE l.AccountID = ? AND l.JournalNumber >= ? AND r.Mapping IS NULL;",
+                (account_id, settings[0]),
+            ).fetchall()
+            scale = money_scale(con)
+        return cls(rows, scale)
+
+
+def zero_sum_groups(keys: np.ndarray, cents: np.ndarray, free: np.ndarray) -> list[np.ndarray]:
+    '''Free lines sharing a key whose amounts net to zero, grouped by hashing the keys.'''
+    idx = np.flatnonzero(free & pd.notna(keys) & (keys != ''))
+    if not len(idx):
+        return []
+    _, inverse = np.unique(keys[idx].astype(str), return_inverse=True)
+    sums = np.bincount(inverse, weights=cents[idx])
+    counts = np.bincount(inverse)
+    keep = ((sums == 0) & (counts >= 2))[inverse]
+    idx, inverse = idx[keep], inverse[keep]
+    order = np.argsort(inverse, kind='stable')
+    idx, inverse = idx[order], inverse[order]
+    return np.split(idx, np.flatnonzero(np.diff(inverse)) + 1) if len(idx) else []
+
+def opposite_pairs(cents: np.ndarray, days: np.ndarray, free: np.ndarray, window: int) -> np.ndarray:
+    '''(i, j) pairs of free lines with equal and opposite amounts dated within ``window``
+    days. Within an amount the n-th earliest debit is paired with the n-th earliest credit.'''
+    idx = np.flatnonzero(free & (cents != 0))
+    df = pd.DataFrame({'i': idx, 'amount': np.abs(cents[idx]), 'credit': cents[idx] < 0, 'day': days[idx]})
+    df = df.sort_values(['amount', 'credit', 'day'], kind='stable')
+    df['rank'] = df.groupby(['amount', 'credit']).cumcount()
+    pairs = df[~df['credit']].merge(df[df['credit']], on=['amount', 'rank'], suffixes=('', '_credit'))
+    pairs = pairs[np.abs(pairs['day'] - pairs['day_credit']) <= window]
+    return pairs[['i', 'i_credit']].to_numpy()
+
+def _pair_sums(values: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''Every pair (a < b) of ``values`` as sorted sums with their positions.'''
+    a, b = np.triu_indices(len(values), 1)
+    sums = values[a] + values[b]
+    order = np.argsort(sums, kind='stable')
+    return sums[order], a[order], b[order]
+
+def find_subset(values: np.ndarray, target: int, max_size: int, limit: int) -> np.ndarray|None:
+    '''Positions of at most ``max_size`` values summing to ``target``, fewest first. Single
+    values and pairs are looked for among all ``values``; larger groups only among the
+    first ``limit``.'''
+    hit = np.flatnonzero(values == target)
+    if len(hit):
+        return hit[:1]
+    if max_size >= 2 and len(values) >= 2:
+        n = len(values)
+        order = np.argsort(values, kind='stable')
+        ranked = values[order]
+        j = np.searchsorted(ranked, target - ranked)
+        # a value cannot pair with itself, only with an equal one at the next position
+        j = np.where(j == np.arange(n), j + 1, j)
+        ok = (j < n) & (ranked[np.minimum(j, n - 1)] == target - ranked)
+        if ok.any():
+            i = np.argmax(ok)
+            return order[[i, j[i]]]
+    values = values[:limit]
+    n = len(values)
+    if max_size < 3 or n < 3:
+        return None
+    sums, a, b = _pair_sums(values)
+    # three: one value and a pair of others
+    lo = np.searchsorted(sums, target - values, 'left')
+    hi = np.searchsorted(sums, target - values, 'right')
+    for i in np.flatnonzero(hi > lo):
+        for p in range(lo[i], hi[i]):
+            if i != a[p] and i != b[p]:
+                return np.array([i, a[p], b[p]])
+    if max_size < 4 or n < 4:
+        return None
+    # four: two disjoint pairs
+    lo = np.searchsorted(sums, target - sums, 'left')
+    hi = np.searchsorted(sums, target - sums, 'right')
+    for p in np.flatnonzero(hi > lo):
+        for q in range(lo[p], hi[p]):
+            if len({a[p], b[p], a[q], b[q]}) == 4:
+                return np.array([a[p], b[p], a[q], b[q]])
+    for size in range(5, min(max_size, n) + 1):
+        for combo in combinations(range(n), size):
+            if values[list(combo)].sum() == target:
+                return np.array(combo)
+    return None
+
+def subset_groups(cents: np.ndarray, days: np.ndarray, free: np.ndarray, window: int, max_group: int,
+    max_candidates: int, deadline: float) -> list[np.ndarray]:
+    '''One free line with the opposite free lines that sum to it, largest amounts first.
+    Candidates are ordered nearest date first. Stops at ``deadline`` (a ``monotonic``
+    time), leaving the rest unmatched.'''
+    rest = np.flatnonzero(free & (cents != 0))
+    rest = rest[np.argsort(days[rest], kind='stable')]
+    rest_days = days[rest]
+    used = ~free
+    groups = []
+    for target in rest[np.argsort(-np.abs(cents[rest]), kind='stable')]:
+        if used[target]:
+            continue
+        if monotonic() > deadline:
+            break
+        lo = np.searchsorted(rest_days, days[target] - window, 'left')
+        hi = np.searchsorted(rest_days, days[target] + window, 'right')
+        candidates = rest[lo:hi]
+        amounts = cents[candidates]
+        candidates = candidates[~used[candidates] & (np.sign(amounts) == -np.sign(cents[target]))
+            & (np.abs(amounts) <= abs(cents[target]))]
+        if not len(candidates):
+            continue
+        candidates = candidates[np.argsort(np.abs(days[candidates] - days[target]), kind='stable')]
+        found = find_subset(cents[candidates], -cents[target], max_group, max_candidates)
+        if found is None:
+            continue
+        members = np.append(target, candidates[found])
+        used[members] = True
+        groups.append(members)
+    return groups
+
+def match_lines(lines: OpenLines, window: int=WINDOW_DAYS, max_group: int=MAX_GROUP,
+    max_candidates: int=MAX_CANDIDATES, time_budget: float=TIME_BUDGET) -> dict[str, list[np.ndarray]]:
+    '''Offsetting groups per stage, as arrays of positions in ``lines``.'''
+    deadline = monotonic() + time_budget
+    free = np.ones(len(lines), dtype=bool)
+    found: dict[str, list[np.ndarray]] = {}
+    for stage, keys in (('source', lines.source_ids), ('reference', lines.references)):
+        found[stage] = zero_sum_groups(keys, lines.cents, free)
+        for group in found[stage]:
+            free[group] = False
+    pairs = opposite_pairs(lines.cents, lines.days, free, window)
+    found['pair'] = list(pairs)
+    free[pairs.ravel()] = False
+    found['subset'] = subset_groups(lines.cents, lines.days, free, window, max_group, max_candidates, deadline)
+    return found
+
+def mappings(lines: OpenLines, found: dict[str, list[np.ndarray]]) -> dict[str, str]:
+    '''JournalLineID -> Mapping for every matched line.'''
+    out = {}
+    for stage, groups in found.items():
+        for group in groups:
+            ids = lines.line_ids[group]
+            mapping = f'{PREFIX}:{stage}:{min(ids)}'
+            for line_id in ids:
+                out[line_id] = mapping
+    return out
+
+def match_account(tenant_id: str, account_id: str, dry_run: bool=False, **options) -> dict:
+    '''Matches the account's unmapped lines and, unless ``dry_run``, maps them in one
+    transaction. ``options`` are passed to ``match_lines``.'''
+    start = perf_counter()
+    lines = OpenLines.load(tenant_id, account_id)
+    loaded = perf_counter()
+    found = match_lines(lines, **options)
+    matched = perf_counter()
+    proposed = mappings(lines, found)
+    if proposed and not dry_run:
+        with tenant_writer(tenant_id) as con, con:
+            set_mappings(con, account_id, proposed)
+    return {
+        'OpenLines': len(lines),
+        'MatchedLines': len(proposed),
+        'Groups': {stage: len(groups) for stage, groups in found.items()},
+        'Seconds': {
+            'load': round(loaded - start, 3),
+            'match': round(matched - loaded, 3),
+            'write': round(perf_counter() - matched, 3),
+        },
+        'DryRun': dry_run,
+    }
+
+def clear_matches(tenant_id: str, account_id: str) -> int:
+    '''Unmaps every line the matcher mapped. Returns the number of lines.'''
+    with tenant_writer(tenant_id) as con, con:
+        ids = [row[0] for row in con.execute(
+            f"SELECT JournalLineID FROM {recon_table(account_id)} WHERE Mapping LIKE ?;", (f'{PREFIX}:%',)
+        )]
+        set_mappings(con, account_id, dict.fromkeys(ids))
+    return len(ids)
+
+def main(tenant_id: str, account_id: str, *flags: str):
+    if '--clear' in flags:
+        print(f'{clear_matches(tenant_id, account_id)} lines unmapped')
+    else:
+        print(json.dumps(match_account(tenant_id, account_id, dry_run='--dry-run' in flags), indent=2))
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,271 @@
+'''Mapping rules for reconciled accounts, compiled once and run over new journal lines.
+
+Rules come from two places. recon_mappings.JSON holds the conditions for its row's
+Mapping: an object whose conditions must all hold, or a list of such objects of which
+any may. recon_settings.TemplateJSON holds a list of rules, each an object with a
+"Mapping" and conditions (or {"Rules": [...]}). The conditions are
+
+    AccountCode, ContraAccountCode, SourceType, TrackingOption
+        a value or list of values; ContraAccountCode is any other line of the journal,
+        TrackingOption an option name or TrackingOptionID
+    Description, Reference
+        a regular expression, searched case-insensitively
+    MinAmount, MaxAmount
+        NetAmount bounds, inclusive
+    Sign
+        "debit" or "credit"
+    Priority
+        lower runs first (default 0); recon_mappings rules run before the template's
+        at equal priority, and a line takes the first rule it matches
+
+Each rule compiles to a predicate over a DataFrame of lines, so a batch is mapped with
+one column filter per condition. Programs are cached by the JSON they came from, so a
+change to the JSON is picked up on the next run, which then also reconsiders the
+account's older unmapped lines.
+
+    python -m recon.rules <tenant_id> [<account_id>] [--all]
+'''
+import hashlib
+import json
+import re
+import sys
+import traceback
+from functools import lru_cache
+from typing import Callable
+import pandas as pd
+from sqlite3 import Connection
+from sql import tenant_writer, create_recon_rules
+from sql.writer import transaction
+from sql.money import money_scale
+from .balances import recon_table, set_mappings
+
+Predicate = Callable[[pd.DataFrame, 'Batch'], pd.Series]
+
+LIST_CONDITIONS = ('AccountCode', 'ContraAccountCode', 'SourceType', 'TrackingOption')
+REGEX_CONDITIONS = ('Description', 'Reference')
+CONDITIONS = LIST_CONDITIONS + REGEX_CONDITIONS + ('MinAmount', 'MaxAmount', 'Sign', 'Priority', 'Mapping')
+
+
+class Batch():
+    '''Journal lines of one account to map, with what rules may ask about them.'''
+
+    def __init__(self, lines: pd.DataFrame, contra: pd.DataFrame, tracking: pd.DataFrame):
+        self.lines = lines
+        # (JournalNumber, AccountCode) of the journals' other lines
+        self.contra = contra
+        # (JournalLineID, Option) with a row for each option's ID and one for its name
+        self.tracking = tracking
+
+
+def _values(val) -> list:
+    return [str(v) for v in val] if isinstance(val, list) else [str(val)]
+
+def condition(key: str, val) -> Predicate:
+    if key == 'AccountCode':
+        codes = _values(val)
+        return lambda df, batch: df['AccountCode'].isin(codes)
+    if key == 'SourceType':
+        types = _values(val)
+        return lambda df, batch: df['SourceType'].isin(types)
+    if key == 'ContraAccountCode':
+        codes = _values(val)
+        return lambda df, batch: df['JournalNumber'].isin(
+            batch.contra.loc[batch.contra['AccountCode'].isin(codes), 'JournalNumber'])
+    if key == 'TrackingOption':
+        options = _values(val)
+        return lambda df, batch: df['JournalLineID'].isin(
+            batch.tracking.loc[batch.tracking['Option'].isin(options), 'JournalLineID'])
+    if key in REGEX_CONDITIONS:
+        pattern = re.compile(val, re.IGNORECASE)
+        return lambda df, batch: df[key].str.contains(pattern, na=False)
+    if key == 'MinAmount':
+        low = float(val)
+        return lambda df, batch: df['NetAmount'] >= low
+    if key == 'MaxAmount':
+        high = float(val)
+        return lambda df, batch: df['NetAmount'] <= high
+    if key == 'Sign':
+        if val not in ('debit', 'credit'):
+            raise ValueError(f'Sign must be debit or credit, not {val}')
+        debit = val == 'debit'
+        return lambda df, batch: (df['NetAmount'] > 0) if debit else (df['NetAmount'] < 0)
+    raise ValueError(f'unknown rule condition {key}')
+
+def compile_conditions(rule: dict) -> Predicate:
+    '''One predicate that holds where all the rule's conditions do.'''
+    unknown = set(rule) - set(CONDITIONS)
+    if unknown:
+        raise ValueError(f'unknown rule conditions {sorted(unknown)}')
+    predicates = [condition(key, val) for key, val in rule.items() if key not in ('Priority', 'Mapping')]
+    if not predicates:
+        raise ValueError('a rule needs at least one condition')
+
+    def predicate(df: pd.DataFrame, batch: Batch) -> pd.Series:
+        mask = predicates[0](df, batch)
+        for p in predicates[1:]:
+            # later conditions only look at rows still in
+            if not mask.any():
+                break
+            mask = mask & p(df, batch)
+        return mask
+    return predicate
+
+def rules_from_json(mappings: list[tuple[str, str]], template: str|None) -> list[tuple[float, int, str, dict]]:
+    '''(priority, source, mapping, conditions) for each rule, in the order they run.'''
+    rules = []
+    for mapping, text in mappings:
+        if not text:
+            continue
+        spec = json.loads(text)
+        for rule in spec if isinstance(spec, list) else [spec]:
+            rules.append((float(rule.get('Priority', 0)), 0, mapping, rule))
+    if template:
+        spec = json.loads(template)
+        for rule in spec.get('Rules', []) if isinstance(spec, dict) else spec:
+            if 'Mapping' not in rule:
+                raise ValueError('template rules need a Mapping')
+            rules.append((float(rule.get('Priority', 0)), 1, rule['Mapping'], rule))
+    rules.sort(key=lambda rule: rule[:2])
+    return rules
+
+
+class Program():
+    '''Compiled rules for one account.'''
+
+    def __init__(self, mappings: tuple[tuple[str, str], ...], template: str|None):
+        rules = rules_from_json(list(mappings), template)
+        self.rules = [(mapping, compile_conditions(rule)) for _, _, mapping, rule in rules]
+        self.needs_contra = any('ContraAccountCode' in rule for *_, rule in rules)
+        self.needs_tracking = any('TrackingOption' in rule for *_, rule in rules)
+
+    def __call__(self, batch: Batch) -> pd.Series:
+        '''The Mapping for each line of the batch, None where no rule matched.'''
+        df = batch.lines
+        result = pd.Series(None, index=df.index, dtype=object)
+        open_rows = pd.Series(True, index=df.index)
+        for mapping, predicate in self.rules:
+            if not open_rows.any():
+                break
+            rest = df[open_rows]
+            hit = predicate(rest, batch)
+            hit_index = rest.index[hit.to_numpy()]
+            result[hit_index] = mapping
+            open_rows[hit_index] = False
+        return result
+
+
+@lru_cache(maxsize=256)
+def compiled(mappings: tuple[tuple[str, str], ...], template: str|None) -> Program:
+    '''The account's program, compiled once for each version of its JSON.'''
+    return Program(mappings, template)
+
+def rules_json(con: Connection, account_id: str) -> tuple[tuple[tuple[str, str], ...], str|None]:
+    template = con.execute("SELECT TemplateJSON FROM recon_settings WHERE AccountID = ?;", (account_id,)).fetchone()
+    if template is None:
+        raise KeyError(f'{account_id} is not a reconciled account')
+    mappings = tuple(con.execute(
+        "SELECT Mapping, JSON FROM recon_mappings WHERE AccountID = ? AND JSON IS NOT NULL ORDER BY Mapping;",
+        (account_id,),
+    ).fetchall())
+    return mappings, template[0]
+
+def rules_hash(mappings: tuple[tuple[str, str], ...], template: str|None) -> str:
+    return hashlib.sha1(json.dumps([mappings, template]).encode()).hexdigest()
+
+def load_batch(con: Connection, account_id: str, after: int, program: Program) -> Batch:
+    '''The account's unmapped lines in journals after ``after``.'''
+    cursor = con.execute(
+        "SELECT l.JournalNumber, l.JournalLineID, l.AccountCode, l.Description, l.NetAmount, "
+        "j.Reference, j.SourceType FROM JournalLines l JOIN Journals j ON j.JournalNumber = l.JournalNumber "
+        f"LEFT JOIN {recon_table(account_id)} r ON r.JournalLineID = l.JournalLineID "
+        "WHERE l.AccountID = ? AND l.JournalNumber > ? AND r.Mapping IS NULL;",
+        (account_id, after),
+    )
+    lines = pd.DataFrame.from_records(cursor.fetchall(), columns=[col[0] for col in cursor.description])
+    # rules give amounts in dollars
+    lines['NetAmount'] = lines['NetAmount'].astype(float) / money_scale(con)
+    contra = pd.DataFrame(columns=['JournalNumber', 'AccountCode'])
+    tracking = pd.DataFrame(columns=['JournalLineID', 'Option'])
+    if len(lines) and program.needs_contra:
+        contra = pd.DataFrame.from_records(con.execute(
+            "SELECT DISTINCT JournalNumber, AccountCode FROM JournalLines WHERE AccountID != ?1 AND JournalNumber IN "
+            "(SELECT JournalNumber FROM JournalLines WHERE AccountID = ?1 AND JournalNumber > ?2);",
+            (account_id, after),
+        ).fetchall(), columns=['JournalNumber', 'AccountCode'])
+    if len(lines) and program.needs_tracking:
+        rows = con.execute(
+            "SELECT t.JournalLineID, t.TrackingOptionID, o.Name FROM JournalLineTracking t "
+            "JOIN JournalLines l ON l.JournalNumber = t.JournalNumber AND l.JournalLineID = t.JournalLineID "
+            "LEFT JOIN TrackingOptions o ON o.TrackingOptionID = t.TrackingOptionID "
+            "WHERE l.AccountID = ? AND t.JournalNumber > ? AND t.TrackingOptionID IS NOT NULL;",
+            (account_id, after),
+        ).fetchall()
+        tracking = pd.DataFrame.from_records(
+            [(line, option) for line, *options in rows for option in options if option is not None],
+            columns=['JournalLineID', 'Option'],
+        )
+    return Batch(lines, contra, tracking)
+
+def apply_rules(con: Connection, account_id: str, rerun: bool=False) -> int:
+    '''Maps the account's unmapped lines synced since the last run, or all of them when
+    the rules changed or with ``rerun``. Run inside ``with con``. Returns the number of
+    lines mapped.'''
+    mappings, template = rules_json(con, account_id)
+    if not mappings and not template:
+        return 0
+    digest = rules_hash(mappings, template)
+    state = con.execute(
+        "SELECT LastJournalNumber, RulesHash FROM recon_rule_state WHERE AccountID = ?;", (account_id,)
+    ).fetchone()
+    after = 0 if rerun or state is None or state[1] != digest else state[0]
+    start = con.execute(
+        "SELECT coalesce(JournalStart, 0) FROM recon_settings WHERE AccountID = ?;", (account_id,)
+    ).fetchone()[0]
+    top = con.execute("SELECT coalesce(max(JournalNumber), 0) FROM Journals;").fetchone()[0]
+    program = compiled(mappings, template)
+    batch = load_batch(con, account_id, max(after, start - 1), program)
+    mapped = 0
+    if len(batch.lines):
+        result = program(batch)
+        hits = result.notna()
+        mapped = int(hits.sum())
+        if mapped:
+            set_mappings(con, account_id, dict(zip(batch.lines.loc[hits, 'JournalLineID'], result[hits])))
+    con.execute(
+        "INSERT INTO recon_rule_state(AccountID, LastJournalNumber, RulesHash) VALUES (?, ?, ?) "
+        "ON CONFLICT(AccountID) DO UPDATE SET LastJournalNumber = excluded.LastJournalNumber, "
+        "RulesHash = excluded.RulesHash;",
+        (account_id, top, digest),
+    )
+    return mapped
+
+def update_mappings(tenant_id: str, account_id: str|None=None, rerun: bool=False) -> dict[str, int]:
+    '''Runs the rules of one reconciled account, or all of them, over their new lines.
+    Running all of them, an account whose rules fail is rolled back and logged and the
+    others are still mapped.'''
+    create_recon_rules(tenant_id)
+    mapped = {}
+    with tenant_writer(tenant_id) as con, transaction(con):
+        if account_id is None:
+            accounts = [row[0] for row in con.execute("SELECT AccountID FROM recon_settings;")]
+        else:
+            accounts = [account_id]
+        for account in accounts:
+            con.execute("SAVEPOINT apply_rules;")
+            try:
+                mapped[account] = apply_rules(con, account, rerun)
+            except Exception:
+                con.execute("ROLLBACK TO apply_rules;")
+                if account_id is not None:
+                    raise
+                print(traceback.format_exc() + f'\n tenant_id = {tenant_id}\n AccountID = {account}', file=sys.stderr)
+            finally:
+                con.execute("RELEASE apply_rules;")
+    return mapped
+
+def main(tenant_id: str, *args: str):
+    accounts = [arg for arg in args if not arg.startswith('--')]
+    print(json.dumps(update_mappings(tenant_id, accounts[0] if accounts else None, rerun='--all' in args), indent=2))
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
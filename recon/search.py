@@ -0,0 +1,164 @@
+'''Free-text search over journal line descriptions and journal references.
+
+journal_search is an FTS5 table with one row per journal line, holding its Description
+and its journal's Reference. The rowid is the JournalNumber shifted left by
+``SHIFT`` plus the line's position in the journal, so the rows of a range of journals
+can be replaced or removed by rowid range. With the trigram tokenizer any fragment
+of three or more characters matches, as LIKE '%...%' would, without a scan.
+
+    python -m recon.search <tenant_id> rebuild
+    python -m recon.search <tenant_id> <text> [<account_id>]
+'''
+import json
+import sys
+from datetime import date, timedelta
+from sqlite3 import Connection
+from sql import tenant_reader, tenant_writer, create_journal_search, fts_tokenizer
+from sql.writer import transaction
+from sql.money import money_scale, amount_sql, to_units
+from .trial_balance import as_date
+
+SHIFT = 16
+MAX_LINES = (1 << SHIFT) - 1
+MIN_TERM = 3
+
+def first_rowid(journal_number: int) -> int:
+    return journal_number << SHIFT
+
+def index_page(con: Connection, parser) -> int:
+    '''Replaces the search rows of the parsed page's journals. Call inside the page's
+    ``transaction(con)``. Returns the number of lines indexed.'''
+    if not parser.journals:
+        return 0
+    numbers = [row[0] for row in parser.journals]
+    reference = dict(zip(numbers, (row[parser.cols_journal.index('Reference')] for row in parser.journals)))
+    con.execute(
+        "DELETE FROM journal_search WHERE rowid >= ? AND rowid < ?;",
+        (first_rowid(min(numbers)), first_rowid(max(numbers) + 1)),
+    )
+    line_id = parser.cols_journal_line.index('JournalLineID')
+    description = parser.cols_journal_line.index('Description')
+    rows = []
+    current, ordinal = None, 0
+    for line in parser.journal_lines:
+        if line[0] != current:
+            current, ordinal = line[0], 0
+        elif ordinal == MAX_LINES:
+            raise ValueError(f'journal {current} has more lines than the search index can hold')
+        else:
+            ordinal += 1
+        rows.append((first_rowid(current) | ordinal, line[description], reference.get(current), line[line_id]))
+    con.executemany(
+        "INSERT INTO journal_search(rowid, Description, Reference, JournalLineID) VALUES (?, ?, ?, ?);", rows
+    )
+    return len(rows)
+
+def trim_index(con: Connection, checkpoint: int):
+    '''Removes the search rows of journals after ``checkpoint``.'''
+    con.execute("DELETE FROM journal_search WHERE rowid >= ?;", (first_rowid(checkpoint + 1),))
+
+def catch_up(con: Connection) -> int:
+    '''Indexes the stored journals above the highest one indexed, in one statement; the
+    way a backfill fills the index after loading without it. Run inside
+    ``transaction(con)``. Returns the number of lines indexed.'''
+    last = con.execute("SELECT max(rowid) FROM journal_search;").fetchone()[0]
+    after = 0 if last is None else last >> SHIFT
+    return con.execute(
+        "INSERT INTO journal_search(rowid, Description, Reference, JournalLineID) "
+        f"SELECT (l.JournalNumber << {SHIFT}) | (row_number() OVER (PARTITION BY l.JournalNumber) - 1), "
+        "l.Description, j.Reference, l.JournalLineID "
+        "FROM JournalLines l JOIN Journals j ON j.JournalNumber = l.JournalNumber WHERE l.JournalNumber > ?;",
+        (after,),
+    ).rowcount
+
+def build_index(con: Connection) -> int:
+    '''Reindexes every stored line. Run inside ``transaction(con)``.'''
+    con.execute("DELETE FROM journal_search;")
+    return catch_up(con)
+
+def ensure_search_index(tenant_id: str):
+    '''Creates the search index, filling it from the stored lines for a tenant synced
+    before it existed.'''
+    with tenant_reader(tenant_id) as con:
+        exists = con.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'journal_search';"
+        ).fetchone()
+    if exists:
+        return
+    create_journal_search(tenant_id)
+    with tenant_writer(tenant_id) as con, transaction(con):
+        build_index(con)
+
+def catch_up_index(tenant_id: str) -> int:
+    with tenant_writer(tenant_id) as con, transaction(con):
+        return catch_up(con)
+
+def rebuild_search_index(tenant_id: str) -> int:
+    create_journal_search(tenant_id)
+    with tenant_writer(tenant_id) as con, transaction(con):
+        return build_index(con)
+
+def match_expression(text: str) -> tuple[str, list[str]]:
+    '''The FTS5 query for ``text``, every term quoted so punctuation in references such
+    as INV-0042 is matched literally, and the terms too short for the trigram index,
+    which are matched with LIKE on the rows found.'''
+    terms = text.split()
+    short = []
+    if fts_tokenizer() == 'trigram':
+        short = [term for term in terms if len(term) < MIN_TERM]
+        terms = [term for term in terms if len(term) >= MIN_TERM]
+    if not terms:
+        raise ValueError(f'search text needs a term of at least {MIN_TERM} characters')
+    return ' '.join('"' + term.replace('"', '""') + '"' for term in terms), short
+
+def search_lines(tenant_id: str, text: str, account_id: str|None=None, start: date|str|None=None,
+    end: date|str|None=None, amount: float|None=None, tolerance: float=0.0, limit: int=50) -> list[dict]:
+    '''Journal lines whose description or journal reference contain every term of
+    ``text``, best match first. Optionally limited to one account, to journals dated from
+    ``start`` to ``end`` inclusive and to a NetAmount within ``tolerance`` of ``amount``.
+    The JournalLineIDs can be passed straight to ``recon.balances.set_mappings``.'''
+    with tenant_reader(tenant_id) as con:
+        scale = money_scale(con)
+    stmt = (
+        "SELECT s.JournalLineID, l.JournalNumber, j.JournalDate, l.AccountID, l.AccountCode, "
+        f"l.Description, j.Reference, {amount_sql('l.NetAmount', scale)} AS NetAmount, "
+        "bm25(journal_search) AS Rank FROM journal_search s "
+        f"JOIN JournalLines l ON l.JournalNumber = s.rowid >> {SHIFT} AND l.JournalLineID = s.JournalLineID "
+        "JOIN Journals j ON j.JournalNumber = l.JournalNumber "
+        "WHERE journal_search MATCH ?"
+    )
+    expression, short = match_expression(text)
+    params: list = [expression]
+    for term in short:
+        stmt += " AND (s.Description LIKE ? OR s.Reference LIKE ?)"
+        params.extend((f'%{term}%', f'%{term}%'))
+    if account_id is not None:
+        stmt += " AND l.AccountID = ?"
+        params.append(account_id)
+    if start is not None:
+        stmt += " AND j.JournalDate >= ?"
+        params.append(as_date(start).isoformat())
+    if end is not None:
+        stmt += " AND j.JournalDate < ?"
+        params.append((as_date(end) + timedelta(days=1)).isoformat())
+    if amount is not None:
+        stmt += " AND abs(l.NetAmount - ?) <= ?"
+        params.extend((to_units(amount, scale), tolerance * scale))
+    stmt += " ORDER BY Rank LIMIT ?;"
+    params.append(limit)
+    with tenant_reader(tenant_id) as con:
+        cursor = con.execute(stmt, params)
+        cols = [col[0] for col in cursor.description]
+        return [dict(zip(cols, row)) for row in cursor]
+
+def main(tenant_id: str, *args: str):
+    if args == ('rebuild',):
+        print(f'{rebuild_search_index(tenant_id)} lines indexed')
+    elif args:
+        print(json.dumps(search_lines(tenant_id, *args[:2]), indent=2))
+    else:
+        print(__doc__, file=sys.stderr)
+        sys.exit(2)
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,171 @@
+'''Trial balances computed from the tenant's stored journals instead of the Xero report.
+
+Balance sheet accounts show their balance since the first journal; profit and loss
+accounts show the financial year to date, with earlier years' profit carried into
+retained earnings, as Xero's Trial Balance does. Journals are never edited once
+posted, so a trial balance is cached against the last journal number it saw.
+
+    python -m recon.trial_balance <tenant_id> <YYYY-MM-DD> [--verify]
+'''
+import json
+import sys
+from datetime import date, datetime, timedelta
+from sqlite3 import Connection
+from sql import tenant_reader, tenant_writer
+from sql.money import money_scale
+
+# https://developer.xero.com/documentation/api/accounting/types/#account-types
+PROFIT_AND_LOSS = ('REVENUE', 'SALES', 'OTHERINCOME', 'EXPENSE', 'OVERHEADS', 'DIRECTCOSTS', 'DEPRECIATN')
+RETAINED_EARNINGS = 'RETAINEDEARNINGS'
+# local and Xero balances closer than this match
+TOLERANCE = 0.005
+
+def as_date(at: date|str) -> date:
+    if isinstance(at, str):
+        return date.fromisoformat(at[:10])
+    if isinstance(at, datetime):
+        return at.date()
+    return at
+
+def financial_year_start(con: Connection, at: date) -> date:
+    '''First day of the financial year ``at`` falls in, from the organisation's year end
+    (31 December if it has not been synced).'''
+    first = con.execute(
+        "SELECT FinancialYearEndDay, FinancialYearEndMonth FROM Organisations LIMIT 1;"
+    ).fetchone()
+    day, month = first if first and first[0] and first[1] else (31, 12)
+    end = year_end(at.year, month, day)
+    if end >= at:
+        end = year_end(at.year - 1, month, day)
+    return end + timedelta(days=1)
+
+def year_end(year: int, month: int, day: int) -> date:
+    try:
+        return date(year, month, day)
+    except ValueError:
+        # 29 February in a year without one
+        return date(year, month, day - 1)
+
+def compute_trial_balance(con: Connection, at: date) -> list[dict]:
+    '''Per-account balances at the end of ``at`` with one grouped pass over JournalLines.'''
+    year_start = financial_year_start(con, at)
+    scale = money_scale(con)
+    rows = con.execute(
+        "SELECT l.AccountID, max(l.AccountCode), max(l.AccountName), max(l.AccountType), "
+        "sum(l.NetAmount), sum(CASE WHEN j.JournalDate >= ? THEN l.NetAmount ELSE 0 END) "
+        "FROM JournalLines l JOIN Journals j ON j.JournalNumber = l.JournalNumber "
+        "WHERE j.JournalDate < ? GROUP BY l.AccountID;",
+        (year_start.isoformat(), (at + timedelta(days=1)).isoformat()),
+    ).fetchall()
+    accounts = {
+        row[0]: row[1:] for row in con.execute("SELECT AccountID, Code, Name, Type, SystemAccount FROM Accounts;")
+    }
+    # balances stay in stored units, exact for integer tenants, until rounded for output
+    balances: dict[str, dict] = {}
+    prior_earnings = 0
+    for account_id, code, name, account_type, total, year_to_date in rows:
+        if account_id in accounts:
+            code, name, account_type = accounts[account_id][:3]
+        if account_type in PROFIT_AND_LOSS:
+            prior_earnings += total - year_to_date
+            total = year_to_date
+        balances[account_id] = {'AccountID': account_id, 'AccountCode': code, 'AccountName': name,
+            'AccountType': account_type, 'Balance': total}
+    if round(prior_earnings / scale, 2):
+        retained = next((account_id for account_id, acct in accounts.items() if acct[3] == RETAINED_EARNINGS), '')
+        if retained not in balances:
+            code, name, account_type = accounts[retained][:3] if retained else (None, 'Retained Earnings', 'EQUITY')
+            balances[retained] = {'AccountID': retained, 'AccountCode': code, 'AccountName': name,
+                'AccountType': account_type, 'Balance': 0.0}
+        balances[retained]['Balance'] += prior_earnings
+    out = []
+    for row in sorted(balances.values(), key=lambda row: (row['AccountCode'] or '', row['AccountID'])):
+        balance = round(row['Balance'] / scale, 2)
+        if not balance:
+            continue
+        row.update(Balance=balance, Debit=max(balance, 0), Credit=max(-balance, 0))
+        out.append(row)
+    return out
+
+def trial_balance(tenant_id: str, at: date|str) -> dict:
+    '''The trial balance at the end of ``at``, from the cache unless journals have been
+    added since it was computed.'''
+    at = as_date(at)
+    with tenant_reader(tenant_id) as con:
+        last = con.execute("SELECT coalesce(max(JournalNumber), 0) FROM Journals;").fetchone()[0]
+        cached = con.execute(
+            "SELECT JSON FROM trial_balances WHERE Date = ? AND LastJournalNumber = ?;", (at.isoformat(), last)
+        ).fetchone()
+        if cached:
+            accounts = json.loads(cached[0])
+        else:
+            accounts = compute_trial_balance(con, at)
+    if not cached:
+        with tenant_writer(tenant_id) as con, con:
+            con.execute("DELETE FROM trial_balances WHERE Date = ?;", (at.isoformat(),))
+            con.execute(
+                "INSERT OR REPLACE INTO trial_balances(Date, LastJournalNumber, JSON) VALUES (?, ?, ?);",
+                (at.isoformat(), last, json.dumps(accounts)),
+            )
+    return {
+        'Date': at.isoformat(),
+        'LastJournalNumber': last,
+        'Accounts': accounts,
+        'Debit': round(sum(row['Debit'] for row in accounts), 2),
+        'Credit': round(sum(row['Credit'] for row in accounts), 2),
+    }
+
+def _amount(cell: dict) -> float:
+    val = cell.get('Value') or '0'
+    return float(val.replace(',', ''))
+
+def report_balances(report: dict) -> dict[str, dict]:
+    '''Net year-to-date balance per AccountID from a Xero Trial Balance report.'''
+    balances = {}
+    for section in report.get('Rows', []):
+        for row in section.get('Rows', []):
+            if row.get('RowType') != 'Row':
+                continue
+            cells = row['Cells']
+            attributes = cells[0].get('Attributes') or []
+            account_id = next((attr['Value'] for attr in attributes if attr.get('Id') == 'account'), None)
+            if account_id is None:
+                continue
+            # Account, Debit, Credit, YTD Debit, YTD Credit
+            balances[account_id] = {'AccountName': cells[0].get('Value'),
+                'Balance': round(_amount(cells[3]) - _amount(cells[4]), 2)}
+    return balances
+
+def verify_trial_balance(tenant_id: str, api, at: date|str) -> dict:
+    '''Diffs the local trial balance against Xero's report for the same date.'''
+    local = trial_balance(tenant_id, at)
+    remote = report_balances(api.get_trial_balance(as_date(at))[0])
+    ours = {row['AccountID']: row for row in local['Accounts']}
+    differences = []
+    for account_id in sorted(set(ours) | set(remote)):
+        mine = ours.get(account_id, {}).get('Balance', 0.0)
+        theirs = remote.get(account_id, {}).get('Balance', 0.0)
+        if abs(mine - theirs) > TOLERANCE:
+            differences.append({
+                'AccountID': account_id,
+                'AccountName': (ours.get(account_id) or remote.get(account_id) or {}).get('AccountName'),
+                'Local': mine,
+                'Xero': theirs,
+                'Difference': round(mine - theirs, 2),
+            })
+    return {
+        'Date': local['Date'],
+        'LastJournalNumber': local['LastJournalNumber'],
+        'Matches': not differences,
+        'Differences': differences,
+    }
+
+def main(tenant_id: str, at: str, *flags: str):
+    if '--verify' in flags:
+        from xero.jobs import tenant_api
+        print(json.dumps(verify_trial_balance(tenant_id, tenant_api(tenant_id), at), indent=2))
+    else:
+        print(json.dumps(trial_balance(tenant_id, at), indent=2))
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -1,12 +1,24 @@
 from jinja2 import Environment, PackageLoader, select_autoescape
+from contextlib import AbstractContextManager
+from .pool import ConnectionPool
 import sqlite3
 import os
 
 env = Environment(loader=PackageLoader(__name__), autoescape=select_autoescape())
 db_dir = os.path.dirname(__file__)
+pool = ConnectionPool()
+
+def tenant_db_path(tenant_id: str) -> str:
+    return f"{db_dir}/xero_tenants/{tenant_id}.db"
 
 def get_tenant_db(tenant_id: str) -> sqlite3.Connection:
-    return sqlite3.connect(f"{db_dir}/xero_tenants/{tenant_id}.db")
+    return sqlite3.connect(tenant_db_path(tenant_id))
+
+def tenant_reader(tenant_id: str) -> AbstractContextManager[sqlite3.Connection]:
+    return pool.reader(tenant_db_path(tenant_id))
+
+def tenant_writer(tenant_id: str) -> AbstractContextManager[sqlite3.Connection]:
+    return pool.writer(tenant_db_path(tenant_id))
 
 def get_user_db() -> sqlite3.Connection:
     return sqlite3.connect(f"{db_dir}/users.db")
@@ -14,20 +26,50 @@ def get_user_db() -> sqlite3.Connection:
 def get_xero_tokens_db() -> sqlite3.Connection:
     return sqlite3.connect(f"{db_dir}/xero_tokens.db", isolation_level="EXCLUSIVE")
 
-def xero_base(tenant_id: str):
-    stmt = env.get_template("base.sql").render()
-    con = get_tenant_db(tenant_id)
-    try:
-        with con:
-            con.executescript(stmt)
-    finally:
-        con.close()
+def run_tenant_script(tenant_id: str, template: str, **kwargs):
+    stmt = env.get_template(template).render(**kwargs)
+    with tenant_writer(tenant_id) as con:
+        con.executescript(stmt)
+
+def xero_base(tenant_id: str, money_scale: int=1):
+    '''``money_scale`` sql.money.MONEY_SCALE stores the tenant's amounts as integers.'''
+    run_tenant_script(tenant_id, "base.sql", money_scale=money_scale)
+
+def create_tenant_settings(tenant_id: str):
+    run_tenant_script(tenant_id, "tenant_settings.sql")
 
 def create_recon_account(account_id: str, tenant_id: str):
-    stmt = env.get_template("create_recon_account.sql").render(account_id=account_id)
-    con = get_tenant_db(tenant_id)
-    try:
-        with con:
-            con.executescript(stmt)
-    finally:
-        con.close()
+    run_tenant_script(tenant_id, "create_recon_account.sql", account_id=account_id)
+
+def create_journal_line_index(tenant_id: str):
+    run_tenant_script(tenant_id, "journal_line_index.sql")
+
+def create_sync_checkpoints(tenant_id: str):
+    run_tenant_script(tenant_id, "sync_checkpoints.sql")
+
+def create_recon_balances(tenant_id: str):
+    run_tenant_script(tenant_id, "recon_balances.sql")
+
+def create_recon_rules(tenant_id: str):
+    run_tenant_script(tenant_id, "recon_rules.sql")
+
+def create_trial_balances(tenant_id: str):
+    run_tenant_script(tenant_id, "trial_balances.sql")
+
+def create_balance_index(tenant_id: str):
+    run_tenant_script(tenant_id, "balance_index.sql")
+
+def create_tracking_tables(tenant_id: str):
+    run_tenant_script(tenant_id, "tracking.sql")
+
+def fts_tokenizer() -> str:
+    '''trigram matches any substring of three or more characters; SQLite before 3.34
+    only has word tokenizers.'''
+    return 'trigram' if sqlite3.sqlite_version_info >= (3, 34, 0) else 'unicode61'
+
+def create_journal_search(tenant_id: str):
+    # not in base.sql, as the tokenizer depends on the SQLite build
+    run_tenant_script(tenant_id, "journal_search.sql", tokenize=fts_tokenizer())
+
+def create_entity_tables(tenant_id: str):
+    run_tenant_script(tenant_id, "entities.sql")
@@ -0,0 +1,97 @@
+'''How a tenant DB stores money.
+
+Amounts are stored either as floating point dollars (scale 1, what tenants synced
+before this option have) or as 64-bit integers in units of 1/MONEY_SCALE. Integer
+amounts sum exactly and without converting each value, so balances over millions of
+lines neither drift by a cent nor pay for floating point. The scale is kept in
+tenant_settings; queries sum in stored units and divide once when returning dollars.
+
+    python -m sql.money <tenant_id> [integer|float]
+'''
+import sys
+from sqlite3 import Connection, OperationalError
+from . import tenant_writer, create_tenant_settings
+from .writer import transaction
+
+MONEY_SCALE = 10000
+SETTING = 'MoneyScale'
+# every stored amount, including running totals derived from the journal lines
+AMOUNT_COLUMNS = (
+    ('JournalLines', 'NetAmount'),
+    ('JournalLines', 'GrossAmount'),
+    ('JournalLines', 'TaxAmount'),
+    ('recon_settings', 'OpeningBalance'),
+    ('recon_balances', 'Amount'),
+    ('balance_index', 'Net'),
+    ('balance_index', 'Balance'),
+)
+
+def money_scale(con: Connection) -> int:
+    '''Stored units per dollar: 1 for floating point amounts, MONEY_SCALE for integers.'''
+    try:
+        first = con.execute("SELECT Value FROM tenant_settings WHERE Name = ?;", (SETTING,)).fetchone()
+    except OperationalError:
+        # a tenant DB from before tenant_settings
+        return 1
+    return int(first[0]) if first else 1
+
+def to_units(amount: float, scale: int) -> float|int:
+    '''A dollar amount as stored.'''
+    return amount if scale == 1 else round(amount * scale)
+
+def amount_sql(expr: str, scale: int) -> str:
+    '''``expr`` in dollars.'''
+    return expr if scale == 1 else f"({expr}) / {scale}.0"
+
+def units_sql(expr: str, scale: int) -> str:
+    '''``expr``, a sum of stored amounts, as it should be stored: floating point results
+    are rounded to the stored precision so error is not carried from one total to the next.'''
+    return expr if scale != 1 else f"round({expr}, 4)"
+
+def _tables(con: Connection) -> set[str]:
+    return {row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type = 'table';")}
+
+def migrate(con: Connection, scale: int) -> int:
+    '''Converts every stored amount to ``scale`` and records it. Run inside
+    ``transaction(con)``. Returns the number of rows converted.'''
+    old = money_scale(con)
+    if scale == old:
+        return 0
+    factor = scale / old
+    tables = _tables(con)
+    converted = 0
+    for table in dict.fromkeys(table for table, _ in AMOUNT_COLUMNS):
+        if table not in tables:
+            continue
+        cols = [col for name, col in AMOUNT_COLUMNS if name == table]
+        if scale == 1:
+            updates = ", ".join(f"{col} = {col} * ?" for col in cols)
+        else:
+            updates = ", ".join(f"{col} = CAST(round({col} * ?) AS INTEGER)" for col in cols)
+        converted += con.execute(f"UPDATE {table} SET {updates};", (factor,) * len(cols)).rowcount
+    con.execute(
+        "INSERT INTO tenant_settings(Name, Value) VALUES (?, ?) ON CONFLICT(Name) DO UPDATE SET Value = excluded.Value;",
+        (SETTING, scale),
+    )
+    return converted
+
+def migrate_tenant(tenant_id: str, scale: int=MONEY_SCALE) -> int:
+    '''Switches a tenant DB to integer amounts (or back to floating point with scale 1)
+    in one transaction, so readers see either the old amounts or the new. Holds the
+    tenant's sync claim, so no sync parses pages at the old scale meanwhile; raises
+    RuntimeError while one is running.'''
+    from xero.jobs import claim_tenant
+    with claim_tenant(tenant_id):
+        create_tenant_settings(tenant_id)
+        with tenant_writer(tenant_id) as con, transaction(con):
+            return migrate(con, scale)
+
+def main(tenant_id: str, mode: str='integer'):
+    if mode not in ('integer', 'float'):
+        print(__doc__, file=sys.stderr)
+        sys.exit(2)
+    rows = migrate_tenant(tenant_id, MONEY_SCALE if mode == 'integer' else 1)
+    print(f'{rows} rows converted')
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
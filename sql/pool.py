@@ -0,0 +1,146 @@
+import sqlite3
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock, Semaphore
+from time import perf_counter
+from typing import Iterator
+
+PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,
+    'busy_timeout': 10000,
+}
+
+
+class _Database():
+    def __init__(self, path: str, readers: int):
+        self.path = path
+        self.writer: sqlite3.Connection | None = None
+        self.writer_lock = Lock()
+        self.idle_readers: list[sqlite3.Connection] = []
+        self.reader_slots = Semaphore(readers)
+        self.in_use = 0
+
+    def close(self):
+        for con in self.idle_readers:
+            con.close()
+        self.idle_readers.clear()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class ConnectionPool():
+    '''Keeps connections to the most recently used ``max_databases`` SQLite files.
+
+    Each database gets one writer connection, used by one thread at a time, and up
+    to ``readers`` query-only connections. In WAL mode readers are not blocked while
+    a sync holds the writer. Pragmas are applied once, when a connection is opened.
+    The least recently used idle database is closed once the limit is reached.'''
+
+    def __init__(self, max_databases: int=64, readers: int=4, pragmas: dict|None=None):
+        self.max_databases = max_databases
+        self.readers = readers
+        self.pragmas = PRAGMAS if pragmas is None else pragmas
+        self.databases: OrderedDict[str, _Database] = OrderedDict()
+        self.lock = Lock()
+        self.counters = {'hits': 0, 'opens': 0, 'evictions': 0, 'checkouts': 0, 'wait_seconds': 0.0}
+
+    def _open(self, path: str, query_only: bool=False) -> sqlite3.Connection:
+        con = sqlite3.connect(path, check_same_thread=False)
+        for name, value in self.pragmas.items():
+            con.execute(f'PRAGMA {name} = {value};')
+        if query_only:
+            con.execute('PRAGMA query_only = 1;')
+        with self.lock:
+            self.counters['opens'] += 1
+        return con
+
+    def _checkout(self, path: str) -> _Database:
+        with self.lock:
+            db = self.databases.get(path)
+            if db is None:
+                db = self.databases[path] = _Database(path, self.readers)
+                self._evict()
+            self.databases.move_to_end(path)
+            db.in_use += 1
+            self.counters['checkouts'] += 1
+            return db
+
+    def _checkin(self, db: _Database):
+        with self.lock:
+            db.in_use -= 1
+            if db.path not in self.databases and db.in_use == 0:
+                db.close()
+
+    def _evict(self):
+        for path in list(self.databases):
+            if len(self.databases) <= self.max_databases:
+                return
+            db = self.databases[path]
+            if db.in_use == 0:
+                del self.databases[path]
+                db.close()
+                self.counters['evictions'] += 1
+
+    def _waited(self, started: float):
+        with self.lock:
+            self.counters['wait_seconds'] += perf_counter() - started
+
+    @contextmanager
+    def writer(self, path: str) -> Iterator[sqlite3.Connection]:
+        '''The database's writer connection. Commit with ``with con:`` inside the block;
+        anything left uncommitted is rolled back when the block exits.'''
+        db = self._checkout(path)
+        try:
+            started = perf_counter()
+            with db.writer_lock:
+                self._waited(started)
+                if db.writer is None:
+                    db.writer = self._open(path)
+                else:
+                    with self.lock:
+                        self.counters['hits'] += 1
+                try:
+                    yield db.writer
+                finally:
+                    if db.writer.in_transaction:
+                        db.writer.rollback()
+        finally:
+            self._checkin(db)
+
+    @contextmanager
+    def reader(self, path: str) -> Iterator[sqlite3.Connection]:
+        db = self._checkout(path)
+        try:
+            started = perf_counter()
+            with db.reader_slots:
+                self._waited(started)
+                with self.lock:
+                    con = db.idle_readers.pop() if db.idle_readers else None
+                    if con is not None:
+                        self.counters['hits'] += 1
+                if con is None:
+                    con = self._open(path, query_only=True)
+                try:
+                    yield con
+                finally:
+                    if con.in_transaction:
+                        con.rollback()
+                    with self.lock:
+                        db.idle_readers.append(con)
+        finally:
+            self._checkin(db)
+
+    def close(self, path: str|None=None):
+        with self.lock:
+            for key in [path] if path else list(self.databases):
+                db = self.databases.pop(key, None)
+                if db is not None and db.in_use == 0:
+                    db.close()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(self.counters, databases=len(self.databases))
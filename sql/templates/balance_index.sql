@@ -0,0 +1,7 @@
+create table if not exists balance_index(
+    AccountID text not null,
+    JournalDate date not null,
+    Net decimal(22,4) not null default 0,
+    Balance decimal(22,4) not null default 0,
+    primary key(AccountID, JournalDate)
+) without rowid;
@@ -79,7 +79,7 @@ create table Journals(
 ) without rowid;
 
 create table JournalLines(
-    JournalNumber integer foreign key
+    JournalNumber integer
         references Journals(JournalNumber)
         on delete cascade,
     JournalLineID text not null,
@@ -96,3 +96,22 @@ create table JournalLines(
     TrackingCategories text,
     primary key(JournalNumber, JournalLineID)
 ) without rowid;
+
+
+{% include "journal_line_index.sql" %}
+
+{% include "tenant_settings.sql" %}
+
+{% include "sync_checkpoints.sql" %}
+
+{% include "tracking.sql" %}
+
+{% include "recon_balances.sql" %}
+
+{% include "recon_rules.sql" %}
+
+{% include "trial_balances.sql" %}
+
+{% include "balance_index.sql" %}
+
+{% include "entities.sql" %}
@@ -1,5 +1,5 @@
-create table "recon-{ account_id }"(
-    JournalNumber integer foreign key references Journals(JournalNumber),
+create table "recon-{{ account_id }}"(
+    JournalNumber integer references Journals(JournalNumber),
     JournalLineID text primary key,
     Mapping text
 ) without rowid;
@@ -0,0 +1,58 @@
+create table if not exists Contacts(
+    ContactID text primary key,
+    ContactNumber text,
+    AccountNumber text,
+    ContactStatus text,
+    Name text,
+    FirstName text,
+    LastName text,
+    EmailAddress text,
+    TaxNumber text,
+    IsSupplier boolean,
+    IsCustomer boolean,
+    DefaultCurrency text,
+    UpdatedDateUTC datetime
+) without rowid;
+
+create table if not exists Invoices(
+    InvoiceID text primary key,
+    InvoiceNumber text,
+    Type text,
+    ContactID text,
+    Date date,
+    DueDate date,
+    Status text,
+    LineAmountTypes text,
+    SubTotal decimal(22,4),
+    TotalTax decimal(22,4),
+    Total decimal(22,4),
+    AmountDue decimal(22,4),
+    AmountPaid decimal(22,4),
+    AmountCredited decimal(22,4),
+    CurrencyCode text,
+    CurrencyRate decimal(22,10),
+    Reference text,
+    HasAttachments boolean,
+    UpdatedDateUTC datetime,
+    LineItems text
+) without rowid;
+
+create table if not exists BankTransactions(
+    BankTransactionID text primary key,
+    Type text,
+    ContactID text,
+    BankAccountID text,
+    Date date,
+    Status text,
+    LineAmountTypes text,
+    SubTotal decimal(22,4),
+    TotalTax decimal(22,4),
+    Total decimal(22,4),
+    CurrencyCode text,
+    CurrencyRate decimal(22,10),
+    Reference text,
+    IsReconciled boolean,
+    HasAttachments boolean,
+    UpdatedDateUTC datetime,
+    LineItems text
+) without rowid;
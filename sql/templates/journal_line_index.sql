@@ -0,0 +1,2 @@
+create index if not exists JournalLines_JournalLineID
+    on JournalLines(JournalLineID);
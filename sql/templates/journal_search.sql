@@ -0,0 +1,6 @@
+create virtual table if not exists journal_search using fts5(
+    Description,
+    Reference,
+    JournalLineID unindexed,
+    tokenize = '{{ tokenize }}'
+);
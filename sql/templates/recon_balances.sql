@@ -0,0 +1,7 @@
+create table if not exists recon_balances(
+    AccountID text not null,
+    Mapping text not null,
+    Amount decimal(22,4) not null default 0,
+    Lines integer not null default 0,
+    primary key(AccountID, Mapping)
+) without rowid;
@@ -0,0 +1,5 @@
+create table if not exists recon_rule_state(
+    AccountID text primary key,
+    LastJournalNumber integer not null default 0,
+    RulesHash text
+) without rowid;
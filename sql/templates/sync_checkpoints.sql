@@ -0,0 +1,10 @@
+create table if not exists sync_checkpoints(
+    Entity text primary key,
+    Cursor integer not null,
+    UpdatedUTC datetime
+) without rowid;
+
+create table if not exists deferred_indexes(
+    Name text primary key,
+    SQL text not null
+) without rowid;
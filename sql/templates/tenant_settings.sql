@@ -0,0 +1,7 @@
+create table if not exists tenant_settings(
+    Name text primary key,
+    Value
+) without rowid;
+{% if money_scale %}
+insert into tenant_settings(Name, Value) values ('MoneyScale', {{ money_scale|int }}) on conflict do nothing;
+{% endif %}
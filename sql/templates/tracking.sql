@@ -0,0 +1,25 @@
+create table if not exists TrackingCategories(
+    TrackingCategoryID text primary key,
+    Name text,
+    Status text
+) without rowid;
+
+create table if not exists TrackingOptions(
+    TrackingOptionID text primary key,
+    TrackingCategoryID text not null,
+    Name text,
+    Status text
+) without rowid;
+
+create table if not exists JournalLineTracking(
+    JournalNumber integer not null
+        references Journals(JournalNumber)
+        on delete cascade,
+    JournalLineID text not null,
+    TrackingCategoryID text not null,
+    TrackingOptionID text,
+    primary key(JournalNumber, JournalLineID, TrackingCategoryID)
+) without rowid;
+
+create index if not exists JournalLineTracking_Option
+    on JournalLineTracking(TrackingCategoryID, TrackingOptionID);
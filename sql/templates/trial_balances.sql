@@ -0,0 +1,6 @@
+create table if not exists trial_balances(
+    Date date not null,
+    LastJournalNumber integer not null,
+    JSON text not null,
+    primary key(Date, LastJournalNumber)
+) without rowid;
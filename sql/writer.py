@@ -0,0 +1,110 @@
+from contextlib import contextmanager
+from sqlite3 import Connection
+from time import perf_counter
+from typing import Iterable, Iterator
+import pandas as pd
+from utils import metrics
+
+BATCH_SIZE = 5000
+
+_primary_keys: dict[tuple[int, str], tuple[str, ...]] = {}
+
+def primary_key(con: Connection, tablename: str) -> tuple[str, ...]:
+    cache_key = (id(con), tablename)
+    if cache_key not in _primary_keys:
+        info = con.execute(f'PRAGMA table_info("{tablename}");').fetchall()
+        _primary_keys[cache_key] = tuple(row[1] for row in sorted(info, key=lambda row: row[5]) if row[5])
+    return _primary_keys[cache_key]
+
+@contextmanager
+def transaction(con: Connection) -> Iterator[Connection]:
+    '''One explicit write transaction. BEGIN IMMEDIATE takes the write lock up front, so
+    a busy database is waited on at the start rather than failing halfway through.'''
+    con.execute('BEGIN IMMEDIATE;')
+    try:
+        yield con
+    except BaseException:
+        con.rollback()
+        raise
+    with metrics.db_commit_seconds.time():
+        con.commit()
+
+def insert_statement(tablename: str, columns: Iterable[str], on_conflict: str|None, key: tuple[str, ...]=()) -> str:
+    columns = tuple(columns)
+    stmt = f'INSERT INTO "{tablename}"({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})'
+    if on_conflict == 'nothing':
+        stmt += ' ON CONFLICT DO NOTHING'
+    elif on_conflict == 'update':
+        updates = ", ".join(f"{col} = excluded.{col}" for col in columns if col not in key)
+        if updates:
+            stmt += f' ON CONFLICT({", ".join(key)}) DO UPDATE SET {updates}'
+        else:
+            stmt += ' ON CONFLICT DO NOTHING'
+    elif on_conflict is not None:
+        raise ValueError(f'unknown on_conflict {on_conflict}')
+    return stmt + ';'
+
+def write_rows_to_sql(con: Connection, rows: Iterable[tuple], tablename: str, columns: tuple[str, ...],
+    on_conflict: str|None='update', key: tuple[str, ...]|None=None, batch_size: int=BATCH_SIZE):
+    '''Bulk writes row tuples with batched ``executemany``.
+
+    ``on_conflict`` is 'update' (upsert on ``key``, the table's primary key by default),
+    'nothing' (keep the stored row) or None (plain insert, conflicts raise). Run inside
+    ``transaction(con)`` to make a page all-or-nothing.'''
+    if on_conflict == 'update' and key is None:
+        key = primary_key(con, tablename)
+    stmt = insert_statement(tablename, columns, on_conflict, key or ())
+    start = perf_counter()
+    if isinstance(rows, list):
+        written = len(rows)
+        for first in range(0, len(rows), batch_size):
+            con.executemany(stmt, rows[first:first + batch_size])
+    else:
+        written = con.executemany(stmt, rows).rowcount
+    metrics.db_write_seconds.observe(perf_counter() - start, tablename)
+    metrics.db_rows_written_total.inc(tablename, amount=written)
+
+def df_rows(df: pd.DataFrame) -> list[tuple]:
+    df = df.astype(object).where(df.notna(), None)
+    for col in df.columns:
+        if df[col].map(lambda val: isinstance(val, pd.Timestamp)).any():
+            df[col] = df[col].map(lambda val: str(val) if isinstance(val, pd.Timestamp) else val)
+    return list(df.itertuples(index=False, name=None))
+
+def write_df_to_sql(con: Connection, df: pd.DataFrame, tablename: str, schema: str|None=None,
+    on_conflict: str|None='update'):
+    '''Writes a DataFrame through ``write_rows_to_sql``. ``schema`` is ignored; tenant
+    databases have a single schema.'''
+    if len(df) == 0:
+        return
+    write_rows_to_sql(con, df_rows(df), tablename, tuple(df.columns), on_conflict)
+
+def drop_indexes(con: Connection, tables: Iterable[str]):
+    '''Drops the secondary indexes on ``tables`` ahead of a bulk load. The definitions
+    are kept in deferred_indexes until ``restore_indexes`` rebuilds them, so they survive
+    an interrupted load.'''
+    tables = tuple(tables)
+    with transaction(con):
+        found = con.execute(
+            f"SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL "
+            f"AND tbl_name IN ({', '.join('?' * len(tables))});",
+            tables,
+        ).fetchall()
+        con.executemany("INSERT OR REPLACE INTO deferred_indexes(Name, SQL) VALUES (?, ?);", found)
+        for name, _ in found:
+            con.execute(f'DROP INDEX "{name}";')
+
+@contextmanager
+def deferred_indexes(con: Connection, tables: Iterable[str]) -> Iterator[None]:
+    drop_indexes(con, tables)
+    try:
+        yield
+    finally:
+        restore_indexes(con)
+
+def restore_indexes(con: Connection):
+    with transaction(con):
+        for name, stmt in con.execute("SELECT Name, SQL FROM deferred_indexes;").fetchall():
+            con.execute(stmt.replace('CREATE INDEX', 'CREATE INDEX IF NOT EXISTS', 1)
+                .replace('CREATE UNIQUE INDEX', 'CREATE UNIQUE INDEX IF NOT EXISTS', 1))
+        con.execute("DELETE FROM deferred_indexes;")
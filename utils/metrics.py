@@ -0,0 +1,242 @@
+'''In-process counters and histograms, exposed in the Prometheus text format.
+
+Recording only touches a dict in this process. When Redis is available, each process
+adds what it recorded since its last flush to one shared hash, but only while someone
+has read the metrics endpoint in the last ``READER_TTL`` seconds, so a deployment
+nobody scrapes costs nothing beyond the dict updates.'''
+import json
+import os
+import sys
+import traceback
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock, Thread, Event
+from time import perf_counter
+from typing import Any, Callable, Iterator
+from urllib.parse import urlsplit
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+FLUSH_INTERVAL = 10
+READER_TTL = 300
+REDIS_KEY = 'xero-metrics:samples'
+READER_KEY = 'xero-metrics:reader'
+
+# (metric name, label values, part) -> value; part is a bucket index, 'sum' or 'count'
+Samples = dict[tuple[str, tuple[str, ...], int|str], float]
+
+
+class Metric(ABC):
+    kind: str
+
+    @abstractmethod
+    def parts(self, series: list[float]) -> Iterator[tuple[int|str, float]]:
+        '''The (part, value) samples of one series.'''
+
+    def __init__(self, registry: 'Registry', name: str, help: str, labels: tuple[str, ...]=()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = labels
+        registry.metrics[name] = self
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels: str, amount: float=1):
+        registry = self.registry
+        with registry.lock:
+            series = registry.series.get((self.name, labels))
+            if series is None:
+                series = registry.series[(self.name, labels)] = [0]
+            series[0] += amount
+        if not registry.connected:
+            registry.connect()
+
+    def parts(self, series: list[float]) -> Iterator[tuple[int|str, float]]:
+        yield 'count', series[0]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry: 'Registry', name: str, help: str, labels: tuple[str, ...]=(),
+        buckets: tuple[float, ...]=LATENCY_BUCKETS):
+        super().__init__(registry, name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *labels: str):
+        bucket = bisect_left(self.buckets, value)
+        registry = self.registry
+        with registry.lock:
+            series = registry.series.get((self.name, labels))
+            if series is None:
+                # a count per bucket (the last is +Inf), then sum and count
+                series = registry.series[(self.name, labels)] = [0] * (len(self.buckets) + 3)
+            series[bucket] += 1
+            series[-2] += value
+            series[-1] += 1
+        if not registry.connected:
+            registry.connect()
+
+    def parts(self, series: list[float]) -> Iterator[tuple[int|str, float]]:
+        yield from enumerate(series[:-2])
+        yield 'sum', series[-2]
+        yield 'count', series[-1]
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, *labels)
+
+
+class Registry():
+    def __init__(self, get_redis: Callable[[], Any]|None=None, flush_interval: float=FLUSH_INTERVAL):
+        self.get_redis = get_redis
+        self.redis = None
+        self.connected = False
+        self.flush_interval = flush_interval
+        self.metrics: dict[str, Metric] = {}
+        self.series: dict[tuple[str, tuple[str, ...]], list[float]] = {}
+        self.flushed: Samples = {}
+        self.lock = Lock()
+        # held from reading the samples to recording them as flushed, so two flushes
+        # never send the same deltas
+        self.flush_lock = Lock()
+        self.resolved = Event()
+        self.stop = Event()
+        os.register_at_fork(after_in_child=self._forked)
+
+    def _forked(self):
+        # what the parent recorded is the parent's to report
+        self.lock = Lock()
+        self.flush_lock = Lock()
+        self.series = {}
+        self.flushed = {}
+        self.connected = False
+        self.resolved = Event()
+
+    def connect(self):
+        '''Starts the flusher, once per process, on first use. Redis is looked up on the
+        flusher thread, so recording never waits on it.'''
+        with self.lock:
+            if self.connected:
+                return
+            self.connected = True
+        Thread(target=self._flush_loop, daemon=True).start()
+
+    def samples(self) -> Samples:
+        with self.lock:
+            series = [(key, list(vals)) for key, vals in self.series.items()]
+        return {
+            (name, labels, part): val
+            for (name, labels), vals in series
+            for part, val in self.metrics[name].parts(vals)
+        }
+
+    def flush(self):
+        '''Adds what this process recorded since its last flush to the shared hash.'''
+        with self.flush_lock:
+            current = self.samples()
+            deltas = {key: val - self.flushed.get(key, 0) for key, val in current.items()}
+            deltas = {key: val for key, val in deltas.items() if val}
+            if deltas:
+                pipe = self.redis.pipeline(transaction=False)
+                for (name, labels, part), val in deltas.items():
+                    pipe.hincrbyfloat(REDIS_KEY, json.dumps([name, labels, part]), val)
+                pipe.execute()
+            self.flushed = current
+
+    def shared_samples(self) -> Samples:
+        samples: Samples = {}
+        for field, val in self.redis.hgetall(REDIS_KEY).items():
+            name, labels, part = json.loads(field)
+            samples[(name, tuple(labels), part)] = float(val)
+        return samples
+
+    def _flush_loop(self):
+        try:
+            self.redis = self.get_redis() if self.get_redis else None
+        finally:
+            self.resolved.set()
+        if self.redis is None:
+            return
+        while not self.stop.wait(self.flush_interval):
+            try:
+                if self.redis.exists(READER_KEY):
+                    self.flush()
+            except Exception:
+                print(traceback.format_exc(), file=sys.stderr)
+
+    def collect(self) -> str:
+        '''Prometheus text for every process sharing the Redis hash, or for this process
+        alone without Redis. Marks the metrics as read, which starts the flushing.'''
+        self.connect()
+        self.resolved.wait()
+        if self.redis is None:
+            return self.exposition(self.samples())
+        self.redis.set(READER_KEY, 1, ex=READER_TTL)
+        self.flush()
+        return self.exposition(self.shared_samples())
+
+    def exposition(self, samples: Samples) -> str:
+        series: dict[tuple[str, tuple[str, ...]], dict] = {}
+        for (name, labels, part), val in samples.items():
+            series.setdefault((name, labels), {})[part] = val
+        out = []
+        for name, metric in self.metrics.items():
+            out.append(f'# HELP {name} {metric.help}')
+            out.append(f'# TYPE {name} {metric.kind}')
+            for (series_name, labels), parts in sorted(series.items()):
+                if series_name != name:
+                    continue
+                pairs = [f'{key}="{escape(val)}"' for key, val in zip(metric.labels, labels)]
+                if isinstance(metric, Histogram):
+                    total = 0.0
+                    for i, bound in enumerate(metric.buckets + (float('inf'),)):
+                        total += parts.get(i, 0)
+                        le = 'le="+Inf"' if bound == float('inf') else f'le="{bound!r}"'
+                        out.append(f'{name}_bucket{braces(pairs + [le])} {total:g}')
+                    out.append(f'{name}_sum{braces(pairs)} {parts.get("sum", 0):g}')
+                    out.append(f'{name}_count{braces(pairs)} {parts.get("count", 0):g}')
+                else:
+                    out.append(f'{name}{braces(pairs)} {parts.get("count", 0):g}')
+        return '\n'.join(out) + '\n'
+
+
+def escape(val: str) -> str:
+    return str(val).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def braces(pairs: list[str]) -> str:
+    return f'{{{",".join(pairs)}}}' if pairs else ''
+
+def endpoint(url: str) -> str:
+    '''The Xero endpoint a URL calls, e.g. Journals for .../api.xro/2.0/Journals?offset=100.'''
+    parts = urlsplit(url).path.strip('/').split('/')
+    if len(parts) >= 3 and parts[0].endswith('.xro'):
+        return parts[2]
+    return parts[0]
+
+
+def _redis():
+    from utils.redis import redis_con
+    return redis_con
+
+registry = Registry(_redis)
+
+xero_request_seconds = Histogram(registry, 'xero_request_seconds', 'Xero API request latency.',
+    ('endpoint', 'tenant'))
+xero_rate_limited_total = Counter(registry, 'xero_rate_limited_total', 'Xero API responses with status 429.',
+    ('endpoint', 'tenant', 'problem'))
+xero_cache_total = Counter(registry, 'xero_cache_total',
+    'Cacheable Xero requests by result: hit, miss (an API call) or coalesced.', ('endpoint', 'result'))
+xero_token_refreshes_total = Counter(registry, 'xero_token_refreshes_total', 'Xero access token refreshes.')
+sync_stage_seconds = Histogram(registry, 'sync_stage_seconds', 'Time per page in each stage of a sync.',
+    ('entity', 'stage'))
+db_write_seconds = Histogram(registry, 'db_write_seconds', 'SQLite bulk write latency.', ('table',))
+db_rows_written_total = Counter(registry, 'db_rows_written_total', 'Rows written to SQLite.', ('table',))
+db_commit_seconds = Histogram(registry, 'db_commit_seconds', 'SQLite write transaction commit latency.')
@@ -0,0 +1,245 @@
+import asyncio
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date
+from time import time, perf_counter
+from typing import Callable, Any
+import aiohttp
+from .api import API_URL, MAX_RETRIES, MiscException, observe_response
+from .ratelimit import TENANT_CONCURRENT, RateLimiter, RateLimit, retry_after, MAX_WAIT
+from . import endpoints
+from utils import metrics
+
+log = logging.getLogger(__name__)
+
+
+class AsyncResponse():
+    def __init__(self, status: int, headers, body: bytes):
+        self.status_code = status
+        self.headers = headers
+        self.content = body
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+    def json(self) -> Any:
+        return json.loads(self.content)
+
+
+class AsyncXeroTokenSession():
+    '''Asyncio counterpart of XeroTokenSession.
+
+    One keep-alive connection pool is shared by every tenant using the session. Token
+    refreshes run the blocking ``token_getter`` in a thread, once for all waiting
+    requests, and 429s back off only the request that received them. Requests made
+    with a ``limiter`` take its slots, so async syncs share the per-tenant and app-wide
+    budgets with every other process using it. Its calls run on a few threads of the
+    session's own and never block there: a request waiting for a slot polls with
+    ``try_acquire`` and sleeps on the event loop in between.'''
+    client_id: str
+    client_secret: str
+    get_new_token: Callable[[], dict]
+    token: dict | None
+
+    def __init__(self, client_id: str, client_secret: str, token_getter: Callable[[], dict],
+        pool_size: int=100, tenant_concurrent: int=TENANT_CONCURRENT, max_retries: int=MAX_RETRIES,
+        limiter_threads: int=4) -> None:
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.get_new_token = token_getter
+        self.token = None
+        self.pool_size = pool_size
+        self.tenant_concurrent = tenant_concurrent
+        self.max_retries = max_retries
+        self.session: aiohttp.ClientSession | None = None
+        self.limiter_threads = limiter_threads
+        self.limiter_pool: ThreadPoolExecutor | None = None
+        self.token_lock = asyncio.Lock()
+        self.tenant_slots: dict[str, asyncio.Semaphore] = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        if self.limiter_pool is not None:
+            self.limiter_pool.shutdown(wait=False)
+            self.limiter_pool = None
+
+    def get_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    async def fetch_new_token(self, stale: dict|None=None) -> dict:
+        async with self.token_lock:
+            # another request may have refreshed while this one waited for the lock
+            if self.token is None or self.token is stale:
+                self.token = await asyncio.to_thread(self.get_new_token)
+                metrics.xero_token_refreshes_total.inc()
+            return self.token
+
+    async def get_token(self) -> dict:
+        token = self.token
+        if token is None or token['expires_at'] < time():
+            token = await self.fetch_new_token(token)
+        return token
+
+    async def in_limiter_thread(self, fn: Callable, *args) -> Any:
+        if self.limiter_pool is None:
+            self.limiter_pool = ThreadPoolExecutor(self.limiter_threads, thread_name_prefix='xero-aio-limiter')
+        return await asyncio.get_running_loop().run_in_executor(self.limiter_pool, fn, *args)
+
+    async def acquire(self, limiter: RateLimiter, tenant_id: str) -> str|None:
+        while True:
+            wait, lease = await self.in_limiter_thread(limiter.try_acquire, tenant_id)
+            if wait == 0:
+                return lease
+            # -1: all concurrent slots are taken, poll until one is released
+            await asyncio.sleep(0.05 if wait < 0 else min(wait, 1))
+
+    async def request(self, method: str, url: str, tenant_id: str|None=None, limiter: RateLimiter|None=None,
+        **kwargs) -> AsyncResponse:
+        key = tenant_id or ''
+        if key not in self.tenant_slots:
+            self.tenant_slots[key] = asyncio.Semaphore(self.tenant_concurrent)
+        slot = self.tenant_slots[key]
+        headers = kwargs.pop('headers', {})
+        refreshed = False
+        for _ in range(self.max_retries + 1):
+            token = await self.get_token()
+            headers['Authorization'] = f"Bearer {token['access_token']}"
+            log.debug('Xero %s %s %s', method.upper(), url, kwargs.get('params'))
+            async with slot:
+                lease = None
+                if limiter is not None and tenant_id is not None:
+                    lease = await self.acquire(limiter, tenant_id)
+                try:
+                    start = perf_counter()
+                    async with self.get_session().request(method, url, headers=headers, **kwargs) as resp:
+                        resp = AsyncResponse(resp.status, resp.headers, await resp.read())
+                finally:
+                    if limiter is not None and tenant_id is not None:
+                        await self.in_limiter_thread(limiter.release, tenant_id, lease)
+            observe_response(method, url, headers, resp.status_code, resp.headers, perf_counter() - start)
+            if limiter is not None and tenant_id is not None:
+                await self.in_limiter_thread(limiter.observe, tenant_id, resp.status_code, resp.headers)
+            if resp.status_code == 401 and not refreshed:
+                await self.fetch_new_token(token)
+                refreshed = True
+                continue
+            if resp.status_code != 429:
+                return resp
+            delay = retry_after(resp.headers)
+            if delay is None:
+                raise MiscException(f'headers returned {resp.headers}')
+            if limiter is not None and tenant_id is not None:
+                # the limiter holds the tenant back for the Retry-After itself
+                continue
+            if delay > MAX_WAIT:
+                raise RateLimit(f"X-Rate-Limit-Problem: {resp.headers['X-Rate-Limit-Problem']}")
+            await asyncio.sleep(delay)
+        raise RateLimit(f'still rate limited after {self.max_retries} retries: {method.upper()} {url}')
+
+def _params(params: dict) -> dict:
+    return {k: str(v).lower() if isinstance(v, bool) else v for k, v in params.items()}
+
+
+class AsyncXeroApi():
+    tenant_id: str | None
+    ts: AsyncXeroTokenSession
+    limiter: RateLimiter | None
+    base_url: str
+
+    def __init__(self, token_session: AsyncXeroTokenSession, tenant_id: str|None=None,
+        limiter: RateLimiter|None=None, base_url: str=API_URL) -> None:
+        self.ts = token_session
+        self.tenant_id = tenant_id
+        self.limiter = limiter
+        self.base_url = base_url
+
+    async def request(self, method: str, url: str, **kwargs) -> AsyncResponse:
+        if self.tenant_id is None:
+            raise Exception('tenant_id not set')
+        kwargs['headers'] = dict(kwargs.get('headers') or {})
+        kwargs['headers']['Xero-tenant-id'] = self.tenant_id
+        kwargs['headers'].setdefault('Accept', 'application/json')
+        if 'params' in kwargs:
+            kwargs['params'] = _params(kwargs['params'])
+        return await self.ts.request(method, url, tenant_id=self.tenant_id, limiter=self.limiter, **kwargs)
+
+    async def get(self, url, **kwargs) -> AsyncResponse:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs) -> AsyncResponse:
+        return await self.request("POST", url, **kwargs)
+
+    async def put(self, url, **kwargs) -> AsyncResponse:
+        return await self.request("PUT", url, **kwargs)
+
+    async def delete(self, url, **kwargs) -> AsyncResponse:
+        return await self.request("DELETE", url, **kwargs)
+
+    async def get_connections(self) -> list[dict]:
+        '''https://developer.xero.com/documentation/guides/oauth2/auth-flow/#5-check-the-tenants-youre-authorized-to-access'''
+        resp = await self.ts.request('GET', f'{self.base_url}/connections')
+        return resp.json()
+
+    async def fetch(self, call: endpoints.Call) -> list[dict]:
+        resp = await self.get(call.url(self.base_url), params=call.params, headers=call.headers)
+        return resp.json()[call.key]
+
+    async def get_journals(self, offset:int|None=None, modified_after: datetime|None=None, paymentsOnly=False) -> list[dict]:
+        return await self.fetch(endpoints.journals(offset, modified_after, paymentsOnly))
+
+    async def get_organisations(self) -> list[dict]:
+        return await self.fetch(endpoints.organisations())
+
+    async def get_invoices(self, modified_after: datetime|None=None, where: str|None=None, page:int|None=None,
+         summaryOnly:bool=False, order: str|None=None) -> list[dict]:
+        return await self.fetch(endpoints.invoices(modified_after, where, page, summaryOnly, order))
+
+    async def get_invoice(self, invoice_id: str) -> list[dict]:
+        return await self.fetch(endpoints.invoice(invoice_id))
+
+    async def get_accounts(self, modified_after: datetime|None=None, where: str|None=None, order: str|None=None) -> list[dict]:
+        return await self.fetch(endpoints.accounts(modified_after, where, order))
+
+    async def get_tracking_categories(self, where: str|None=None, order: str|None=None, includeArchived: bool=False) -> list[dict]:
+        return await self.fetch(endpoints.tracking_categories(where, order, includeArchived))
+
+    async def get_trial_balance(self, at_date: date|str|None=None, paymentsOnly: bool=False) -> list[dict]:
+        return await self.fetch(endpoints.trial_balance(at_date, paymentsOnly))
+
+    async def get_contacts(self, modified_after: datetime|None=None, where: str|None=None, order: str|None=None,
+        includeArchived: bool=False, page:int|None=None) -> list[dict]:
+        return await self.fetch(endpoints.contacts(modified_after, where, order, includeArchived, page))
+
+    async def get_bank_transactions(self, modified_after: datetime|None=None, where: str|None=None,
+        order: str|None=None, page:int|None=None) -> list[dict]:
+        return await self.fetch(endpoints.bank_transactions(modified_after, where, order, page))
+
+    async def get_assets(self, page: int, page_size: int=200, status: str|None=None, filter_by: str|None=None, order_by: str|None=None):
+        return await self.fetch(endpoints.assets(page, page_size, status, filter_by, order_by))
+
+    async def get_manual_journals(self, modified_after: datetime|None=None, where: str|None=None,
+        order: str|None=None, page:int|None=None):
+        return await self.fetch(endpoints.manual_journals(modified_after, where, order, page))
+
+    async def get_credit_notes(self, modified_after: datetime|None=None, where: str|None=None,
+        order: str|None=None, page:int|None=None):
+        return await self.fetch(endpoints.credit_notes(modified_after, where, order, page))
+
+    async def get_credit_note(self, credit_note_id: str):
+        return await self.fetch(endpoints.credit_note(credit_note_id))
+
+    async def update_manual_journal(self, manjournal_id: str, payload: dict):
+        return await self.post(endpoints.manual_journal(manjournal_id).url(self.base_url), json=payload)
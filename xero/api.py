@@ -1,21 +1,38 @@
 import logging
+import weakref
 from requests import Response
 from oauthlib.oauth2 import TokenExpiredError
-from time import sleep,  time
+from time import sleep, time, perf_counter
 from datetime import datetime, date
-from typing import Callable, Any
+from typing import Callable, Iterator
 from requests_oauthlib import OAuth2Session
+from .ratelimit import RateLimiter, RateLimit, retry_after, MAX_WAIT
+from .stream import iter_json_array
+from .paging import PageIterator, JournalIterator
+from .ratelimit import TENANT_CONCURRENT
+from .cache import ResponseCache
+from .archive import ResponseArchive
+from . import endpoints
+from utils import metrics
 
 log = logging.getLogger(__name__)
 
-def xero_date_fmt(dt: datetime) -> str:
-    return dt.strftime('%Y-%m-%dT%H:%M:%S')
+API_URL = 'https://api.xero.com'
+MAX_RETRIES = 5
+STREAM_CHUNK_SIZE = 1 << 16
+
+Records = list[dict] | Iterator[dict]
 
 class MiscException(Exception):
     pass
 
-class RateLimit(Exception):
-    pass
+def observe_response(method: str, url: str, headers: dict|None, status_code: int, resp_headers, seconds: float):
+    endpoint = metrics.endpoint(url)
+    tenant = (headers or {}).get('Xero-tenant-id', '')
+    log.debug('%s %s %s in %.3fs', status_code, method.upper(), endpoint, seconds)
+    metrics.xero_request_seconds.observe(seconds, endpoint, tenant)
+    if status_code == 429:
+        metrics.xero_rate_limited_total.inc(endpoint, tenant, resp_headers.get('X-Rate-Limit-Problem', ''))
 
 class XeroTokenSession():
     client_id: str
@@ -23,52 +40,73 @@ class XeroTokenSession():
     get_new_token: Callable[[], dict]
     token: dict
 
-    def __init__(self, client_id: str, client_secret: str, token_getter: Callable[[], dict]) -> None:
+    def __init__(self, client_id: str, client_secret: str, token_getter: Callable[[], dict],
+        max_retries: int=MAX_RETRIES) -> None:
         self.client_id = client_id
         self.client_secret = client_secret
         self.get_new_token = token_getter
+        self.max_retries = max_retries
         self.token = token_getter()
         self.session = OAuth2Session(self.client_id, token=self.token)
 
     def fetch_new_token(self) -> None:
         self.token = self.get_new_token()
         self.session.token = self.token
-        
-    def request(self, method: str, url: str, *args, **kwargs ) -> Response:
+        metrics.xero_token_refreshes_total.inc()
+
+    def send(self, method: str, url: str, *args, **kwargs) -> Response:
+        '''One attempt at the request, refreshing the token if needed. 429s are returned.'''
         if self.token['expires_at'] < time():
             self.fetch_new_token()
+        log.debug('Xero %s %s %s', method.upper(), url, kwargs.get('params'))
+        start = perf_counter()
         try:
-            log.debug(f'Xero {method.upper()} {args=}, {kwargs=}')
             resp = self.session.request(method, url, *args, **kwargs)
-            log.debug(resp.status_code)
-            log.debug(resp.text)
         except TokenExpiredError:
             self.fetch_new_token()
+            start = perf_counter()
             resp = self.session.request(method, url, *args, **kwargs)
-            log.debug(resp.status_code)
-            log.debug(resp.text)
-        if resp.status_code == 429:
-            problem = resp.headers.get('X-Rate-Limit-Problem')
-            if problem is None:
-                raise MiscException(f'headers returned {resp.headers}')
-            if problem == 'minute':
-                retry_time = int(resp.headers['Retry-After'])
-                sleep(retry_time)
-            elif problem == 'concurrent':
-                sleep(1)
-            else:
-                raise RateLimit(f'X-Rate-Limit-Problem: {problem}')
-            return self.request(method, url, *args, **kwargs)
+        observe_response(method, url, kwargs.get('headers'), resp.status_code, resp.headers, perf_counter() - start)
         return resp
 
+    def request(self, method: str, url: str, *args, **kwargs ) -> Response:
+        for _ in range(self.max_retries + 1):
+            resp = self.send(method, url, *args, **kwargs)
+            if resp.status_code != 429:
+                return resp
+            delay = retry_after(resp.headers)
+            if delay is None:
+                raise MiscException(f'headers returned {resp.headers}')
+            if delay > MAX_WAIT:
+                raise RateLimit(f"X-Rate-Limit-Problem: {resp.headers['X-Rate-Limit-Problem']}")
+            resp.close()
+            sleep(delay)
+        raise RateLimit(f'still rate limited after {self.max_retries} retries: {method.upper()} {url}')
+
 
 class XeroApi():
     tenant_id: str | None
     ts: XeroTokenSession
-
-    def __init__(self, token_session: XeroTokenSession, tenant_id: str|None=None) -> None:
+    limiter: RateLimiter | None
+    base_url: str
+    stream: bool
+    cache: ResponseCache | None
+    archive: ResponseArchive | None
+
+    def __init__(self, token_session: XeroTokenSession, tenant_id: str|None=None, limiter: RateLimiter|None=None,
+        base_url: str=API_URL, stream: bool=False, cache: ResponseCache|None=None,
+        archive: ResponseArchive|None=None) -> None:
+        '''With ``stream`` set, the ``get_*`` methods return iterators that decode records
+        as the response body arrives instead of lists. With a ``cache``, the organisation,
+        accounts, tracking categories and trial balance are served from it when fresh.
+        With an ``archive``, every page of records fetched is also stored there raw.'''
         self.ts = token_session
         self.tenant_id = tenant_id
+        self.limiter = limiter
+        self.base_url = base_url
+        self.stream = stream
+        self.cache = cache
+        self.archive = archive
         return
 
     def request(self, method: str, url: str, *args, **kwargs ) -> Response:
@@ -79,12 +117,64 @@ class XeroApi():
         else:
             kwargs['headers'] = {'Xero-tenant-id': self.tenant_id}
         kwargs['headers'].setdefault('Accept', 'application/json')
-        return self.ts.request(method, url, *args, **kwargs)
+        if self.limiter is None:
+            return self.ts.request(method, url, *args, **kwargs)
+        # the limiter paces retries itself, from the headers of each response
+        for _ in range(self.ts.max_retries + 1):
+            lease = self.limiter.acquire(self.tenant_id)
+            try:
+                resp = self.ts.send(method, url, *args, **kwargs)
+            except BaseException:
+                self.limiter.release(self.tenant_id, lease)
+                raise
+            if kwargs.get('stream') and resp.status_code != 429:
+                # the body is still being read: the connection keeps its slot until the
+                # response is closed, or collected if it never is
+                resp.release_slot = weakref.finalize(resp, self.limiter.release, self.tenant_id, lease) # type: ignore
+            else:
+                self.limiter.release(self.tenant_id, lease)
+            self.limiter.observe(self.tenant_id, resp.status_code, resp.headers)
+            if resp.status_code != 429:
+                return resp
+            if retry_after(resp.headers) is None:
+                raise MiscException(f'headers returned {resp.headers}')
+            resp.close()
+        raise RateLimit(f'still rate limited after {self.ts.max_retries} retries: {method.upper()} {url}')
 
     def get(self, url, *args, **kwargs) -> Response:
         kwargs.setdefault("allow_redirects", True)
+        kwargs.setdefault("stream", self.stream)
         return self.request("GET", url, *args, **kwargs)
 
+    def cached(self, endpoint: str, params: dict, fetch: Callable[[], Records]) -> Records:
+        if self.cache is None or self.tenant_id is None:
+            return fetch()
+        return self.cache.get(self.tenant_id, endpoint, params, fetch)
+
+    def records(self, resp: Response, key: str) -> Records:
+        if not self.stream:
+            if self.archive is not None and resp.status_code == 200:
+                self.archive.put_response(self.tenant_id, resp)
+            return resp.json()[key]
+        return self._iter_records(resp, key)
+
+    def _iter_records(self, resp: Response, key: str) -> Iterator[dict]:
+        try:
+            chunks = resp.iter_content(STREAM_CHUNK_SIZE)
+            if self.archive is None or resp.status_code != 200:
+                yield from iter_json_array(chunks, key)
+                return
+            chunks = self.archive.tee(self.tenant_id, resp, chunks)
+            yield from iter_json_array(chunks, key)
+            # the rest of the body, so the archive has all of it
+            for _ in chunks:
+                pass
+        finally:
+            resp.close()
+            release_slot = getattr(resp, 'release_slot', None)
+            if release_slot is not None:
+                release_slot()
+
     def options(self, url, *args, **kwargs) -> Response:
         kwargs.setdefault("allow_redirects", True)
         return self.request("OPTIONS", url, *args, **kwargs)
@@ -106,172 +196,106 @@ class XeroApi():
     def delete(self, url, *args, **kwargs) -> Response:
         return self.request("DELETE", url, *args, **kwargs)
 
+    def page_workers(self) -> int:
+        return self.limiter.tenant_concurrent if self.limiter else TENANT_CONCURRENT
+
+    def iter_journals(self, offset: int=0, paymentsOnly=False, workers: int|None=None) -> JournalIterator:
+        return JournalIterator(lambda o: self.get_journals(o, paymentsOnly=paymentsOnly), offset,
+            workers or self.page_workers())
+
+    def iter_invoices(self, start_page: int=1, workers: int|None=None, **kwargs) -> PageIterator:
+        return PageIterator(lambda page: self.get_invoices(page=page, **kwargs), start_page, workers or self.page_workers())
+
+    def iter_contacts(self, start_page: int=1, workers: int|None=None, **kwargs) -> PageIterator:
+        return PageIterator(lambda page: self.get_contacts(page=page, **kwargs), start_page, workers or self.page_workers())
+
+    def iter_bank_transactions(self, start_page: int=1, workers: int|None=None, **kwargs) -> PageIterator:
+        return PageIterator(lambda page: self.get_bank_transactions(page=page, **kwargs), start_page,
+            workers or self.page_workers())
+
+    def iter_manual_journals(self, start_page: int=1, workers: int|None=None, **kwargs) -> PageIterator:
+        return PageIterator(lambda page: self.get_manual_journals(page=page, **kwargs), start_page,
+            workers or self.page_workers())
+
+    def iter_credit_notes(self, start_page: int=1, workers: int|None=None, **kwargs) -> PageIterator:
+        return PageIterator(lambda page: self.get_credit_notes(page=page, **kwargs), start_page,
+            workers or self.page_workers())
+
+    def iter_assets(self, start_page: int=1, workers: int|None=None, page_size: int=200, **kwargs) -> PageIterator:
+        return PageIterator(lambda page: self.get_assets(page, page_size=page_size, **kwargs), start_page,
+            workers or self.page_workers(), page_size)
+
     def get_connections(self) -> list[dict]:
         '''https://developer.xero.com/documentation/guides/oauth2/auth-flow/#5-check-the-tenants-youre-authorized-to-access'''
         try:
-            resp = self.ts.session.get('https://api.xero.com/connections')
+            resp = self.ts.session.get(f'{self.base_url}/connections')
         except TokenExpiredError:
             self.ts.fetch_new_token()
-            resp = self.ts.session.get('https://api.xero.com/connections')
+            resp = self.ts.session.get(f'{self.base_url}/connections')
         return resp.json()
 
     def remove_tenant(self):
         '''https://developer.xero.com/documentation/guides/oauth2/auth-flow/#removing-connections'''
         try:
-            resp = self.ts.session.get(f'https://api.xero.com/connections/{self.tenant_id}')
+            resp = self.ts.session.get(f'{self.base_url}/connections/{self.tenant_id}')
         except TokenExpiredError:
             self.ts.fetch_new_token()
-            resp = self.ts.session.get(f'https://api.xero.com/connections/{self.tenant_id}')
+            resp = self.ts.session.get(f'{self.base_url}/connections/{self.tenant_id}')
         return resp.ok
 
-    def get_journals(self, offset:int|None=None, modified_after: datetime|None=None, paymentsOnly=False) -> list[dict]:
-        '''https://developer.xero.com/documentation/api/accounting/journals'''
-        url = 'https://api.xero.com/api.xro/2.0/Journals'
-        params = {}
-        headers = {}
-        if modified_after:
-            headers['If-Modified-Since'] = modified_after.strftime('%Y-%m-%dT%H:%M:%S')
-        if offset:
-            params['offset'] = offset
-        if paymentsOnly:
-            params['paymentsOnly'] = True
-        resp  = self.get(url, params=params, headers=headers)
-        return resp.json()['Journals']
-
-    def get_organisations(self) -> list[dict]:
-        '''https://developer.xero.com/documentation/api/accounting/organisation'''
-        url = 'https://api.xero.com/api.xro/2.0/Organisation'
-        resp  = self.get(url)
-        return resp.json()['Organisations']
+    def fetch(self, call: endpoints.Call) -> Records:
+        return self.records(self.get(call.url(self.base_url), params=call.params, headers=dict(call.headers)), call.key)
+
+    def get_journals(self, offset:int|None=None, modified_after: datetime|None=None, paymentsOnly=False) -> Records:
+        return self.fetch(endpoints.journals(offset, modified_after, paymentsOnly))
+
+    def get_organisations(self) -> Records:
+        call = endpoints.organisations()
+        return self.cached(call.endpoint, call.params, lambda: self.fetch(call))
 
     def get_invoices(self, modified_after: datetime|None=None, where: str|None=None, page:int|None=None,
-         summaryOnly:bool=False, order: str|None=None) -> list[dict]:
-        '''https://developer.xero.com/documentation/api/accounting/invoices'''
-        url = 'https://api.xero.com/api.xro/2.0/Invoices'
-        headers = {}
-        params = {}
+         summaryOnly:bool=False, order: str|None=None) -> Records:
+        return self.fetch(endpoints.invoices(modified_after, where, page, summaryOnly, order))
+
+    def get_invoice(self, invoice_id: str) -> Records:
+        return self.fetch(endpoints.invoice(invoice_id))
+
+    def get_accounts(self, modified_after: datetime|None=None, where: str|None=None, order: str|None=None) -> Records:
+        call = endpoints.accounts(modified_after, where, order)
         if modified_after:
-            headers['If-Modified-Since'] = xero_date_fmt(modified_after)
-        if where:
-            params['where'] = where
-        if page:
-            params['page'] = page
-        if summaryOnly:
-            params['summaryOnly'] = summaryOnly
-        if order:
-            params['order'] = order
-        resp  = self.get(url, params=params, headers=headers)
-        return resp.json()['Invoices']
-
-    def get_invoice(self, invoice_id: str) -> list[dict]:
-        '''https://developer.xero.com/documentation/api/accounting/invoices'''
-        url = f'https://api.xero.com/api.xro/2.0/Invoices/{invoice_id}'
-        resp  = self.get(url)
-        return resp.json()['Invoices']
-
-    def get_accounts(self, modified_after: datetime|None=None, where: str|None=None, order: str|None=None) -> list[dict]:
-        '''https://developer.xero.com/documentation/api/accounting/accounts'''
-        url = 'https://api.xero.com/api.xro/2.0/Accounts'
-        headers = {}
-        params = {}
-        if modified_after: headers['If-Modified-Since'] = xero_date_fmt(modified_after)
-        if where: params['where'] = where
-        if order: params['order'] = order
-        resp  = self.get(url, params=params, headers=headers)
-        return resp.json()['Accounts']
-
-    def get_tracking_categories(self, where: str|None=None, order: str|None=None, includeArchived: bool=False) -> list[dict]:
-        '''https://developer.xero.com/documentation/api/accounting/trackingcategories'''
-        url = 'https://api.xero.com/api.xro/2.0/TrackingCategories'
-        params = {}
-        if where: params['where'] = where
-        if order: params['order'] = order
-        if includeArchived: params['includeArchived'] = includeArchived
-        resp  = self.get(url, params=params)
-        return resp.json()['TrackingCategories']
-
-    def get_trial_balance(self, at_date: date|str|None=None, paymentsOnly: bool=False) -> list[dict]:
-        '''https://developer.xero.com/documentation/api/accounting/reports/#trial-balance'''
-        url = 'https://api.xero.com/api.xro/2.0/Reports/TrialBalance'
-        params = {}
-        if type(at_date) is str:
-            params['date'] = at_date
-        elif type(at_date) is date:
-            params['date'] = at_date.strftime('%Y-%m-%d')
-        if paymentsOnly: params['paymentsOnly'] = paymentsOnly # type: ignore
-        resp  = self.get(url, params=params)
-        return resp.json()['Reports']
+            # a delta sync wants what changed now, not what was cached
+            return self.fetch(call)
+        return self.cached(call.endpoint, call.params, lambda: self.fetch(call))
+
+    def get_tracking_categories(self, where: str|None=None, order: str|None=None, includeArchived: bool=False) -> Records:
+        call = endpoints.tracking_categories(where, order, includeArchived)
+        return self.cached(call.endpoint, call.params, lambda: self.fetch(call))
+
+    def get_trial_balance(self, at_date: date|str|None=None, paymentsOnly: bool=False) -> Records:
+        call = endpoints.trial_balance(at_date, paymentsOnly)
+        return self.cached(call.endpoint, call.params, lambda: self.fetch(call))
 
     def get_contacts(self, modified_after: datetime|None=None, where: str|None=None, order: str|None=None,
-        includeArchived: bool=False, page:int|None=None) -> list[dict]:
-        '''https://developer.xero.com/documentation/api/accounting/contacts/#get-contacts'''
-        url = 'https://api.xero.com/api.xro/2.0/Contacts'
-        headers = {}
-        params = {}
-        if modified_after: headers['If-Modified-Since'] = xero_date_fmt(modified_after)
-        if where: params['where'] = where
-        if order: params['order'] = order
-        if includeArchived: params['includeArchived'] = includeArchived
-        if page: params['page'] = page
-        resp  = self.get(url, params=params, headers=headers)
-        return resp.json()['Contacts']
+        includeArchived: bool=False, page:int|None=None) -> Records:
+        return self.fetch(endpoints.contacts(modified_after, where, order, includeArchived, page))
 
     def get_bank_transactions(self, modified_after: datetime|None=None, where: str|None=None,
-        order: str|None=None, page:int|None=None) -> list[dict]:
-        '''https://developer.xero.com/documentation/api/accounting/banktransactions'''
-        url = 'https://api.xero.com/api.xro/2.0/BankTransactions'
-        headers = {}
-        params = {}
-        if modified_after: headers['If-Modified-Since'] = xero_date_fmt(modified_after)
-        if where: params['where'] = where
-        if order: params['order'] = order
-        if page: params['page'] = page
-        resp  = self.get(url, params=params, headers=headers)
-        return resp.json()['BankTransactions']
-
-    def get_assets(self, page: int, page_size: int=200, status: str|None=None, filter_by: str|None=None, order_by: str|None=None):
-        '''https://developer.xero.com/documentation/api/assets/assets'''
-        url = 'https://api.xero.com/assets.xro/1.0/Assets'
-        params: dict[str, Any] = {"page": page, "pageSize": page_size}
-        if filter_by: params['filterBy'] = filter_by
-        if order_by: params['orderBy'] = order_by
-        if status: params['status'] = status
-        resp  = self.get(url, params=params)
-        return resp.json()['items']
+        order: str|None=None, page:int|None=None) -> Records:
+        return self.fetch(endpoints.bank_transactions(modified_after, where, order, page))
+
+    def get_assets(self, page: int, page_size: int=200, status: str|None=None, filter_by: str|None=None, order_by: str|None=None) -> Records:
+        return self.fetch(endpoints.assets(page, page_size, status, filter_by, order_by))
 
     def get_manual_journals(self, modified_after: datetime|None=None, where: str|None=None,
-        order: str|None=None, page:int|None=None):
-        '''https://developer.xero.com/documentation/api/accounting/manualjournals/#overview'''
-        url = 'https://api.xero.com/api.xro/2.0/ManualJournals'
-        headers = {}
-        params = {}
-        if modified_after: headers['If-Modified-Since'] = xero_date_fmt(modified_after)
-        if where: params['where'] = where
-        if order: params['order'] = order
-        if page: params['page'] = page
-        resp =  self.get(url, params=params, headers=headers)
-        return resp.json()['ManualJournals']
+        order: str|None=None, page:int|None=None) -> Records:
+        return self.fetch(endpoints.manual_journals(modified_after, where, order, page))
 
     def get_credit_notes(self, modified_after: datetime|None=None, where: str|None=None,
-        order: str|None=None, page:int|None=None):
-        '''https://developer.xero.com/documentation/api/accounting/creditnotes/#get-creditnotes'''
-        url = 'https://api.xero.com/api.xro/2.0/CreditNotes'
-        headers = {}
-        params = {}
-        if modified_after: headers['If-Modified-Since'] = xero_date_fmt(modified_after)
-        if where: params['where'] = where
-        if order: params['order'] = order
-        if page: params['page'] = page
-        resp =  self.get(url, params=params, headers=headers)
-        return resp.json()['CreditNotes']
-
-    def get_credit_note(self, credit_note_id: str):
-        '''https://developer.xero.com/documentation/api/accounting/creditnotes/#get-creditnotes'''
-        url = f'https://api.xero.com/api.xro/2.0/CreditNotes/{credit_note_id}'
-        resp =  self.get(url)
-        return resp.json()['CreditNotes']
+        order: str|None=None, page:int|None=None) -> Records:
+        return self.fetch(endpoints.credit_notes(modified_after, where, order, page))
+
+    def get_credit_note(self, credit_note_id: str) -> Records:
+        return self.fetch(endpoints.credit_note(credit_note_id))
 
     def update_manual_journal(self, manjournal_id: str, payload: dict):
-        '''https://developer.xero.com/documentation/api/accounting/manualjournals/#overview'''
-        url = f'https://api.xero.com/api.xro/2.0/ManualJournals/{manjournal_id}'
-        return self.post(url, json=payload)
+        return self.post(endpoints.manual_journal(manjournal_id).url(self.base_url), json=payload)
@@ -0,0 +1,286 @@
+'''Raw Xero responses kept on disk, so the parsers and writers can be re-run over a
+tenant's history without spending API quota on fetching it again.
+
+Each response body is compressed and stored once, named by the SHA-256 of its bytes,
+under ``objects/``. ``index.db`` maps (TenantID, Endpoint, Cursor) to the body last
+fetched for it. The cursor is the request's query string plus any If-Modified-Since,
+so the third page of journals is 'offset=200'. ``XeroApi(archive=...)`` records into
+an archive; ``replay`` reads it back and the bench stand-in can serve it.
+
+    python -m xero.archive <archive_dir> <tenant_id> [<endpoint>]
+    python -m xero.archive <archive_dir> <tenant_id> replay [--workers 4]
+'''
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import zlib
+from collections import deque
+from contextlib import closing
+from concurrent.futures import ProcessPoolExecutor, Future
+from multiprocessing import get_context
+from datetime import datetime, timezone
+from time import perf_counter
+from typing import Iterable, Iterator
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+LEVEL = 6
+# pages parsed ahead of the writer, per worker
+READ_AHEAD = 2
+
+def endpoint_path(url: str) -> str:
+    '''The endpoint a URL calls with anything after it, e.g. Journals or Invoices/<id>.'''
+    parts = urlsplit(url).path.strip('/').split('/')
+    if len(parts) >= 3 and parts[0].endswith('.xro'):
+        return '/'.join(parts[2:])
+    return '/'.join(parts)
+
+def cursor_key(params: Iterable[tuple[str, str]], modified_since: str|None=None) -> str:
+    '''The request's query, in a fixed order, and its If-Modified-Since.'''
+    pairs = sorted(params)
+    if modified_since:
+        pairs.append(('If-Modified-Since', modified_since))
+    return urlencode(pairs)
+
+def position(params: Iterable[tuple[str, str]]) -> int:
+    '''Where a page falls in its endpoint: the offset or page number.'''
+    query = dict(params)
+    return int(query.get('offset') or query.get('page') or 0)
+
+def journals_cursor(offset: int) -> str:
+    '''The cursor of a journals page as the sync fetches it: by offset alone, without
+    paymentsOnly or If-Modified-Since.'''
+    return cursor_key([('offset', str(offset))] if offset else [])
+
+def object_path(root: str, digest: str) -> str:
+    return os.path.join(root, 'objects', digest[:2], digest[2:])
+
+def read_object(root: str, digest: str) -> bytes:
+    with open(object_path(root, digest), 'rb') as f:
+        return zlib.decompress(f.read())
+
+
+class ResponseArchive():
+    '''A directory of compressed, content-addressed response bodies with an index. Safe
+    to share between threads and processes: objects are written under a temporary name
+    and renamed into place, and the index is SQLite.'''
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        with closing(self.index()) as con, con:
+            con.execute("PRAGMA journal_mode=WAL;")
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS responses(TenantID text not null, Endpoint text not null, "
+                "Cursor text not null, Position integer not null, Digest text not null, Bytes integer not null, "
+                "FetchedUTC datetime not null, primary key(TenantID, Endpoint, Cursor)) without rowid;"
+            )
+
+    def index(self) -> sqlite3.Connection:
+        return sqlite3.connect(os.path.join(self.root, 'index.db'), timeout=30)
+
+    def put_object(self, body: bytes) -> str:
+        digest = hashlib.sha256(body).hexdigest()
+        path = object_path(self.root, digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f'{path}.{os.getpid()}.{id(body)}.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(zlib.compress(body, LEVEL))
+            os.replace(tmp, path)
+        return digest
+
+    def read_object(self, digest: str) -> bytes:
+        return read_object(self.root, digest)
+
+    def put(self, tenant_id: str, endpoint: str, params: Iterable[tuple[str, str]], body: bytes,
+        modified_since: str|None=None) -> str:
+        '''Stores a response body as the latest for its request. Returns its digest.'''
+        params = list(params)
+        digest = self.put_object(body)
+        with closing(self.index()) as con, con:
+            con.execute(
+                "INSERT OR REPLACE INTO responses(TenantID, Endpoint, Cursor, Position, Digest, Bytes, FetchedUTC) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?);",
+                (tenant_id, endpoint, cursor_key(params, modified_since), position(params), digest, len(body),
+                    str(datetime.now(timezone.utc))),
+            )
+        return digest
+
+    def put_response(self, tenant_id: str, resp, body: bytes|None=None) -> str:
+        '''Stores a ``requests`` response, its body read already or given as ``body``.'''
+        request = resp.request
+        return self.put(tenant_id, endpoint_path(request.url), parse_qsl(urlsplit(request.url).query),
+            resp.content if body is None else body, request.headers.get('If-Modified-Since'))
+
+    def tee(self, tenant_id: str, resp, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        '''Passes a streamed body through, storing it once it has all been read.'''
+        body = bytearray()
+        for chunk in chunks:
+            body += chunk
+            yield chunk
+        self.put_response(tenant_id, resp, bytes(body))
+
+    def get(self, tenant_id: str, endpoint: str, cursor: str) -> bytes|None:
+        with closing(self.index()) as con:
+            first = con.execute(
+                "SELECT Digest FROM responses WHERE TenantID = ? AND Endpoint = ? AND Cursor = ?;",
+                (tenant_id, endpoint, cursor),
+            ).fetchone()
+        return self.read_object(first[0]) if first else None
+
+    def entries(self, tenant_id: str, endpoint: str|None=None) -> list[dict]:
+        '''Index rows for the tenant, in page order within each endpoint, oldest fetch first.'''
+        stmt = "SELECT Endpoint, Cursor, Position, Digest, Bytes, FetchedUTC FROM responses WHERE TenantID = ?"
+        params = [tenant_id]
+        if endpoint is not None:
+            stmt += " AND Endpoint = ?"
+            params.append(endpoint)
+        with closing(self.index()) as con:
+            cursor = con.execute(stmt + " ORDER BY Endpoint, Position, FetchedUTC;", params)
+            cols = [col[0] for col in cursor.description]
+            return [dict(zip(cols, row)) for row in cursor]
+
+
+def _parse_journals(root: str, digest: str, money_scale: int):
+    from .parser import JournalsParser
+    body = read_object(root, digest)
+    return JournalsParser(json.loads(body)['Journals'], money_scale=money_scale)
+
+def parsed_pages(archive: ResponseArchive, digests: list[str], money_scale: int, workers: int) -> Iterator:
+    '''JournalsParsers for the archived pages in order, parsed in ``workers`` processes
+    with a bounded number read ahead, or in this one with a single worker.'''
+    if workers <= 1:
+        for digest in digests:
+            yield _parse_journals(archive.root, digest, money_scale)
+        return
+    with ProcessPoolExecutor(workers, mp_context=get_context('spawn')) as pool:
+        pending: deque[Future] = deque()
+        todo = iter(digests)
+        for digest in todo:
+            pending.append(pool.submit(_parse_journals, archive.root, digest, money_scale))
+            if len(pending) >= workers * READ_AHEAD:
+                break
+        while pending:
+            yield pending.popleft().result()
+            for digest in todo:
+                pending.append(pool.submit(_parse_journals, archive.root, digest, money_scale))
+                break
+
+def replay_journals(tenant_id: str, archive: ResponseArchive, workers: int=1) -> int:
+    '''Re-parses and rewrites the tenant's stored journals from the archive. Only journals
+    up to the sync checkpoint are kept, so replay never moves the checkpoint; newer ones
+    come from the next sync. Holds the tenant's sync claim throughout (see
+    ``jobs.claim_tenant``). ``workers`` parse processes pay off only with spare cores.
+    Returns the number of journal lines written.'''
+    from .jobs import claim_tenant
+    with claim_tenant(tenant_id):
+        return _replay_journals(tenant_id, archive, workers)
+
+def _replay_journals(tenant_id: str, archive: ResponseArchive, workers: int) -> int:
+    from sql import tenant_writer
+    from sql.writer import transaction, drop_indexes, restore_indexes
+    from .updater import JournalUpdater
+    updater = JournalUpdater(tenant_id, None) # type: ignore
+    checkpoint = updater.resume_offset()
+    # other fetches of the endpoint share its positions but not its pages
+    pages = [entry['Digest'] for entry in archive.entries(tenant_id, 'Journals')
+        if entry['Position'] < checkpoint and entry['Cursor'] == journals_cursor(entry['Position'])]
+    lines = 0
+    with tenant_writer(tenant_id) as con:
+        drop_indexes(con, updater.tables)
+    try:
+        for parser in parsed_pages(archive, pages, updater.money_scale, workers):
+            with tenant_writer(tenant_id) as con, transaction(con):
+                updater.write_page(con, parser, search=False)
+                # an interrupted replay must not leave the checkpoint behind the stored journals
+                updater.set_checkpoint(con, checkpoint)
+            lines += len(parser.journal_lines)
+        with tenant_writer(tenant_id) as con, transaction(con):
+            updater.trim(con, checkpoint)
+    finally:
+        with tenant_writer(tenant_id) as con:
+            restore_indexes(con)
+    return lines
+
+def replay_entities(tenant_id: str, archive: ResponseArchive) -> dict[str, int]:
+    '''Rewrites the synced entities from their archived pages, oldest fetch first so the
+    latest version of a record wins. Their checkpoints are left as they were.'''
+    from .jobs import claim_tenant
+    with claim_tenant(tenant_id):
+        return _replay_entities(tenant_id, archive)
+
+def _replay_entities(tenant_id: str, archive: ResponseArchive) -> dict[str, int]:
+    from sql import tenant_writer, create_entity_tables
+    from sql.writer import transaction
+    from .updater import ENTITY_UPDATERS, set_checkpoint, get_checkpoint
+    create_entity_tables(tenant_id)
+    written = {}
+    for entity, updater_class in ENTITY_UPDATERS.items():
+        entries = sorted(archive.entries(tenant_id, entity), key=lambda entry: (entry['FetchedUTC'], entry['Position']))
+        if not entries:
+            continue
+        updater = updater_class(tenant_id, None) # type: ignore
+        before = get_checkpoint(tenant_id, updater.checkpoint_entity)
+        written[entity] = 0
+        with tenant_writer(tenant_id) as con, transaction(con):
+            for entry in entries:
+                parser = updater.parser(json.loads(archive.read_object(entry['Digest']))[entity])
+                updater.write_page(con, parser)
+                written[entity] += len(parser.rows)
+            if before is not None:
+                set_checkpoint(con, updater.checkpoint_entity, before)
+    return written
+
+def replay(tenant_id: str, archive: ResponseArchive, workers: int=1) -> dict:
+    '''Rebuilds the tenant's synced tables from the archive, then everything derived
+    from the journals, holding the tenant's sync claim throughout. Raises RuntimeError
+    while a sync of the tenant is running.'''
+    from .jobs import claim_tenant
+    with claim_tenant(tenant_id):
+        return _replay(tenant_id, archive, workers)
+
+def _replay(tenant_id: str, archive: ResponseArchive, workers: int) -> dict:
+    from sql import tenant_writer
+    from recon.tracking import rebuild_tracking
+    from recon.search import rebuild_search_index
+    from recon.balance_index import rebuild_balance_index
+    from recon.balances import rebuild_balances
+    from .cache import invalidate
+    start = perf_counter()
+    entities = _replay_entities(tenant_id, archive)
+    entities_done = perf_counter()
+    lines = _replay_journals(tenant_id, archive, workers)
+    journals_done = perf_counter()
+    rebuild_tracking(tenant_id)
+    rebuild_search_index(tenant_id)
+    rebuild_balance_index(tenant_id)
+    with tenant_writer(tenant_id) as con, con:
+        # computed from journals that may have parsed differently
+        con.execute("DELETE FROM trial_balances;")
+        accounts = [row[0] for row in con.execute("SELECT AccountID FROM recon_settings;")]
+    for account_id in accounts:
+        rebuild_balances(tenant_id, account_id)
+    invalidate(tenant_id)
+    return {
+        'JournalLines': lines,
+        **entities,
+        'Seconds': {
+            'entities': round(entities_done - start, 3),
+            'journals': round(journals_done - entities_done, 3),
+            'derived': round(perf_counter() - journals_done, 3),
+        },
+    }
+
+def main(root: str, tenant_id: str, *args: str):
+    archive = ResponseArchive(root)
+    if args[:1] == ('replay',):
+        workers = int(args[args.index('--workers') + 1]) if '--workers' in args else 1
+        print(json.dumps(replay(tenant_id, archive, workers), indent=2))
+    else:
+        entries = archive.entries(tenant_id, args[0] if args else None)
+        print(json.dumps(entries, indent=2))
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,150 @@
+'''A cache for read-mostly Xero endpoints, shared by every process through Redis.
+
+Entries are keyed by tenant, endpoint and params and expire after the endpoint's TTL.
+Each key also carries the tenant's cache generation, which ``invalidate`` bumps when a
+sync finishes, so every entry cached for the tenant before then stops being found.
+Identical requests that miss together make one API call: within a process they wait
+on the first caller's future, across processes on a Redis lock held while it fetches.'''
+import hashlib
+import json
+from concurrent.futures import Future
+from threading import Lock
+from time import monotonic, sleep
+from typing import Callable, Iterable
+from uuid import uuid4
+from utils import metrics
+
+PREFIX = 'xero-cache'
+# seconds; endpoints not listed are never cached
+TTLS: dict[str, int] = {
+    'Organisation': 3600,
+    'Accounts': 600,
+    'TrackingCategories': 600,
+    'TrialBalance': 300,
+}
+LOCK_SECONDS = 30
+MAX_LOCAL = 1024
+
+# deletes the fill lock only if this caller still holds it
+_RELEASE = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end
+return 0
+'''
+
+
+class ResponseCache():
+    def __init__(self, redis=None, ttls: dict[str, int]|None=None, lock_seconds: float=LOCK_SECONDS,
+        poll: float=0.05):
+        '''Without ``redis`` entries are kept in this process only.'''
+        self.redis = redis
+        self.ttls = {**TTLS, **(ttls or {})}
+        self.lock_seconds = lock_seconds
+        self.poll = poll
+        self.local: dict[str, tuple[float, bytes]] = {}
+        self.generations: dict[str, int] = {}
+        self.inflight: dict[str, Future] = {}
+        self.lock = Lock()
+
+    def generation(self, tenant_id: str) -> int:
+        if self.redis is None:
+            return self.generations.get(tenant_id, 0)
+        return int(self.redis.get(f'{PREFIX}:generation:{tenant_id}') or 0)
+
+    def invalidate(self, tenant_id: str):
+        if self.redis is None:
+            with self.lock:
+                self.generations[tenant_id] = self.generations.get(tenant_id, 0) + 1
+                self.local = {key: val for key, val in self.local.items() if not key.startswith(f'{PREFIX}:{tenant_id}:')}
+            return
+        self.redis.incr(f'{PREFIX}:generation:{tenant_id}')
+
+    def key(self, tenant_id: str, endpoint: str, params: dict) -> str:
+        digest = hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+        return f'{PREFIX}:{tenant_id}:{self.generation(tenant_id)}:{endpoint}:{digest}'
+
+    def get(self, tenant_id: str, endpoint: str, params: dict, fetch: Callable[[], Iterable[dict]]) -> list[dict]:
+        '''The cached records for the request, calling ``fetch`` only on a miss. Each call
+        returns its own copy of the records.'''
+        if endpoint not in self.ttls:
+            return list(fetch())
+        key = self.key(tenant_id, endpoint, params)
+        body = self._load(key)
+        if body is not None:
+            metrics.xero_cache_total.inc(endpoint, 'hit')
+            return json.loads(body)
+        with self.lock:
+            future = self.inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self.inflight[key] = Future()
+        if not leader:
+            metrics.xero_cache_total.inc(endpoint, 'coalesced')
+            return json.loads(future.result())
+        try:
+            body = self._fill(key, endpoint, fetch)
+            future.set_result(body)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+        return json.loads(body)
+
+    def _load(self, key: str) -> bytes|None:
+        if self.redis is not None:
+            return self.redis.get(key)
+        entry = self.local.get(key)
+        if entry is None or entry[0] < monotonic():
+            return None
+        return entry[1]
+
+    def _fetch(self, endpoint: str, fetch: Callable[[], Iterable[dict]]) -> bytes:
+        metrics.xero_cache_total.inc(endpoint, 'miss')
+        return json.dumps(list(fetch())).encode()
+
+    def _fill(self, key: str, endpoint: str, fetch: Callable[[], Iterable[dict]]) -> bytes:
+        ttl = self.ttls[endpoint]
+        if self.redis is None:
+            body = self._fetch(endpoint, fetch)
+            with self.lock:
+                if len(self.local) >= MAX_LOCAL:
+                    now = monotonic()
+                    self.local = {k: v for k, v in self.local.items() if v[0] >= now}
+                    while len(self.local) >= MAX_LOCAL:
+                        del self.local[next(iter(self.local))]
+                self.local[key] = (monotonic() + ttl, body)
+            return body
+        lock_key = f'{key}:lock'
+        token = uuid4().hex
+        while True:
+            if self.redis.set(lock_key, token, nx=True, px=int(self.lock_seconds * 1000)):
+                try:
+                    # another process may have filled it between our miss and the lock
+                    body = self.redis.get(key)
+                    if body is None:
+                        body = self._fetch(endpoint, fetch)
+                        self.redis.set(key, body, ex=int(ttl))
+                    return body
+                finally:
+                    self.redis.eval(_RELEASE, 1, lock_key, token)
+            # another process is fetching; its lock expires if it dies
+            sleep(self.poll)
+            body = self.redis.get(key)
+            if body is not None:
+                metrics.xero_cache_total.inc(endpoint, 'coalesced')
+                return body
+
+
+_shared: ResponseCache|None = None
+
+def shared_cache() -> ResponseCache:
+    '''The process-wide cache, on Redis when it is available.'''
+    global _shared
+    if _shared is None:
+        from utils.redis import redis_con
+        _shared = ResponseCache(redis_con)
+    return _shared
+
+def invalidate(tenant_id: str):
+    shared_cache().invalidate(tenant_id)
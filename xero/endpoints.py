@@ -0,0 +1,117 @@
+'''The URL, query and headers of each Xero call, built once for the blocking and the
+asyncio clients. ``XeroApi`` and ``AsyncXeroApi`` send a ``Call`` and take its
+``key`` from the response.'''
+from datetime import datetime, date
+from typing import Any
+
+
+def xero_date_fmt(dt: datetime) -> str:
+    return dt.strftime('%Y-%m-%dT%H:%M:%S')
+
+
+class Call():
+    '''``path`` is relative to the API's base URL; ``key`` holds the records in the response.'''
+
+    def __init__(self, path: str, key: str, params: dict|None=None, modified_after: datetime|None=None):
+        self.path = path
+        self.key = key
+        self.params: dict[str, Any] = params or {}
+        self.headers: dict[str, str] = {}
+        if modified_after:
+            self.headers['If-Modified-Since'] = xero_date_fmt(modified_after)
+
+    @property
+    def endpoint(self) -> str:
+        return self.path.rsplit('/', 1)[-1]
+
+    def url(self, base_url: str) -> str:
+        return f'{base_url}/{self.path}'
+
+
+def _filters(where: str|None=None, order: str|None=None, page: int|None=None, **flags) -> dict:
+    params: dict[str, Any] = {}
+    if where: params['where'] = where
+    if order: params['order'] = order
+    if page: params['page'] = page
+    params.update((name, val) for name, val in flags.items() if val)
+    return params
+
+def journals(offset: int|None=None, modified_after: datetime|None=None, paymentsOnly=False) -> Call:
+    '''https://developer.xero.com/documentation/api/accounting/journals'''
+    params: dict[str, Any] = {}
+    if offset:
+        params['offset'] = offset
+    if paymentsOnly:
+        params['paymentsOnly'] = True
+    return Call('api.xro/2.0/Journals', 'Journals', params, modified_after)
+
+def organisations() -> Call:
+    '''https://developer.xero.com/documentation/api/accounting/organisation'''
+    return Call('api.xro/2.0/Organisation', 'Organisations')
+
+def invoices(modified_after: datetime|None=None, where: str|None=None, page: int|None=None,
+    summaryOnly: bool=False, order: str|None=None) -> Call:
+    '''https://developer.xero.com/documentation/api/accounting/invoices'''
+    return Call('api.xro/2.0/Invoices', 'Invoices', _filters(where, order, page, summaryOnly=summaryOnly),
+        modified_after)
+
+def invoice(invoice_id: str) -> Call:
+    '''https://developer.xero.com/documentation/api/accounting/invoices'''
+    return Call(f'api.xro/2.0/Invoices/{invoice_id}', 'Invoices')
+
+def accounts(modified_after: datetime|None=None, where: str|None=None, order: str|None=None) -> Call:
+    '''https://developer.xero.com/documentation/api/accounting/accounts'''
+    return Call('api.xro/2.0/Accounts', 'Accounts', _filters(where, order), modified_after)
+
+def tracking_categories(where: str|None=None, order: str|None=None, includeArchived: bool=False) -> Call:
+    '''https://developer.xero.com/documentation/api/accounting/trackingcategories'''
+    return Call('api.xro/2.0/TrackingCategories', 'TrackingCategories',
+        _filters(where, order, includeArchived=includeArchived))
+
+def trial_balance(at_date: date|str|None=None, paymentsOnly: bool=False) -> Call:
+    '''https://developer.xero.com/documentation/api/accounting/reports/#trial-balance'''
+    params: dict[str, Any] = {}
+    if type(at_date) is str:
+        params['date'] = at_date
+    elif type(at_date) is date:
+        params['date'] = at_date.strftime('%Y-%m-%d')
+    if paymentsOnly: params['paymentsOnly'] = paymentsOnly
+    return Call('api.xro/2.0/Reports/TrialBalance', 'Reports', params)
+
+def contacts(modified_after: datetime|None=None, where: str|None=None, order: str|None=None,
+    includeArchived: bool=False, page: int|None=None) -> Call:
+    '''https://developer.xero.com/documentation/api/accounting/contacts/#get-contacts'''
+    return Call('api.xro/2.0/Contacts', 'Contacts', _filters(where, order, page, includeArchived=includeArchived),
+        modified_after)
+
+def bank_transactions(modified_after: datetime|None=None, where: str|None=None, order: str|None=None,
+    page: int|None=None) -> Call:
+    '''https://developer.xero.com/documentation/api/accounting/banktransactions'''
+    return Call('api.xro/2.0/BankTransactions', 'BankTransactions', _filters(where, order, page), modified_after)
+
+def assets(page: int, page_size: int=200, status: str|None=None, filter_by: str|None=None,
+    order_by: str|None=None) -> Call:
+    '''https://developer.xero.com/documentation/api/assets/assets'''
+    params: dict[str, Any] = {"page": page, "pageSize": page_size}
+    if filter_by: params['filterBy'] = filter_by
+    if order_by: params['orderBy'] = order_by
+    if status: params['status'] = status
+    return Call('assets.xro/1.0/Assets', 'items', params)
+
+def manual_journals(modified_after: datetime|None=None, where: str|None=None, order: str|None=None,
+    page: int|None=None) -> Call:
+    '''https://developer.xero.com/documentation/api/accounting/manualjournals/#overview'''
+    return Call('api.xro/2.0/ManualJournals', 'ManualJournals', _filters(where, order, page), modified_after)
+
+def manual_journal(manjournal_id: str) -> Call:
+    '''https://developer.xero.com/documentation/api/accounting/manualjournals/#overview'''
+    return Call(f'api.xro/2.0/ManualJournals/{manjournal_id}', 'ManualJournals')
+
+def credit_notes(modified_after: datetime|None=None, where: str|None=None, order: str|None=None,
+    page: int|None=None) -> Call:
+    '''https://developer.xero.com/documentation/api/accounting/creditnotes/#get-creditnotes'''
+    return Call('api.xro/2.0/CreditNotes', 'CreditNotes', _filters(where, order, page), modified_after)
+
+def credit_note(credit_note_id: str) -> Call:
+    '''https://developer.xero.com/documentation/api/accounting/creditnotes/#get-creditnotes'''
+    return Call(f'api.xro/2.0/CreditNotes/{credit_note_id}', 'CreditNotes')
@@ -0,0 +1,414 @@
+'''Background sync jobs on Redis, run by worker processes.
+
+A tenant has at most one queued or running job; ``enqueue`` returns that job's id
+instead of queueing another. Workers publish progress events on the job's channel
+and keep the latest one on the job, so a late subscriber starts from current state.
+While a job runs, a heartbeat thread keeps its claim on the tenant alive, so the claim
+lapses soon after its worker dies and only then is the job requeued.
+
+    python -m xero.jobs [processes]
+'''
+import json
+import sys
+import traceback
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from multiprocessing import get_context
+from threading import Event, Thread
+from time import monotonic, sleep, time
+from typing import Callable, Iterator
+from uuid import uuid4
+from .api import XeroApi, XeroTokenSession
+from .archive import ResponseArchive
+from .cache import ResponseCache, shared_cache
+from .parser import JournalsParser, RecordsParser
+from .ratelimit import RateLimiter, shared_limiter
+from .scheduler import SYNC_KINDS
+from .updater import JournalUpdater, ENTITY_UPDATERS
+
+PREFIX = 'xero-jobs'
+QUEUE_KEY = f'{PREFIX}:queue'
+RUNNING_KEY = f'{PREFIX}:running'
+# job id -> when requeue_stale first saw it running
+RUNNING_SINCE_KEY = f'{PREFIX}:running-since'
+JOB_TTL = 86400
+# a running job that has not reported for this long is assumed to have lost its worker
+STALE_SECONDS = 600
+# a tenant claim held by running work expires this long after its last heartbeat
+CLAIM_SECONDS = STALE_SECONDS
+HEARTBEAT_SECONDS = 30
+ENTITIES = ('Journals',) + tuple(ENTITY_UPDATERS)
+FINISHED = ('done', 'failed')
+
+# deletes the tenant's claim only if it still belongs to this job
+_RELEASE = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end
+return 0
+'''
+# extends the tenant's claim only if it still belongs to ARGV[1]
+_EXTEND = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('EXPIRE', KEYS[1], ARGV[2]) end
+return 0
+'''
+
+
+class JobConflict(Exception):
+    '''The tenant already has a queued or running job that does not cover the request.'''
+
+    def __init__(self, job_id: str, description: str):
+        super().__init__(description)
+        self.job_id = job_id
+
+
+def get_redis():
+    from utils.redis import redis_con
+    if redis_con is None:
+        raise RuntimeError('background sync jobs need Redis')
+    return redis_con
+
+def job_key(job_id: str) -> str:
+    return f'{PREFIX}:job:{job_id}'
+
+def tenant_key(tenant_id: str) -> str:
+    return f'{PREFIX}:tenant:{tenant_id}'
+
+def events_channel(job_id: str) -> str:
+    return f'{PREFIX}:events:{job_id}'
+
+def _text(val) -> str:
+    return val.decode() if isinstance(val, bytes) else val
+
+
+def covers(job: dict, entities: tuple[str, ...], kind: str) -> bool:
+    '''Whether ``job`` syncs ``entities``, and Journals the ``kind`` way if they are asked for.'''
+    return set(entities) <= set(job['entities']) and ('Journals' not in entities or job['kind'] == kind)
+
+def enqueue(tenant_id: str, entities: tuple[str, ...]=ENTITIES, kind: str='update', redis=None) -> tuple[str, bool]:
+    '''Queues a sync of ``entities`` for the tenant. Returns its job id and True, or the
+    id of the tenant's job already queued or running and False when that job covers the
+    request; raises JobConflict when it does not. ``kind`` is how Journals are synced,
+    'update' (top up from the checkpoint) or 'full' (pipelined backfill).'''
+    if kind not in SYNC_KINDS:
+        raise ValueError(f'unknown sync kind {kind}')
+    unknown = set(entities) - set(ENTITIES)
+    if unknown:
+        raise ValueError(f'unknown entities {sorted(unknown)}')
+    redis = redis or get_redis()
+    while True:
+        job_id = uuid4().hex
+        if redis.set(tenant_key(tenant_id), job_id, nx=True, ex=JOB_TTL):
+            break
+        existing = redis.get(tenant_key(tenant_id))
+        if existing is None:
+            continue
+        existing = _text(existing)
+        job = get_job(existing, redis)
+        if job is None:
+            # claim_tenant's claim, or a job still being written by another enqueue
+            raise JobConflict(existing, f'tenant {tenant_id} is busy; try again shortly')
+        if covers(job, entities, kind):
+            return existing, False
+        raise JobConflict(existing, f"tenant {tenant_id} already has a sync queued or running "
+            f"({job['kind']} of {', '.join(job['entities'])}) that does not cover this one")
+    event = {'job': job_id, 'tenant': tenant_id, 'status': 'queued', 'time': time()}
+    pipe = redis.pipeline()
+    pipe.hset(job_key(job_id), mapping={
+        'tenant': tenant_id,
+        'entities': json.dumps(list(entities)),
+        'kind': kind,
+        'status': 'queued',
+        'heartbeat': time(),
+        'event': json.dumps(event),
+    })
+    pipe.expire(job_key(job_id), JOB_TTL)
+    pipe.lpush(QUEUE_KEY, job_id)
+    pipe.publish(events_channel(job_id), json.dumps(event))
+    pipe.execute()
+    return job_id, True
+
+def get_job(job_id: str, redis=None) -> dict|None:
+    redis = redis or get_redis()
+    job = {_text(key): _text(val) for key, val in redis.hgetall(job_key(job_id)).items()}
+    if not job:
+        return None
+    job['entities'] = json.loads(job['entities'])
+    job['event'] = json.loads(job['event'])
+    return job
+
+def events(job_id: str, redis=None, timeout: float=15) -> Iterator[dict|None]:
+    '''The job's latest event, then each new one until it finishes. Yields None after
+    ``timeout`` seconds without an event, so a caller can keep its connection alive.'''
+    redis = redis or get_redis()
+    pubsub = redis.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(events_channel(job_id))
+    try:
+        # subscribed before reading the latest, so nothing published in between is missed
+        job = get_job(job_id, redis)
+        if job is None:
+            return
+        last = job['event']
+        yield last
+        while last['status'] not in FINISHED:
+            message = pubsub.get_message(timeout=timeout)
+            if message is None:
+                job = get_job(job_id, redis)
+                if job is None:
+                    return
+                if job['event'] != last:
+                    last = job['event']
+                    yield last
+                else:
+                    yield None
+                continue
+            last = json.loads(message['data'])
+            yield last
+    finally:
+        pubsub.close()
+
+
+class Heartbeat():
+    '''Extends ``owner``'s claim on the tenant every ``interval`` seconds from a thread,
+    and with a ``job_id`` also the job's heartbeat, for as long as the block runs. Silent
+    stretches of work (rate limit waits, index rebuilds) then keep the claim too.'''
+
+    def __init__(self, redis, tenant_id: str, owner: str, job_id: str|None=None,
+        interval: float=HEARTBEAT_SECONDS):
+        self.redis = redis
+        self.tenant_id = tenant_id
+        self.owner = owner
+        self.job_id = job_id
+        self.interval = interval
+        self.stop = Event()
+        self.thread = Thread(target=self._run, daemon=True)
+
+    def beat(self) -> bool:
+        '''Returns whether the claim is still ``owner``'s.'''
+        pipe = self.redis.pipeline()
+        pipe.eval(_EXTEND, 1, tenant_key(self.tenant_id), self.owner, CLAIM_SECONDS)
+        if self.job_id is not None:
+            pipe.hset(job_key(self.job_id), 'heartbeat', time())
+            pipe.expire(job_key(self.job_id), JOB_TTL)
+        return bool(pipe.execute()[0])
+
+    def _run(self):
+        while not self.stop.wait(self.interval):
+            try:
+                if not self.beat():
+                    print(f'lost the claim on tenant {self.tenant_id} to another sync', file=sys.stderr)
+            except Exception:
+                print(traceback.format_exc() + f'\n tenant_id = {self.tenant_id}', file=sys.stderr)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.thread.join()
+
+
+@contextmanager
+def claim_tenant(tenant_id: str, redis=None) -> Iterator[None]:
+    '''Holds the tenant's sync claim for the block, the one a running job holds, so work
+    that rewrites the tenant's data never overlaps a sync. Raises RuntimeError if the
+    claim is taken. Without Redis there are no jobs to overlap and nothing is claimed.'''
+    if redis is None:
+        from utils.redis import redis_con as redis
+    if redis is None:
+        yield
+        return
+    owner = uuid4().hex
+    if not redis.set(tenant_key(tenant_id), owner, nx=True, ex=CLAIM_SECONDS):
+        raise RuntimeError(f'tenant {tenant_id} is already being synced')
+    try:
+        with Heartbeat(redis, tenant_id, owner):
+            yield
+    finally:
+        redis.eval(_RELEASE, 1, tenant_key(tenant_id), owner)
+
+
+class Progress():
+    '''Turns each committed page into a progress event for the job.
+
+    Journal numbers give no total up front, so the ETA assumes the journals still to
+    come are spread over time like those already fetched: the fraction done is how far
+    the last CreatedDateUTC has moved from the first one towards now.'''
+
+    def __init__(self, publish: Callable[[dict], None], entity: str):
+        self.publish = publish
+        self.entity = entity
+        self.started = monotonic()
+        self.pages = 0
+        self.rows = 0
+        self.first_created: datetime|None = None
+
+    def __call__(self, parser: JournalsParser|RecordsParser):
+        self.pages += 1
+        event: dict = {'status': 'progress', 'entity': self.entity, 'pages': self.pages}
+        if isinstance(parser, JournalsParser):
+            self.rows += len(parser.journal_lines)
+            last = parser.last_journal
+            if last:
+                event['last_journal'] = last['JournalNumber']
+                event['eta_seconds'] = self.eta(datetime.fromisoformat(last['CreatedDateUTC']))
+        else:
+            self.rows += len(parser.rows)
+        event['rows'] = self.rows
+        self.publish(event)
+
+    def eta(self, created: datetime) -> float|None:
+        if self.first_created is None:
+            self.first_created = created
+            return None
+        span = (datetime.now(timezone.utc) - self.first_created).total_seconds()
+        done = (created - self.first_created).total_seconds()
+        if span <= 0 or done <= 0:
+            return None
+        return round((monotonic() - self.started) * max(span - done, 0) / done, 1)
+
+
+def tenant_api(tenant_id: str, limiter: RateLimiter|None=None, archive: ResponseArchive|None=None,
+    cache: ResponseCache|None=None) -> XeroApi:
+    '''A XeroApi using the token of a user connected to the tenant, reading the cacheable
+    endpoints through ``cache`` or the shared response cache. Responses are archived
+    to ``archive``, or to ``config.archive_dir`` when that is set.'''
+    import config
+    from .oauth import get_tenant_user, get_refreshed_token
+    user = get_tenant_user(tenant_id)
+    if user is None:
+        raise LookupError(f'no user is connected to tenant {tenant_id}')
+    if archive is None and getattr(config, 'archive_dir', None):
+        archive = ResponseArchive(config.archive_dir)
+    return XeroApi(XeroTokenSession(config.client_id, config.client_secret, lambda: get_refreshed_token(user)),
+        tenant_id, limiter, cache=cache or shared_cache(), archive=archive)
+
+
+def run_job(job_id: str, redis, api_factory: Callable[[str, RateLimiter], XeroApi], limiter: RateLimiter):
+    job = get_job(job_id, redis)
+    if job is None:
+        return
+    tenant_id = job['tenant']
+
+    def publish(event: dict):
+        event.update(job=job_id, tenant=tenant_id, time=time())
+        pipe = redis.pipeline()
+        pipe.hset(job_key(job_id), mapping={'status': event['status'], 'heartbeat': time(), 'event': json.dumps(event)})
+        pipe.publish(events_channel(job_id), json.dumps(event))
+        pipe.execute()
+
+    heartbeat = Heartbeat(redis, tenant_id, job_id, job_id)
+    if not heartbeat.beat():
+        # requeued after its claim lapsed, and the tenant has been claimed again since
+        publish({'status': 'failed', 'description': 'Another sync of the tenant is running'})
+        return
+    results = {}
+    try:
+        with heartbeat:
+            publish({'status': 'running'})
+            api = api_factory(tenant_id, limiter)
+            for entity in job['entities']:
+                progress = Progress(publish, entity)
+                if entity == 'Journals':
+                    result = SYNC_KINDS[job['kind']][0](JournalUpdater(tenant_id, api, progress))
+                else:
+                    result = ENTITY_UPDATERS[entity](tenant_id, api, progress).update_sql()
+                results[entity] = result
+                if result['error']:
+                    publish({'status': 'failed', 'entity': entity, 'description': result['description'],
+                        'results': results})
+                    return
+            publish({'status': 'done', 'results': results})
+    except Exception:
+        print(traceback.format_exc() + f'\n tenant_id = {tenant_id}', file=sys.stderr)
+        publish({'status': 'failed', 'description': 'Sync job failed', 'results': results})
+    finally:
+        redis.eval(_RELEASE, 1, tenant_key(tenant_id), job_id)
+
+
+def set_event(redis, job_id: str, event: dict):
+    '''Records ``event`` as the job's latest and publishes it.'''
+    pipe = redis.pipeline()
+    pipe.hset(job_key(job_id), mapping={'status': event['status'], 'event': json.dumps(event)})
+    pipe.publish(events_channel(job_id), json.dumps(event))
+    pipe.execute()
+
+def requeue_stale(redis, stale_seconds: float=STALE_SECONDS) -> int:
+    '''Puts jobs that have been running for ``stale_seconds`` without a heartbeat back on
+    the queue, once their claim on the tenant has lapsed too. A job whose tenant has been
+    claimed by another since is failed instead, and one whose record expired is reported
+    as failed to its subscribers.'''
+    requeued = 0
+    now = time()
+    running = [_text(job_id) for job_id in redis.lrange(RUNNING_KEY, 0, -1)]
+    finished = {_text(job_id) for job_id in redis.hkeys(RUNNING_SINCE_KEY)} - set(running)
+    if finished:
+        redis.hdel(RUNNING_SINCE_KEY, *finished)
+    for job_id in running:
+        # a job queued for long carries an old heartbeat into RUNNING, so it is timed
+        # from when it was first seen here too
+        redis.hsetnx(RUNNING_SINCE_KEY, job_id, now)
+        if now - float(redis.hget(RUNNING_SINCE_KEY, job_id) or now) < stale_seconds:
+            continue
+        heartbeat, tenant_id = redis.hmget(job_key(job_id), 'heartbeat', 'tenant')
+        if heartbeat is not None and now - float(heartbeat) < stale_seconds:
+            continue
+        if tenant_id is not None:
+            tenant_id = _text(tenant_id)
+            claim = tenant_key(tenant_id)
+            if _text(redis.get(claim)) == job_id:
+                if redis.ttl(claim) <= CLAIM_SECONDS:
+                    # only a live worker's heartbeat keeps the claim this short
+                    continue
+                # still enqueue's claim: the worker died before its first heartbeat
+                redis.eval(_RELEASE, 1, claim, job_id)
+        if not redis.lrem(RUNNING_KEY, 1, job_id):
+            continue
+        redis.hdel(RUNNING_SINCE_KEY, job_id)
+        event = {'job': job_id, 'tenant': tenant_id, 'time': now}
+        if tenant_id is None:
+            event.update(status='failed', description='Worker lost and the job expired')
+            redis.publish(events_channel(job_id), json.dumps(event))
+        elif redis.set(tenant_key(tenant_id), job_id, nx=True, ex=JOB_TTL):
+            set_event(redis, job_id, {**event, 'status': 'queued', 'description': 'Requeued after its worker was lost'})
+            redis.rpush(QUEUE_KEY, job_id)
+            requeued += 1
+        else:
+            set_event(redis, job_id, {**event, 'status': 'failed',
+                'description': 'Worker lost; another sync of the tenant has started since'})
+    return requeued
+
+def work(api_factory: Callable[[str, RateLimiter], XeroApi]|None=None, poll: float=5):
+    '''One worker process: takes jobs off the queue until stopped.'''
+    redis = get_redis()
+    limiter = shared_limiter()
+    api_factory = api_factory or tenant_api
+    while True:
+        job_id = redis.blmove(QUEUE_KEY, RUNNING_KEY, poll, 'RIGHT', 'LEFT')
+        if job_id is None:
+            continue
+        job_id = _text(job_id)
+        try:
+            run_job(job_id, redis, api_factory, limiter)
+        finally:
+            redis.lrem(RUNNING_KEY, 1, job_id)
+
+def main(processes: int=4):
+    ctx = get_context('spawn')
+    workers = []
+    try:
+        while True:
+            workers = [worker for worker in workers if worker.is_alive()]
+            for _ in range(processes - len(workers)):
+                worker = ctx.Process(target=work, daemon=True)
+                worker.start()
+                workers.append(worker)
+            requeue_stale(get_redis())
+            sleep(30)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.terminate()
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
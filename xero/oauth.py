@@ -5,24 +5,81 @@ from sql import get_user_db, get_xero_tokens_db
 from utils.redis import redis_con_bytes
 from config import fernet_key, client_id, client_secret, sso_id, sso_secret
 from time import time
+from threading import Lock
+from contextlib import contextmanager
+from functools import lru_cache
 import jwt
 import json
 
 refresh_url = 'https://identity.xero.com/connect/token'
+jwks_url = "https://identity.xero.com/.well-known/openid-configuration/jwks"
+# tokens closer than this to expiry are refreshed
+refresh_margin = 60
+refresh_lock_timeout = 30
 scope = (
     "offline_access openid profile email accounting.transactions.read "
     "accounting.reports.read accounting.journals.read accounting.settings.read "
     "accounting.contacts.read accounting.attachments.read accounting.budgets.read"
 )
 
+_token_cache: dict[str, dict] = {}
+_user_locks: dict[str, Lock] = {}
+_user_locks_lock = Lock()
+
+@lru_cache(maxsize=None)
+def get_fernet() -> Fernet:
+    return Fernet(fernet_key)
+
+@lru_cache(maxsize=None)
+def get_jwks_client() -> jwt.PyJWKClient:
+    return jwt.PyJWKClient(jwks_url, cache_keys=True, cache_jwk_set=True, lifespan=3600)
+
 def encrypt_token(token: dict) -> bytes:
     text = json.dumps(token)
-    f = Fernet(fernet_key)
-    return f.encrypt(text.encode('utf-8'))
+    return get_fernet().encrypt(text.encode('utf-8'))
 
 def decrypt_token(encypted_token: bytes) -> dict:
-    f = Fernet(fernet_key)
-    return json.loads(f.decrypt(encypted_token).decode())
+    return json.loads(get_fernet().decrypt(encypted_token).decode())
+
+def token_is_fresh(token: dict|None) -> bool:
+    return token is not None and token['expires_at'] - time() >= refresh_margin
+
+def cache_token(user: str, token: dict, encrypted: bytes|None=None):
+    _token_cache[user] = token
+    ttl = int(token['expires_at'] - time() - refresh_margin)
+    if redis_con_bytes and ttl > 0:
+        redis_con_bytes.set(f'xero-token:{user}', encrypted or encrypt_token(token), ex=ttl)
+
+def get_cached_token(user: str) -> dict|None:
+    token = _token_cache.get(user)
+    if token_is_fresh(token):
+        return token
+    if redis_con_bytes:
+        resp: bytes|None = redis_con_bytes.get(f'xero-token:{user}') # type: ignore
+        if resp:
+            token = decrypt_token(resp)
+            _token_cache[user] = token
+            return token
+    return None
+
+def forget_token(user: str):
+    _token_cache.pop(user, None)
+    if redis_con_bytes:
+        redis_con_bytes.delete(f'xero-token:{user}')
+
+@contextmanager
+def refresh_lock(user: str):
+    '''Single flight for a user's token refresh: one thread per process, and with Redis
+    one process overall, refreshes while the others wait and then reuse its token.'''
+    with _user_locks_lock:
+        lock = _user_locks.setdefault(user, Lock())
+    with lock:
+        if redis_con_bytes is None:
+            yield
+            return
+        with redis_con_bytes.lock(f'xero-token-lock:{user}', timeout=refresh_lock_timeout,
+            blocking_timeout=refresh_lock_timeout):
+            yield
 
 def set_tenant_user(tenant_id: str, user_email: str):
     con = get_user_db()
@@ -32,39 +89,71 @@ def set_tenant_user(tenant_id: str, user_email: str):
             (user_email, tenant_id),
         )
 
+def get_tenant_user(tenant_id: str) -> str|None:
+    con = get_user_db()
+    try:
+        first = con.execute(
+            "select email from token_users where tenant_id = ? limit 1",
+            (tenant_id,),
+        ).fetchone()
+    finally:
+        con.close()
+    if first:
+        return first[0]
+    return None
+
+def is_tenant_user(user_email: str, tenant_id: str) -> bool:
+    con = get_user_db()
+    try:
+        found = con.execute(
+            "select 1 from token_users where email = ? and tenant_id = ? limit 1",
+            (user_email, tenant_id),
+        ).fetchone()
+    finally:
+        con.close()
+    return found is not None
+
 def store_xero_oauth2_token(token: dict, user: str):
     con = get_xero_tokens_db()
     with con:
         con.execute(
-            "delete from tokens where user = ?;",
+            "delete from tokens where email = ?;",
             (user,),
         )
         con.execute(
             "insert into tokens(email, token) values (?, ?)",
             (user, encrypt_token(token)),
         )
+    forget_token(user)
 
 def get_refreshed_token(user: str) -> dict:
-    if redis_con_bytes:
-        resp: bytes|None = redis_con_bytes.get(f'xero-token:{user}') # type: ignore
-        if resp:
-            return decrypt_token(resp)
-    con = get_xero_tokens_db()
-    with con:
-        cur = con.execute(
-            "select token from tokens where email = ?",
-            (user,),
-        )
-        token = decrypt_token(cur.fetchone()[0])
-        if token['expires_at'] - time() < 60:
-            token = refresh_token(token)
-            et = encrypt_token(token)
-            con.execute(
-                "update tokens set token = ? where email = ?",
-                (et, user),
-            )
-            if redis_con_bytes:
-                redis_con_bytes.set(f'xero-token:{user}', et, ex=(token['expires_in']-60))
+    token = get_cached_token(user)
+    if token:
+        return token
+    with refresh_lock(user):
+        # whoever held the lock before us may already have refreshed
+        token = get_cached_token(user)
+        if token:
+            return token
+        con = get_xero_tokens_db()
+        try:
+            with con:
+                cur = con.execute(
+                    "select token from tokens where email = ?",
+                    (user,),
+                )
+                et = cur.fetchone()[0]
+                token = decrypt_token(et)
+                if not token_is_fresh(token):
+                    token = refresh_token(token)
+                    et = encrypt_token(token)
+                    con.execute(
+                        "update tokens set token = ? where email = ?",
+                        (et, user),
+                    )
+        finally:
+            con.close()
+        cache_token(user, token, et)
     return token
 
 def refresh_token(token: dict):
@@ -147,9 +236,7 @@ class XeroTokenManager():
         )
 
     def get_user(self) -> str:
-        discovery_url = "https://identity.xero.com/.well-known/openid-configuration/jwks"
-        jwks_client = jwt.PyJWKClient(discovery_url)
-        signing_key = jwks_client.get_signing_key_from_jwt(self.token['id_token'])
+        signing_key = get_jwks_client().get_signing_key_from_jwt(self.token['id_token'])
         info = jwt.decode(self.token['id_token'], signing_key.key, algorithms=["RS256"], audience=self.client_id)
         self._user = info['email']
         return self._user
@@ -0,0 +1,106 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Callable, Iterable, Iterator
+from .ratelimit import TENANT_CONCURRENT
+
+PAGE_SIZE = 100
+# one more page is requested ahead for every RAMP_PAGES full pages already received, so
+# a sync that needs only a few pages spends no calls on guesses past its end
+RAMP_PAGES = 4
+
+def look_ahead(full_pages: int, workers: int) -> int:
+    '''Pages to keep in flight after ``full_pages`` full pages.'''
+    return max(1, min(workers, 1 + full_pages // RAMP_PAGES))
+
+
+class PageIterator():
+    '''Yields the records of a paged endpoint in order while fetching up to ``workers``
+    pages ahead in parallel, ramping up to that as full pages come back (``look_ahead``).
+    Iteration ends at the first page shorter than ``page_size``.
+
+    ``page`` is the resume cursor: the first page whose records have not all been
+    yielded yet. Pass it back as ``start_page`` to carry on from there.'''
+
+    def __init__(self, fetch: Callable[[int], Iterable[dict]], start_page: int=1,
+        workers: int=TENANT_CONCURRENT, page_size: int=PAGE_SIZE):
+        self.fetch = fetch
+        self.page = start_page
+        self.workers = workers
+        self.page_size = page_size
+
+    def _fetch(self, page: int) -> list[dict]:
+        return list(self.fetch(page))
+
+    def __iter__(self) -> Iterator[dict]:
+        for records in self.pages():
+            yield from records
+
+    def pages(self) -> Iterator[list[dict]]:
+        pool = ThreadPoolExecutor(self.workers, thread_name_prefix='xero-page')
+        try:
+            pending: deque[Future] = deque()
+            next_page = self.page
+            full = 0
+            while True:
+                while len(pending) < look_ahead(full, self.workers):
+                    pending.append(pool.submit(self._fetch, next_page))
+                    next_page += 1
+                records = pending.popleft().result()
+                yield records
+                self.page += 1
+                if len(records) < self.page_size:
+                    return
+                full += 1
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
+class JournalIterator():
+    '''Yields journals after ``offset`` in order with up to ``workers`` pages in flight.
+
+    The Journals endpoint pages by offset (the last JournalNumber seen), not page number.
+    Journal numbers are sequential, so the pages after ``offset`` are requested at
+    offset + 100, offset + 200, ... ahead of time, as many as ``look_ahead`` allows. If a
+    page ends anywhere else, the guesses after it are dropped and fetching restarts from
+    the real offset.
+    ``offset`` is the resume cursor: the last JournalNumber of the last complete page.'''
+
+    def __init__(self, fetch: Callable[[int], Iterable[dict]], offset: int=0,
+        workers: int=TENANT_CONCURRENT, page_size: int=PAGE_SIZE):
+        self.fetch = fetch
+        self.offset = offset
+        self.workers = workers
+        self.page_size = page_size
+
+    def _fetch(self, offset: int) -> list[dict]:
+        return list(self.fetch(offset))
+
+    def __iter__(self) -> Iterator[dict]:
+        for journals in self.pages():
+            yield from journals
+
+    def pages(self) -> Iterator[list[dict]]:
+        pool = ThreadPoolExecutor(self.workers, thread_name_prefix='xero-journals')
+        try:
+            pending: deque[tuple[int, Future]] = deque()
+            full = 0
+            while True:
+                guess = pending[-1][0] + self.page_size if pending else self.offset
+                while len(pending) < look_ahead(full, self.workers):
+                    pending.append((guess, pool.submit(self._fetch, guess)))
+                    guess += self.page_size
+                requested, future = pending.popleft()
+                journals = future.result()
+                if requested != self.offset:
+                    # an earlier page did not end where guessed
+                    for _, stale in pending:
+                        stale.cancel()
+                    pending.clear()
+                    continue
+                yield journals
+                if len(journals) < self.page_size:
+                    return
+                full += 1
+                self.offset = max(journal['JournalNumber'] for journal in journals)
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
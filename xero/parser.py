@@ -1,118 +1,379 @@
 import re
 import json
 from datetime import datetime, timezone
+from typing import Iterable
+import numpy as np
 import pandas as pd
 
+# /Date(ticks+offset)/: ticks are milliseconds since the epoch in UTC. The optional
+# offset is the sender's UTC offset and does not shift the instant.
+XERO_DATE = re.compile(r'/Date\((-?\d+)([+-]\d{4})?\)/')
+# a whole column of /Date()/ values joined by newlines, and the ticks of each
+XERO_DATE_LINES = re.compile(r'(?:/Date\(-?\d+(?:[+-]\d{4})?\)/\n)*')
+XERO_DATE_TICKS = re.compile(r'/Date\((-?\d+)')
+
+def date_ticks_of(val: str, column: str|None=None) -> int:
+    '''Epoch milliseconds of a Xero /Date()/ value, or of an ISO 8601 one as some
+    endpoints return (UTC unless it says otherwise).'''
+    match = XERO_DATE.match(val) if isinstance(val, str) else None
+    if match:
+        return int(match.group(1))
+    try:
+        dt = datetime.fromisoformat(val)
+    except (TypeError, ValueError):
+        raise ValueError(f'{column or "value"}: {val!r} is not a Xero date') from None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp() * 1000)
+
 def convert_date(s):
-    pat = re.compile('[0-9]+')
-    ticks = int(pat.findall(s)[0])
-    return datetime.fromtimestamp(ticks / 1000, timezone.utc)
+    return datetime.fromtimestamp(date_ticks_of(s) / 1000, timezone.utc)
+
+def is_date_column(values: Iterable) -> bool:
+    for val in values:
+        if not pd.isna(val):
+            return isinstance(val, str) and val.startswith('/Date(')
+    return False
+
+def date_ticks(values: Iterable) -> pd.Series:
+    '''Milliseconds since the epoch for a whole column of Xero dates, <NA> where missing.'''
+    col = pd.Series(list(values), dtype=object).astype('string')
+    return pd.to_numeric(col.str.extract(XERO_DATE, expand=True)[0]).astype('Int64')
+
+def column_ticks(values: list, column: str|None=None) -> np.ndarray:
+    '''Epoch milliseconds of a column of dates with none missing. A column of /Date()/
+    values, what the API sends, is read with one regex pass over the whole column; any
+    other goes value by value through ``date_ticks_of``, which names ``column`` in its
+    error for a value that is not a date.'''
+    try:
+        joined = '\n'.join(values) + '\n'
+    except TypeError:
+        joined = ''
+    found = XERO_DATE_TICKS.findall(joined) if XERO_DATE_LINES.fullmatch(joined) else ()
+    if len(found) == len(values):
+        return np.array(found, dtype='int64')
+    return np.array([date_ticks_of(val, column) for val in values], dtype='int64')
+
+def convert_date_column(values: Iterable, epoch: bool=False, column: str|None=None) -> list:
+    '''Converts a column of Xero dates to text in the form ``str(datetime)`` gives
+    ('2024-07-06 01:12:07+00:00'), or to epoch milliseconds with ``epoch``, with numpy
+    over the whole column and each distinct date formatted once. A value that is not a
+    date raises ValueError naming ``column``.'''
+    values = list(values)
+    present = [val for val in values if val is not None]
+    ticks = column_ticks(present, column)
+    if epoch:
+        converted = ticks.tolist()
+    else:
+        distinct, index = np.unique(ticks, return_inverse=True)
+        moments = distinct.astype('datetime64[ms]')
+        # str(datetime) shows microseconds only when there are any
+        text = np.where(distinct % 1000 == 0, np.datetime_as_string(moments, unit='s'),
+            np.datetime_as_string(moments, unit='us'))
+        formatted = [f'{val[:10]} {val[11:]}+00:00' for val in text.tolist()]
+        converted = [formatted[i] for i in index.tolist()]
+    if len(present) == len(values):
+        return converted
+    found = iter(converted)
+    return [None if val is None else next(found) for val in values]
+
+def convert_date_frame(df: pd.DataFrame, epoch: bool=False) -> pd.DataFrame:
+    '''Converts, in place, every column whose first value is a Xero date to UTC datetimes
+    (or epoch milliseconds with ``epoch``).'''
+    for col in df.columns:
+        if (pd.api.types.is_object_dtype(df[col]) or pd.api.types.is_string_dtype(df[col])) and is_date_column(df[col]):
+            ticks = date_ticks(df[col])
+            df[col] = ticks if epoch else pd.to_datetime(ticks, unit='ms', utc=True)
+    return df
 
 
 class JournalsParser():
-    cols_journal = set(
-        [
-            "JournalNumber",
-            "JournalID",
-            "JournalDate",
-            "CreatedDateUTC",
-            "Reference",
-            "SourceID",
-            "SourceType",
-        ]
+    '''Parses journal pages into row tuples ordered as ``cols_journal``/``cols_journal_line``,
+    ready for ``executemany``. The DataFrame views are only built when first read.'''
+    cols_journal = (
+        "JournalNumber",
+        "JournalID",
+        "JournalDate",
+        "CreatedDateUTC",
+        "Reference",
+        "SourceID",
+        "SourceType",
     )
-    cols_journal_line = set(
-        [
-            "JournalLineID",
-            "JournalNumber",
-            "AccountID",
-            "AccountCode",
-            "AccountType",
-            "AccountName",
-            "NetAmount",
-            "GrossAmount",
-            "TaxAmount",
-            "TaxType",
-            "TaxName",
-            "Description",
-            "TrackingCategories",
-        ]
+    cols_journal_line = (
+        "JournalNumber",
+        "JournalLineID",
+        "AccountID",
+        "AccountCode",
+        "AccountType",
+        "AccountName",
+        "NetAmount",
+        "GrossAmount",
+        "TaxAmount",
+        "TaxType",
+        "TaxName",
+        "Description",
+        "TrackingCategories",
     )
+    cols_journal_line_tracking = (
+        "JournalNumber",
+        "JournalLineID",
+        "TrackingCategoryID",
+        "TrackingOptionID",
+    )
+    cols_tracking_category = ("TrackingCategoryID", "Name")
+    cols_tracking_option = ("TrackingOptionID", "TrackingCategoryID", "Name")
+    cols_journal_date = ("JournalDate", "CreatedDateUTC")
+    cols_amount = ("NetAmount", "GrossAmount", "TaxAmount")
 
-    def __init__(self, journals: list[dict], offset=0):
-        journal_entries = []
-        self.journal_lines = []
-        self.journal_lines_tracking = []
+    def __init__(self, journals: Iterable[dict], offset=0, money_scale: int=1):
+        '''With ``money_scale`` above 1 line amounts are converted to integer units of
+        1/money_scale, for tenants storing money as integers (see sql.money).'''
+        self.money_scale = money_scale
+        self.journals: list[tuple] = []
+        self.journal_lines: list[tuple] = []
+        self.journal_lines_tracking: list[tuple] = []
+        # names as the lines carry them, for categories and options not yet synced from TrackingCategories
+        self.tracking_categories: dict[str, tuple] = {}
+        self.tracking_options: dict[str, tuple] = {}
+        cols = self.cols_journal
         for journal in journals:
-            journal_entry = {}
-            journal_id = journal["JournalID"]
             if journal['JournalNumber'] <= offset:
                 continue
-            for col in self.cols_journal:
-                val = journal.get(col)
-                if isinstance(val, str) and val.find('/Date') == 0:
-                    val = convert_date(val)
-                journal_entry[col] = val
+            self.journals.append(tuple(journal.get(col) for col in cols))
             if 'JournalLines' in journal:
-                self.insert_journal_lines(journal['JournalLines'], journal_id)
-            journal_entries.append(journal_entry)
-        self.df_journals = pd.DataFrame.from_dict(journal_entries) # type: ignore
-        self.df_journal_lines = pd.DataFrame.from_dict(self.journal_lines) # type: ignore
-        self.df_journal_lines_tracking = pd.DataFrame.from_dict(self.journal_lines_tracking) # type: ignore
-        del self.journal_lines
-        del self.journal_lines_tracking
-
-    def insert_journal_lines(self, journal_lines: list[dict], journal_id):
+                self.insert_journal_lines(journal['JournalLines'], journal['JournalNumber'])
+        if self.journals:
+            columns = list(zip(*self.journals))
+            for col in self.cols_journal_date:
+                i = cols.index(col)
+                columns[i] = tuple(convert_date_column(columns[i], column=col))
+            self.journals = list(zip(*columns))
+
+    def insert_journal_lines(self, journal_lines: list[dict], journal_number: int):
+        cols = self.cols_journal_line[1:]
+        scale = self.money_scale
+        amounts = self.cols_amount if scale != 1 else ()
         for journal_line in journal_lines:
-            journal_line_entry = {}
-            for col in self.cols_journal_line:
+            journal_line_entry = [journal_number]
+            for col in cols:
                 val = journal_line.get(col)
-                if isinstance(val, str) and val.find('/Date') == 0:
-                    val = convert_date(val)
-                elif isinstance(val, dict):
+                if isinstance(val, (dict, list)):
                     val = json.dumps(val)
-                journal_line_entry[col] = val
-            journal_line_entry['JournalID'] = journal_id
-            self.journal_lines.append(journal_line_entry)
+                elif col in amounts and val is not None:
+                    val = round(val * scale)
+                journal_line_entry.append(val)
+            self.journal_lines.append(tuple(journal_line_entry))
+            for tracking in journal_line.get('TrackingCategories') or ():
+                category_id = tracking['TrackingCategoryID']
+                option_id = tracking.get('TrackingOptionID')
+                self.journal_lines_tracking.append((journal_number, journal_line['JournalLineID'], category_id, option_id))
+                if category_id not in self.tracking_categories:
+                    self.tracking_categories[category_id] = (category_id, tracking.get('Name'))
+                if option_id and option_id not in self.tracking_options:
+                    self.tracking_options[option_id] = (option_id, category_id, tracking.get('Option'))
 
+    @property
+    def last_journal(self) -> dict|None:
+        if not self.journals:
+            return None
+        return dict(zip(self.cols_journal, self.journals[-1]))
 
-class AccountsParser():
-    cols_account = set(
-        [
-            "AccountID",
-            "Code",
-            "Name",
-            "Type",
-            "BankAccountNumber",
-            "Status",
-            "Description",
-            "BankAccountType",
-            "CurrencyCode",
-            "TaxType",
-            "EnablePaymentsToAccount",
-            "ShowInExpenseClaims",
-            "Class",
-            "SystemAccount",
-            "ReportingCode",
-            "ReportingCodeName",
-            "HasAttachments",
-            "UpdatedDateUTC",
-            "AddToWatchlist",
-        ]
+    @property
+    def df_journals(self) -> pd.DataFrame:
+        if not hasattr(self, '_df_journals'):
+            df = pd.DataFrame.from_records(self.journals, columns=self.cols_journal)
+            for col in self.cols_journal_date:
+                df[col] = pd.to_datetime(df[col], utc=True)
+            self._df_journals = df
+        return self._df_journals
+
+    @property
+    def df_journal_lines(self) -> pd.DataFrame:
+        if not hasattr(self, '_df_journal_lines'):
+            self._df_journal_lines = pd.DataFrame.from_records(self.journal_lines, columns=self.cols_journal_line)
+        return self._df_journal_lines
+
+    @property
+    def df_journal_lines_tracking(self) -> pd.DataFrame:
+        if not hasattr(self, '_df_journal_lines_tracking'):
+            self._df_journal_lines_tracking = pd.DataFrame.from_records(self.journal_lines_tracking,
+                columns=self.cols_journal_line_tracking)
+        return self._df_journal_lines_tracking
+
+
+class RecordsParser():
+    '''Parses records of one Xero entity into row tuples ordered as ``columns``.
+
+    ``nested`` maps a column to the (field, subfield) it is read from, e.g. an invoice's
+    ContactID from its Contact. Lists and objects are stored as JSON text, and date
+    columns are converted a column at a time. ``high_water`` is the newest
+    UpdatedDateUTC in epoch milliseconds, if the entity has one.'''
+    table: str
+    key: str
+    columns: tuple[str, ...]
+    nested: dict[str, tuple[str, str]] = {}
+
+    def __init__(self, records: Iterable[dict]) -> None:
+        rows = []
+        for record in records:
+            row = []
+            for col in self.columns:
+                if col in self.nested:
+                    parent, child = self.nested[col]
+                    val = (record.get(parent) or {}).get(child)
+                else:
+                    val = record.get(col)
+                if isinstance(val, (dict, list)):
+                    val = json.dumps(val)
+                row.append(val)
+            rows.append(row)
+        self.high_water = None
+        self.date_columns: list[str] = []
+        if rows:
+            columns = list(zip(*rows))
+            for i, col in enumerate(self.columns):
+                if is_date_column(columns[i]):
+                    self.date_columns.append(col)
+                    if col == 'UpdatedDateUTC':
+                        ticks = convert_date_column(columns[i], epoch=True, column=col)
+                        self.high_water = max(t for t in ticks if t is not None)
+                    columns[i] = tuple(convert_date_column(columns[i], column=col))
+            rows = list(zip(*columns))
+        self.rows: list[tuple] = rows
+
+    @property
+    def df(self) -> pd.DataFrame:
+        if not hasattr(self, '_df'):
+            df = pd.DataFrame.from_records(self.rows, columns=self.columns)
+            for col in self.date_columns:
+                df[col] = pd.to_datetime(df[col], utc=True)
+            self._df = df
+        return self._df
+
+
+class AccountsParser(RecordsParser):
+    table = 'Accounts'
+    key = 'AccountID'
+    columns = (
+        "AccountID",
+        "Code",
+        "Name",
+        "Type",
+        "BankAccountNumber",
+        "Status",
+        "Description",
+        "BankAccountType",
+        "CurrencyCode",
+        "TaxType",
+        "EnablePaymentsToAccount",
+        "ShowInExpenseClaims",
+        "Class",
+        "SystemAccount",
+        "ReportingCode",
+        "ReportingCodeName",
+        "HasAttachments",
+        "UpdatedDateUTC",
+        "AddToWatchlist",
+    )
+    cols_account = set(columns)
+
+    @property
+    def df_accounts(self) -> pd.DataFrame:
+        return self.df
+
+
+class ContactsParser(RecordsParser):
+    table = 'Contacts'
+    key = 'ContactID'
+    columns = (
+        "ContactID",
+        "ContactNumber",
+        "AccountNumber",
+        "ContactStatus",
+        "Name",
+        "FirstName",
+        "LastName",
+        "EmailAddress",
+        "TaxNumber",
+        "IsSupplier",
+        "IsCustomer",
+        "DefaultCurrency",
+        "UpdatedDateUTC",
     )
 
-    def __init__(self, accounts: list[dict]) -> None:
-        account_entries = []
-        for account in accounts:
-            account_entry = {}
-            for key, val in account.items():
-                if key in self.cols_account:
-                    if isinstance(val, str) and val.find('/Date') == 0:
-                        account_entry[key] = convert_date(val)
-                    else:
-                        account_entry[key] = val
-            account_entries.append(account_entry)
-        self.df_accounts = pd.DataFrame.from_dict(account_entries) #type: ignore
+
+class InvoicesParser(RecordsParser):
+    table = 'Invoices'
+    key = 'InvoiceID'
+    columns = (
+        "InvoiceID",
+        "InvoiceNumber",
+        "Type",
+        "ContactID",
+        "Date",
+        "DueDate",
+        "Status",
+        "LineAmountTypes",
+        "SubTotal",
+        "TotalTax",
+        "Total",
+        "AmountDue",
+        "AmountPaid",
+        "AmountCredited",
+        "CurrencyCode",
+        "CurrencyRate",
+        "Reference",
+        "HasAttachments",
+        "UpdatedDateUTC",
+        "LineItems",
+    )
+    nested = {"ContactID": ("Contact", "ContactID")}
+
+
+class BankTransactionsParser(RecordsParser):
+    table = 'BankTransactions'
+    key = 'BankTransactionID'
+    columns = (
+        "BankTransactionID",
+        "Type",
+        "ContactID",
+        "BankAccountID",
+        "Date",
+        "Status",
+        "LineAmountTypes",
+        "SubTotal",
+        "TotalTax",
+        "Total",
+        "CurrencyCode",
+        "CurrencyRate",
+        "Reference",
+        "IsReconciled",
+        "HasAttachments",
+        "UpdatedDateUTC",
+        "LineItems",
+    )
+    nested = {"ContactID": ("Contact", "ContactID"), "BankAccountID": ("BankAccount", "AccountID")}
+
+
+class TrackingCategoriesParser(RecordsParser):
+    '''Tracking categories, with their options flattened into ``options`` rows ordered
+    as ``cols_option``.'''
+    table = 'TrackingCategories'
+    key = 'TrackingCategoryID'
+    columns = (
+        "TrackingCategoryID",
+        "Name",
+        "Status",
+    )
+    cols_option = ("TrackingOptionID", "TrackingCategoryID", "Name", "Status")
+
+    def __init__(self, records: Iterable[dict]) -> None:
+        records = list(records)
+        super().__init__(records)
+        self.options: list[tuple] = [
+            (option['TrackingOptionID'], record['TrackingCategoryID'], option.get('Name'), option.get('Status'))
+            for record in records for option in record.get('Options') or ()
+        ]
 
 
 class OrganisationParser():
@@ -150,16 +411,11 @@ class OrganisationParser():
         ]
     )
 
-    def __init__(self, organisations: list[dict], tenant_id) -> None:
-        organisation_entry = {}
-        for key, val in organisations[0].items():
-            if key in self.cols_organisation:
-                if isinstance(val, str) and val.find('/Date') == 0:
-                    organisation_entry[key] = convert_date(val)
-                else:
-                    organisation_entry[key] = val
+    def __init__(self, organisations: Iterable[dict], tenant_id) -> None:
+        organisation = next(iter(organisations))
+        organisation_entry = {key: val for key, val in organisation.items() if key in self.cols_organisation}
         organisation_entry['TenantID'] = tenant_id
-        self.df_organisations = pd.DataFrame.from_dict([organisation_entry]) #type: ignore
+        self.df_organisations = convert_date_frame(pd.DataFrame.from_dict([organisation_entry])) #type: ignore
 
 
 class UsersParser():
@@ -175,9 +431,9 @@ class UsersParser():
         ]
     )
 
-    def __init__(self, users: list[dict]) -> None:
+    def __init__(self, users: Iterable[dict]) -> None:
         user_entries = []
         for user in users:
             user_entry = {c: user.get(c) for c in self.cols_users}
             user_entries.append(user_entry)
-        self.df_users = pd.DataFrame.from_dict(user_entries)
+        self.df_users = convert_date_frame(pd.DataFrame.from_dict(user_entries))
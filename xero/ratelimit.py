@@ -0,0 +1,296 @@
+from collections import deque
+from contextlib import contextmanager
+from threading import Condition
+from time import monotonic, sleep, time
+from typing import Mapping
+from uuid import uuid4
+
+# https://developer.xero.com/documentation/guides/oauth2/limits/#api-rate-limits
+TENANT_CONCURRENT = 5
+TENANT_PER_MINUTE = 60
+TENANT_PER_DAY = 5000
+APP_PER_MINUTE = 10000
+# a request that has not released its slot by then is assumed dead
+LEASE_SECONDS = 120
+# waits longer than this (usually the daily limit) raise RateLimit instead of sleeping
+MAX_WAIT = 300
+
+
+class RateLimit(Exception):
+    pass
+
+
+def retry_after(headers: Mapping) -> float|None:
+    '''Seconds to back off after a 429, or None if Xero did not say which limit was hit.'''
+    problem = headers.get('X-Rate-Limit-Problem')
+    if problem is None:
+        return None
+    if problem == 'concurrent':
+        return 1
+    if problem in ('minute', 'appminute', 'day'):
+        return int(headers.get('Retry-After', 1))
+    raise RateLimit(f'X-Rate-Limit-Problem: {problem}')
+
+
+def remaining(headers: Mapping) -> dict[str, int]:
+    '''Remaining quota Xero reports on every response.'''
+    found = {}
+    for key, header in (('minute', 'X-MinLimit-Remaining'), ('day', 'X-DayLimit-Remaining'),
+        ('app_minute', 'X-AppMinLimit-Remaining')):
+        if header in headers:
+            found[key] = int(headers[header])
+    return found
+
+
+class _Window():
+    def __init__(self, limit: int, period: float):
+        self.limit = limit
+        self.period = period
+        self.calls: deque[float] = deque()
+
+    def wait_time(self, now: float) -> float:
+        while self.calls and now - self.calls[0] >= self.period:
+            self.calls.popleft()
+        if len(self.calls) < self.limit:
+            return 0
+        return self.period - (now - self.calls[-self.limit])
+
+    def sync(self, remaining: int, now: float):
+        # calls made outside this limiter still count against Xero's budget
+        for _ in range(self.limit - remaining - len(self.calls)):
+            self.calls.append(now)
+
+
+class RateLimiter():
+    '''Per-tenant concurrency, minute and day budgets plus the app-wide minute budget,
+    shared by every XeroApi in this process handed to the same limiter.'''
+
+    def __init__(self, tenant_concurrent: int=TENANT_CONCURRENT, tenant_per_minute: int=TENANT_PER_MINUTE,
+        tenant_per_day: int=TENANT_PER_DAY, app_per_minute: int=APP_PER_MINUTE, max_wait: float=MAX_WAIT):
+        self.tenant_concurrent = tenant_concurrent
+        self.tenant_per_minute = tenant_per_minute
+        self.tenant_per_day = tenant_per_day
+        self.max_wait = max_wait
+        self.app_window = _Window(app_per_minute, 60)
+        self.tenant_windows: dict[str, tuple[_Window, _Window]] = {}
+        self.in_flight: dict[str, int] = {}
+        self.blocked_until: dict[str, float] = {}
+        self.throttled: dict[str, int] = {}
+        self.cond = Condition()
+
+    def _windows(self, tenant_id: str) -> tuple[_Window, _Window]:
+        if tenant_id not in self.tenant_windows:
+            self.tenant_windows[tenant_id] = (_Window(self.tenant_per_minute, 60), _Window(self.tenant_per_day, 86400))
+        return self.tenant_windows[tenant_id]
+
+    def _take(self, tenant_id: str) -> float:
+        '''Takes a slot if one is free: 0, else seconds until one may be, or -1 until one
+        is released. Call holding ``cond``.'''
+        now = monotonic()
+        minute, day = self._windows(tenant_id)
+        wait = max(self.blocked_until.get(tenant_id, 0) - now, day.wait_time(now),
+            minute.wait_time(now), self.app_window.wait_time(now))
+        if wait > self.max_wait:
+            raise RateLimit(f'tenant {tenant_id} is out of API budget for {wait:.0f}s')
+        if wait > 0:
+            return wait
+        if self.in_flight.get(tenant_id, 0) >= self.tenant_concurrent:
+            return -1
+        for window in (minute, day, self.app_window):
+            window.calls.append(now)
+        self.in_flight[tenant_id] = self.in_flight.get(tenant_id, 0) + 1
+        return 0
+
+    def acquire(self, tenant_id: str) -> str|None:
+        with self.cond:
+            while True:
+                wait = self._take(tenant_id)
+                if wait == 0:
+                    return None
+                self.cond.wait(wait if wait > 0 else None)
+
+    def try_acquire(self, tenant_id: str) -> tuple[float, str|None]:
+        '''``acquire`` without blocking: (0, lease) with a slot, else (wait, None) where
+        wait is as ``_take`` returns it. For callers that wait themselves, e.g. asyncio.'''
+        with self.cond:
+            return self._take(tenant_id), None
+
+    def release(self, tenant_id: str, lease: str|None=None):
+        with self.cond:
+            self.in_flight[tenant_id] -= 1
+            self.cond.notify_all()
+
+    def observe(self, tenant_id: str, status_code: int, headers: Mapping):
+        with self.cond:
+            now = monotonic()
+            minute, day = self._windows(tenant_id)
+            found = remaining(headers)
+            for key, window in (('minute', minute), ('day', day), ('app_minute', self.app_window)):
+                if key in found:
+                    window.sync(found[key], now)
+            if status_code == 429:
+                self.throttled[tenant_id] = self.throttled.get(tenant_id, 0) + 1
+                delay = retry_after(headers)
+                if delay:
+                    self.blocked_until[tenant_id] = now + delay
+            self.cond.notify_all()
+
+    def stats(self, tenant_id: str) -> dict:
+        with self.cond:
+            now = monotonic()
+            minute, day = self._windows(tenant_id)
+            for window in (minute, day, self.app_window):
+                window.wait_time(now)
+            return {
+                'minute_used': len(minute.calls),
+                'day_used': len(day.calls),
+                'app_minute_used': len(self.app_window.calls),
+                'in_flight': self.in_flight.get(tenant_id, 0),
+                'throttled': self.throttled.get(tenant_id, 0),
+            }
+
+    @contextmanager
+    def slot(self, tenant_id: str):
+        lease = self.acquire(tenant_id)
+        try:
+            yield
+        finally:
+            self.release(tenant_id, lease)
+
+
+# KEYS: tenant minute, tenant day, app minute, tenant leases, tenant block, app block
+# ARGV: now ms, lease id, lease ms, tenant concurrent, tenant/min, tenant/day, app/min
+_ACQUIRE = '''
+local now = tonumber(ARGV[1])
+local wait = math.max(redis.call('PTTL', KEYS[5]), redis.call('PTTL', KEYS[6]), 0)
+local windows = {{KEYS[1], tonumber(ARGV[5]), 60000}, {KEYS[2], tonumber(ARGV[6]), 86400000},
+    {KEYS[3], tonumber(ARGV[7]), 60000}}
+for _, w in ipairs(windows) do
+    redis.call('ZREMRANGEBYSCORE', w[1], '-inf', now - w[3])
+    local used = redis.call('ZCARD', w[1])
+    if used >= w[2] then
+        local oldest = redis.call('ZRANGE', w[1], used - w[2], used - w[2], 'WITHSCORES')
+        wait = math.max(wait, tonumber(oldest[2]) + w[3] - now)
+    end
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[4], '-inf', now)
+if wait > 0 then return wait end
+if redis.call('ZCARD', KEYS[4]) >= tonumber(ARGV[4]) then return -1 end
+for _, w in ipairs(windows) do
+    redis.call('ZADD', w[1], now, ARGV[2])
+    redis.call('PEXPIRE', w[1], w[3])
+end
+redis.call('ZADD', KEYS[4], now + tonumber(ARGV[3]), ARGV[2])
+redis.call('PEXPIRE', KEYS[4], tonumber(ARGV[3]))
+return 0
+'''
+
+# KEYS: window; ARGV: now ms, limit, remaining, period ms
+_SYNC = '''
+local now = tonumber(ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - tonumber(ARGV[4]))
+local missing = tonumber(ARGV[2]) - tonumber(ARGV[3]) - redis.call('ZCARD', KEYS[1])
+for i = 1, missing do
+    redis.call('ZADD', KEYS[1], now, 'x' .. now .. ':' .. i)
+end
+if missing > 0 then redis.call('PEXPIRE', KEYS[1], tonumber(ARGV[4])) end
+return missing
+'''
+
+
+class RedisRateLimiter(RateLimiter):
+    '''RateLimiter whose budgets live in Redis, so every worker process and cron job
+    calling Xero for a tenant paces against the same counters.
+
+    Minute and day budgets are sliding windows of call timestamps; concurrency is a set
+    of leases that expire after ``lease_seconds`` in case a process dies mid-request.
+    Remaining-quota headers pad the windows with calls made elsewhere, and a 429 blocks
+    the tenant (or the whole app) for its Retry-After.'''
+
+    def __init__(self, redis, tenant_concurrent: int=TENANT_CONCURRENT, tenant_per_minute: int=TENANT_PER_MINUTE,
+        tenant_per_day: int=TENANT_PER_DAY, app_per_minute: int=APP_PER_MINUTE, max_wait: float=MAX_WAIT,
+        lease_seconds: float=LEASE_SECONDS, prefix: str='xero-rl'):
+        super().__init__(tenant_concurrent, tenant_per_minute, tenant_per_day, app_per_minute, max_wait)
+        self.redis = redis
+        self.app_per_minute = app_per_minute
+        self.lease_ms = int(lease_seconds * 1000)
+        self.prefix = prefix
+        self._acquire = redis.register_script(_ACQUIRE)
+        self._sync = redis.register_script(_SYNC)
+
+    def _keys(self, tenant_id: str) -> list[str]:
+        return [
+            f'{self.prefix}:minute:{tenant_id}',
+            f'{self.prefix}:day:{tenant_id}',
+            f'{self.prefix}:app-minute',
+            f'{self.prefix}:leases:{tenant_id}',
+            f'{self.prefix}:blocked:{tenant_id}',
+            f'{self.prefix}:blocked',
+        ]
+
+    def acquire(self, tenant_id: str) -> str|None:
+        while True:
+            wait, lease = self.try_acquire(tenant_id)
+            if wait == 0:
+                return lease
+            # -1: all concurrent slots are taken, poll until one is released
+            sleep(0.05 if wait < 0 else min(wait, 1))
+
+    def try_acquire(self, tenant_id: str) -> tuple[float, str|None]:
+        lease = uuid4().hex
+        wait = int(self._acquire(keys=self._keys(tenant_id), args=[int(time() * 1000), lease, self.lease_ms,
+            self.tenant_concurrent, self.tenant_per_minute, self.tenant_per_day, self.app_per_minute]))
+        if wait == 0:
+            return 0, lease
+        if wait / 1000 > self.max_wait:
+            raise RateLimit(f'tenant {tenant_id} is out of API budget for {wait / 1000:.0f}s')
+        return (wait / 1000 if wait > 0 else -1), None
+
+    def release(self, tenant_id: str, lease: str|None=None):
+        if lease is not None:
+            self.redis.zrem(self._keys(tenant_id)[3], lease)
+
+    def observe(self, tenant_id: str, status_code: int, headers: Mapping):
+        keys = self._keys(tenant_id)
+        now = int(time() * 1000)
+        found = remaining(headers)
+        for key, window, limit, period in (('minute', keys[0], self.tenant_per_minute, 60000),
+            ('day', keys[1], self.tenant_per_day, 86400000), ('app_minute', keys[2], self.app_per_minute, 60000)):
+            if key in found:
+                self._sync(keys=[window], args=[now, limit, found[key], period])
+        if found:
+            self.redis.hset(f'{self.prefix}:remaining:{tenant_id}', mapping=found)
+        if status_code == 429:
+            self.redis.hincrby(f'{self.prefix}:throttled', tenant_id, 1)
+            delay = retry_after(headers)
+            if delay:
+                block = keys[5] if headers.get('X-Rate-Limit-Problem') == 'appminute' else keys[4]
+                self.redis.set(block, 1, px=int(delay * 1000))
+
+    def stats(self, tenant_id: str) -> dict:
+        keys = self._keys(tenant_id)
+        now = int(time() * 1000)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zcount(keys[0], now - 60000, '+inf')
+        pipe.zcount(keys[1], now - 86400000, '+inf')
+        pipe.zcount(keys[2], now - 60000, '+inf')
+        pipe.zcount(keys[3], now, '+inf')
+        pipe.hget(f'{self.prefix}:throttled', tenant_id)
+        pipe.hgetall(f'{self.prefix}:remaining:{tenant_id}')
+        minute, day, app_minute, in_flight, throttled, reported = pipe.execute()
+        return {
+            'minute_used': minute,
+            'day_used': day,
+            'app_minute_used': app_minute,
+            'in_flight': in_flight,
+            'throttled': int(throttled or 0),
+            'reported_remaining': {k.decode() if isinstance(k, bytes) else k: int(v) for k, v in reported.items()},
+        }
+
+
+def shared_limiter(**kwargs) -> RateLimiter:
+    '''The Redis-backed limiter when Redis is reachable, otherwise one for this process.'''
+    from utils.redis import redis_con
+    if redis_con is not None:
+        return RedisRateLimiter(redis_con, **kwargs)
+    return RateLimiter(**kwargs)
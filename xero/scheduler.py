@@ -0,0 +1,140 @@
+from .api import XeroApi
+from .ratelimit import RateLimiter, shared_limiter
+from .updater import JournalUpdater
+from collections import deque
+from concurrent.futures import Future
+from threading import Thread, Condition
+from typing import Callable
+import traceback
+import sys
+
+PRIORITY_INCREMENTAL = 0
+PRIORITY_BACKFILL = 10
+
+def run_update(updater: JournalUpdater) -> dict:
+    while True:
+        result = updater.update_sql()
+        if result['error'] or result['done']:
+            return result
+
+def run_full_update(updater: JournalUpdater) -> dict:
+    return updater.full_update()
+
+SYNC_KINDS: dict[str, tuple[Callable[[JournalUpdater], dict], int]] = {
+    'update': (run_update, PRIORITY_INCREMENTAL),
+    'full': (run_full_update, PRIORITY_BACKFILL),
+}
+
+
+class SyncJob():
+    def __init__(self, tenant_id: str, kind: str, priority: int):
+        self.tenant_id = tenant_id
+        self.kind = kind
+        self.priority = priority
+        self.future: Future = Future()
+
+
+class SyncScheduler():
+    '''Runs many tenants' journal syncs on a shared worker pool.
+
+    Jobs are taken lowest priority value first, round-robin across tenants within a
+    priority, and at most ``tenant_jobs`` syncs run for one tenant at a time. Backfills
+    may occupy at most ``max_backfills`` workers so top-ups never wait behind them.
+    Every XeroApi is built with the scheduler's RateLimiter, which keeps all workers
+    inside the per-tenant and app-wide call budgets.'''
+
+    def __init__(self, api_factory: Callable[[str, RateLimiter], XeroApi], workers: int=8,
+        tenant_jobs: int=1, max_backfills: int|None=None, limiter: RateLimiter|None=None):
+        self.api_factory = api_factory
+        self.workers = workers
+        self.tenant_jobs = tenant_jobs
+        self.max_backfills = max(workers - 1, 1) if max_backfills is None else max_backfills
+        self.limiter = limiter or shared_limiter()
+        self.queues: dict[int, dict[str, deque[SyncJob]]] = {}
+        self.pending: dict[tuple[str, str], SyncJob] = {}
+        self.running: dict[str, int] = {}
+        self.backfills = 0
+        self.closed = False
+        self.cond = Condition()
+        self.threads: list[Thread] = []
+
+    def start(self):
+        for n in range(self.workers):
+            thread = Thread(target=self._worker, name=f'sync-worker-{n}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def shutdown(self, wait: bool=True):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        if wait:
+            for thread in self.threads:
+                thread.join()
+
+    def submit(self, tenant_id: str, kind: str='update', priority: int|None=None) -> Future:
+        '''Queues a sync. A sync of the same kind already waiting for the tenant is reused.'''
+        if kind not in SYNC_KINDS:
+            raise ValueError(f'unknown sync kind {kind}')
+        if priority is None:
+            priority = SYNC_KINDS[kind][1]
+        with self.cond:
+            if self.closed:
+                raise RuntimeError('scheduler is shut down')
+            job = self.pending.get((tenant_id, kind))
+            if job:
+                return job.future
+            job = SyncJob(tenant_id, kind, priority)
+            self.pending[(tenant_id, kind)] = job
+            self.queues.setdefault(priority, {}).setdefault(tenant_id, deque()).append(job)
+            self.cond.notify()
+        return job.future
+
+    def _next_job(self) -> SyncJob|None:
+        for priority in sorted(self.queues):
+            tenants = self.queues[priority]
+            for tenant_id in list(tenants):
+                if self.running.get(tenant_id, 0) >= self.tenant_jobs:
+                    continue
+                job = tenants[tenant_id][0]
+                if job.kind == 'full' and self.backfills >= self.max_backfills:
+                    continue
+                # re-inserting the tenant moves it behind its peers at this priority
+                queue = tenants.pop(tenant_id)
+                queue.popleft()
+                if queue:
+                    tenants[tenant_id] = queue
+                if not tenants:
+                    del self.queues[priority]
+                return job
+        return None
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while True:
+                    job = self._next_job()
+                    if job:
+                        break
+                    if self.closed and not self.pending:
+                        return
+                    self.cond.wait()
+                del self.pending[(job.tenant_id, job.kind)]
+                self.running[job.tenant_id] = self.running.get(job.tenant_id, 0) + 1
+                if job.kind == 'full':
+                    self.backfills += 1
+            if job.future.set_running_or_notify_cancel():
+                self._run(job)
+            with self.cond:
+                self.running[job.tenant_id] -= 1
+                if job.kind == 'full':
+                    self.backfills -= 1
+                self.cond.notify_all()
+
+    def _run(self, job: SyncJob):
+        try:
+            updater = JournalUpdater(job.tenant_id, self.api_factory(job.tenant_id, self.limiter))
+            job.future.set_result(SYNC_KINDS[job.kind][0](updater))
+        except BaseException as exc:
+            print(traceback.format_exc() + f'\n tenant_id = {job.tenant_id}', file=sys.stderr)
+            job.future.set_exception(exc)
@@ -0,0 +1,80 @@
+import codecs
+import json
+from typing import Iterable, Iterator, Any
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+_TRIM_AT = 1 << 16
+
+
+class _Buffer():
+    '''Text decoded so far from a byte stream, with a read position.'''
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self.chunks = iter(chunks)
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.text = ''
+        self.pos = 0
+
+    def more(self) -> bool:
+        for chunk in self.chunks:
+            if not chunk:
+                continue
+            if self.pos > _TRIM_AT:
+                self.text = self.text[self.pos:]
+                self.pos = 0
+            self.text += self.utf8.decode(chunk)
+            return True
+        return False
+
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.more():
+                raise ValueError('unexpected end of JSON stream')
+
+    def expect(self, char: str):
+        if self.peek() != char:
+            raise ValueError(f'expected {char!r} at offset {self.pos} of JSON stream')
+        self.pos += 1
+
+    def value(self) -> Any:
+        self.peek()
+        while True:
+            # a value must be followed by something (',', ']' or '}') in valid JSON,
+            # which also stops numbers being cut short at a chunk boundary
+            try:
+                val, end = _decoder.raw_decode(self.text, self.pos)
+                if end < len(self.text):
+                    self.pos = end
+                    return val
+            except json.JSONDecodeError:
+                pass
+            if not self.more():
+                val, self.pos = _decoder.raw_decode(self.text, self.pos)
+                return val
+
+
+def iter_json_array(chunks: Iterable[bytes], key: str) -> Iterator[Any]:
+    '''Yields the items of the array at ``key`` of a top-level JSON object, one at a time,
+    while the body is still being received. Other top-level values are decoded and dropped.'''
+    buf = _Buffer(chunks)
+    buf.expect('{')
+    while buf.peek() != '}':
+        name = buf.value()
+        buf.expect(':')
+        if name != key:
+            buf.value()
+        else:
+            buf.expect('[')
+            while buf.peek() != ']':
+                yield buf.value()
+                if buf.peek() == ',':
+                    buf.pos += 1
+            return
+        if buf.peek() == ',':
+            buf.pos += 1
+    raise KeyError(key)